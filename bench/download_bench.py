@@ -0,0 +1,255 @@
+"""Download benchmark against the local fake Quark server.
+
+Runs the real download path, file/download included, for every segment
+size and connection budget combination and reports throughput, requests
+per file and the segment times the server measured. Nothing leaves the
+machine, so results are comparable between commits.
+
+    python bench/download_bench.py --files 8 --size 64 --segments 4,16 --connections 4,16
+    python bench/download_bench.py --scenario oneclick --bandwidth 8 --latency 20
+
+--scenario files downloads fids of the drive (download_pipeline,
+download_file, download_part). oneclick runs one_click_download_pipeline
+on someone else's share: save, share, crawl, download and clean up.
+"""
+
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+from typing import Any
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import httpx  # noqa: E402
+
+from downloader import DownloadManifest, HostProfile  # noqa: E402
+from fake_quark import FakeQuark, LocalTransport  # noqa: E402
+from quark import QuarkPanFileManager  # noqa: E402
+
+MB = 1024 * 1024
+
+
+class BenchManager(QuarkPanFileManager):
+    """The manager with a dummy cookie instead of a browser login."""
+
+    def get_cookies(self) -> str:
+        return "bench=1"
+
+
+def make_manager(
+    server: FakeQuark, folder: str, segment: int, connections: int, args
+) -> BenchManager:
+    manager = BenchManager()
+    manager.save_folder = os.path.join(folder, "downloads")
+    manager.segment_size = segment
+    # One worker per segment up front, the budget caps them
+    manager.block_size = segment
+    manager.connection_budget.limit = connections
+    manager.concurrent_files = args.concurrent_files
+    manager.adaptive_connections = args.adaptive
+    manager.hedge_budget = args.hedge_budget
+    manager.progress.mode = "off"
+    # Learned connection counts would carry over between runs
+    manager.host_profile = HostProfile(os.path.join(folder, "host_profile.json"))
+    manager.host_selector.profile = manager.host_profile
+    manager.session.configure(
+        transport=LocalTransport(
+            server.base_url,
+            limits=httpx.Limits(
+                max_connections=connections + 16,
+                max_keepalive_connections=connections + 16,
+            ),
+        )
+    )
+    return manager
+
+
+def downloaded(folder: str) -> tuple[int, int]:
+    """Count and bytes of the files that finished."""
+    count = size = 0
+    for root, _, names in os.walk(folder):
+        for name in names:
+            # Sync state, manifests and the files they belong to
+            if (
+                name.startswith(".")
+                or name.endswith(DownloadManifest.SUFFIX)
+                or name + DownloadManifest.SUFFIX in names
+            ):
+                continue
+            count += 1
+            size += os.path.getsize(os.path.join(root, name))
+    return count, size
+
+
+async def run_files(manager: BenchManager, server: FakeQuark, args) -> None:
+    _, fids = server.populate(args.files, args.size * MB)
+    await manager.quark_file_download(fids)
+
+
+async def run_oneclick(manager: BenchManager, server: FakeQuark, args) -> None:
+    share_url = server.add_foreign_share(args.files, args.size * MB)
+    manager.pdir_id = "0"
+    try:
+        await manager.one_click_download_pipeline(share_url)
+    except SystemExit as e:
+        raise Exception(f"one_click_download_pipeline exited with {e.code}")
+
+
+SCENARIOS = {"files": run_files, "oneclick": run_oneclick}
+
+
+async def bench(
+    server: FakeQuark, segment: int, connections: int, args
+) -> dict[str, Any]:
+    with tempfile.TemporaryDirectory() as folder:
+        cwd = os.getcwd()
+        # one_click writes output/share_url.txt next to where it runs
+        os.chdir(folder)
+        log = io.StringIO()
+        error = None
+        try:
+            async with make_manager(
+                server, folder, segment, connections, args
+            ) as manager:
+                server.reset_stats()
+                started = time.perf_counter()
+                with contextlib.redirect_stdout(sys.stdout if args.verbose else log):
+                    try:
+                        await SCENARIOS[args.scenario](manager, server, args)
+                    except Exception as e:
+                        error = str(e)
+                elapsed = time.perf_counter() - started
+                # As the client saw them, the server can't tell a retry apart
+                retries = sum(
+                    stats.retries for stats in manager.metrics.endpoints.values()
+                )
+        finally:
+            os.chdir(cwd)
+        files, size = downloaded(os.path.join(folder, "downloads"))
+
+    stats = server.summary()
+    requests = sum(stats["requests"].values())
+    expected = args.files * args.size * MB
+    return {
+        "segment_mb": segment,
+        "connections": connections,
+        "seconds": round(elapsed, 2),
+        "mb_s": round(size / elapsed / MB, 1),
+        "files_ok": (
+            f"{files}/{args.files}" if size == expected else f"{files}/{args.files}!"
+        ),
+        "requests_per_file": round(requests / args.files, 1),
+        "cdn_requests_per_file": round(
+            stats["requests"].get("/cdn", 0) / args.files, 1
+        ),
+        "segment_p50": stats["segment_p50"],
+        "segment_p99": stats["segment_p99"],
+        "errors": sum(n for status, n in stats["statuses"].items() if status >= 400),
+        "retries": retries,
+        "error": error,
+    }
+
+
+COLUMNS = (
+    ("segment_mb", "seg MB"),
+    ("connections", "conns"),
+    ("seconds", "secs"),
+    ("mb_s", "MB/s"),
+    ("files_ok", "files"),
+    ("requests_per_file", "req/file"),
+    ("cdn_requests_per_file", "cdn/file"),
+    ("segment_p50", "p50 s"),
+    ("segment_p99", "p99 s"),
+    ("errors", "4xx/5xx"),
+    ("retries", "retries"),
+)
+
+
+def print_row(row: dict[str, Any]) -> None:
+    print("  ".join(f"{str(row[key]):>9}" for key, _ in COLUMNS))
+    if row["error"]:
+        print(f"    error: {row['error']}")
+
+
+def int_list(value: str) -> list[int]:
+    return [int(v) for v in value.split(",") if v]
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--scenario", choices=sorted(SCENARIOS), default="files")
+    parser.add_argument("--files", type=int, default=4)
+    parser.add_argument("--size", type=int, default=64, help="MB per file")
+    parser.add_argument(
+        "--segments", type=int_list, default=[4, 16], help="segment sizes in MB"
+    )
+    parser.add_argument("--connections", type=int_list, default=[4, 16])
+    parser.add_argument("--concurrent-files", type=int, default=3)
+    parser.add_argument(
+        "--bandwidth", type=float, default=0, help="MB/s per connection"
+    )
+    parser.add_argument("--total-bandwidth", type=float, default=0, help="MB/s overall")
+    parser.add_argument(
+        "--latency", type=float, default=0, help="ms before each response"
+    )
+    parser.add_argument("--error-rate", type=float, default=0)
+    parser.add_argument("--drop-rate", type=float, default=0)
+    parser.add_argument("--straggler-rate", type=float, default=0)
+    parser.add_argument("--url-ttl", type=float, default=0, help="seconds")
+    parser.add_argument(
+        "--api-rate", type=float, default=0, help="API requests/s per path"
+    )
+    parser.add_argument("--no-ranges", action="store_true")
+    parser.add_argument(
+        "--adaptive", action="store_true", help="let the tuner pick connections"
+    )
+    parser.add_argument("--hedge-budget", type=float, default=0.1)
+    parser.add_argument("--json", action="store_true", help="one JSON object per run")
+    parser.add_argument(
+        "--verbose", action="store_true", help="show the downloader's output"
+    )
+    return parser.parse_args()
+
+
+async def main() -> None:
+    args = parse_args()
+    server = FakeQuark(
+        api_latency=args.latency / 1000,
+        cdn_latency=args.latency / 1000,
+        bandwidth=args.bandwidth * MB,
+        total_bandwidth=args.total_bandwidth * MB,
+        ranges=not args.no_ranges,
+        error_rate=args.error_rate,
+        drop_rate=args.drop_rate,
+        straggler_rate=args.straggler_rate,
+        url_ttl=args.url_ttl,
+        api_rate=args.api_rate,
+    )
+    server.start()
+    try:
+        if not args.json:
+            print(
+                f"{args.scenario}: {args.files} x {args.size} MB, "
+                f"{args.bandwidth or 'unlimited'} MB/s per connection, "
+                f"{args.latency:g} ms latency"
+            )
+            print("  ".join(f"{title:>9}" for _, title in COLUMNS))
+        for segment in args.segments:
+            for connections in args.connections:
+                row = await bench(server, segment, connections, args)
+                if args.json:
+                    print(json.dumps(row, ensure_ascii=False))
+                else:
+                    print_row(row)
+    finally:
+        server.stop()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
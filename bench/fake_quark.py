@@ -0,0 +1,782 @@
+"""Local stand-in for the Quark endpoints the downloader talks to.
+
+Serves token, detail, sort, account/info, create dir, save, task, share,
+share/password, share/delete, file/download and file/delete from an
+in-memory drive, plus a CDN path for the signed download URLs. File
+contents are generated from a seed, so large files cost no memory.
+
+Knobs, all attributes of FakeQuark that can be changed between runs:
+
+    api_latency, cdn_latency   seconds before a response starts
+    bandwidth                  bytes/s per CDN response, 0 is unlimited
+    total_bandwidth            bytes/s over all CDN responses
+    ranges                     False serves the whole file for any Range
+    error_rate                 share of CDN requests answered with a 503
+    drop_rate                  share of CDN responses cut off midway
+    straggler_rate             share of CDN responses sent at
+                               straggler_bandwidth
+    url_ttl                    download URLs expire after this many seconds,
+                               a stale one gets a 403
+    task_polls                 task polls answered "running" before a task
+                               finishes
+    api_rate                   API requests/s per path, beyond it a 429
+                               with Retry-After, 0 is unlimited
+
+fail() scripts the next answers of one API path, e.g. code 23018 from
+file/download or a 429 with Retry-After.
+
+Clients reach it through LocalTransport, which sends requests for the
+Quark hosts here and leaves the rest alone:
+
+    server = FakeQuark()
+    base_url = server.start()
+    manager.session.configure(transport=LocalTransport(base_url))
+
+Standalone, for poking at it with curl:
+
+    python bench/fake_quark.py [port]
+"""
+
+import asyncio
+import hashlib
+import hmac
+import itertools
+import json
+import os
+import random
+import re
+import secrets
+import sys
+import threading
+import time
+from collections import Counter, defaultdict, deque
+from typing import Any, Union
+from urllib.parse import parse_qsl, quote, urlsplit
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from downloader import BandwidthLimiter  # noqa: E402
+
+QUARK_HOSTS = ("drive-pc.quark.cn", "drive.quark.cn", "pan.quark.cn")
+PATTERN_SIZE = 64 * 1024
+CHUNK_SIZE = 64 * 1024
+
+REASONS = {
+    200: "OK",
+    206: "Partial Content",
+    400: "Bad Request",
+    403: "Forbidden",
+    404: "Not Found",
+    416: "Range Not Satisfiable",
+    429: "Too Many Requests",
+    500: "Internal Server Error",
+    503: "Service Unavailable",
+}
+
+
+def parse_range(value: str, size: int) -> Union[tuple[int, int], None]:
+    """start, end of a single "bytes=" range, None if it can't be served."""
+    match = re.fullmatch(r"bytes=(\d*)-(\d*)", value.strip())
+    if not match or not (match.group(1) or match.group(2)):
+        return None
+    if not match.group(1):
+        # Suffix range, the last n bytes
+        start = max(size - int(match.group(2)), 0)
+        end = size - 1
+    else:
+        start = int(match.group(1))
+        end = int(match.group(2)) if match.group(2) else size - 1
+    if start >= size or end < start:
+        return None
+    return start, min(end, size - 1)
+
+
+def percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(len(values) * q), len(values) - 1)]
+
+
+class FakeQuark:
+    """In-memory drive, shares and tasks behind the Quark API paths."""
+
+    ROOT = "0"
+
+    def __init__(
+        self,
+        api_latency: float = 0.0,
+        cdn_latency: float = 0.0,
+        bandwidth: float = 0.0,
+        total_bandwidth: float = 0.0,
+        ranges: bool = True,
+        error_rate: float = 0.0,
+        drop_rate: float = 0.0,
+        straggler_rate: float = 0.0,
+        straggler_bandwidth: float = 1024 * 1024,
+        url_ttl: float = 0.0,
+        task_polls: int = 1,
+        api_rate: float = 0.0,
+        seed: int = 0,
+    ) -> None:
+        self.api_latency = api_latency
+        self.cdn_latency = cdn_latency
+        self.bandwidth = bandwidth
+        self.total_bandwidth = total_bandwidth
+        self.ranges = ranges
+        self.error_rate = error_rate
+        self.drop_rate = drop_rate
+        self.straggler_rate = straggler_rate
+        self.straggler_bandwidth = straggler_bandwidth
+        self.url_ttl = url_ttl
+        self.task_polls = task_polls
+        self.api_rate = api_rate
+        self.random = random.Random(seed)
+        self.secret = secrets.token_bytes(16)
+        self.base_url = ""
+        self.nodes: dict[str, dict[str, Any]] = {
+            self.ROOT: {"fid": self.ROOT, "file_name": "", "dir": True, "pdir_fid": ""}
+        }
+        self.children: dict[str, list[str]] = defaultdict(list)
+        self.shares: dict[str, dict[str, Any]] = {}
+        self.tasks: dict[str, dict[str, Any]] = {}
+        self.failures: dict[str, list[dict[str, Any]]] = defaultdict(list)
+        self._ids = itertools.count(1)
+        # path -> times of the API requests of the last second
+        self._recent: dict[str, deque[float]] = defaultdict(deque)
+        self._patterns: dict[int, bytes] = {}
+        self._md5: dict[int, str] = {}
+        self._limiter = BandwidthLimiter()
+        self._loop: Union[asyncio.AbstractEventLoop, None] = None
+        self._server: Union[asyncio.base_events.Server, None] = None
+        self._thread: Union[threading.Thread, None] = None
+        self.reset_stats()
+
+    def reset_stats(self) -> None:
+        # path -> count, CDN requests counted under "/cdn"
+        self.requests: Counter = Counter()
+        self.statuses: Counter = Counter()
+        self.connections = 0
+        self.bytes_sent = 0
+        # Request to last byte of every completed Range response
+        self.segment_times: list[float] = []
+
+    # Drive contents
+
+    def _new_id(self) -> str:
+        return f"{next(self._ids):08d}" + secrets.token_hex(12)
+
+    def _add(self, pdir_fid: str, name: str, is_dir: bool, **fields) -> str:
+        fid = self._new_id()
+        self.nodes[fid] = {
+            "fid": fid,
+            "file_name": name,
+            "dir": is_dir,
+            "pdir_fid": pdir_fid,
+            "size": 0,
+            "updated_at": int(time.time() * 1000),
+            **fields,
+        }
+        self.children[pdir_fid].append(fid)
+        return fid
+
+    def add_dir(self, name: str, pdir_fid: str = ROOT) -> str:
+        return self._add(pdir_fid, name, True)
+
+    def add_file(self, name: str, size: int, pdir_fid: str = ROOT) -> str:
+        return self._add(
+            pdir_fid, name, False, size=size, seed=self.random.getrandbits(32)
+        )
+
+    def populate(
+        self, count: int, size: int, folder: str = "bench", pdir_fid: str = ROOT
+    ) -> tuple[str, list[str]]:
+        """A folder of count files of size bytes, returns its fid and theirs."""
+        folder_fid = self.add_dir(folder, pdir_fid)
+        fids = [
+            self.add_file(f"file_{i:04d}.bin", size, folder_fid) for i in range(count)
+        ]
+        return folder_fid, fids
+
+    def add_share(
+        self, fids: list[str], title: str = "", owner: bool = False, passcode: str = ""
+    ) -> str:
+        """Share fids, returns the share URL. Files the current user didn't
+        share themselves are listed with is_owner 0, like someone else's."""
+        pwd_id = secrets.token_hex(6)
+        share_id = secrets.token_hex(16)
+        self.shares[pwd_id] = {
+            "pwd_id": pwd_id,
+            "share_id": share_id,
+            "fids": list(fids),
+            "title": title or (self.nodes[fids[0]]["file_name"] if fids else ""),
+            "owner": owner,
+            "passcode": passcode,
+            "stokens": set(),
+        }
+        url = f"https://pan.quark.cn/s/{pwd_id}"
+        return f"{url}?pwd={passcode}" if passcode else url
+
+    def add_foreign_share(
+        self, count: int, size: int, folder: str = "share", passcode: str = ""
+    ) -> str:
+        """A share of someone else's folder of count files."""
+        owner_root = self.add_dir("__other_user__", "")
+        folder_fid, _ = self.populate(count, size, folder, owner_root)
+        return self.add_share([folder_fid], folder, owner=False, passcode=passcode)
+
+    def _copy(self, fid: str, pdir_fid: str) -> str:
+        node = self.nodes[fid]
+        fields = {k: v for k, v in node.items() if k not in ("fid", "pdir_fid")}
+        name, is_dir = fields.pop("file_name"), fields.pop("dir")
+        new_fid = self._add(pdir_fid, name, is_dir, **fields)
+        for child in list(self.children.get(fid, [])):
+            self._copy(child, new_fid)
+        return new_fid
+
+    def _remove(self, fid: str) -> None:
+        node = self.nodes.pop(fid, None)
+        if node is None:
+            return
+        for child in self.children.pop(fid, []):
+            self._remove(child)
+        siblings = self.children.get(node["pdir_fid"])
+        if siblings and fid in siblings:
+            siblings.remove(fid)
+
+    def _in_drive(self, fid: str) -> bool:
+        while fid in self.nodes:
+            if fid == self.ROOT:
+                return True
+            fid = self.nodes[fid]["pdir_fid"]
+        return False
+
+    # File contents
+
+    def _pattern(self, seed: int) -> bytes:
+        pattern = self._patterns.get(seed)
+        if pattern is None:
+            pattern = random.Random(seed).randbytes(PATTERN_SIZE)
+            self._patterns[seed] = pattern
+        return pattern
+
+    def read(self, node: dict[str, Any], start: int, end: int) -> bytes:
+        """Bytes start..end inclusive of a file, its seed's pattern repeated."""
+        pattern = self._pattern(node["seed"])
+        offset = start % PATTERN_SIZE
+        length = end - start + 1
+        repeats = (offset + length) // PATTERN_SIZE + 1
+        return (pattern * repeats)[offset : offset + length]
+
+    def md5(self, node: dict[str, Any]) -> str:
+        key = node["seed"] ^ (node["size"] << 32)
+        digest = self._md5.get(key)
+        if digest is None:
+            hasher = hashlib.md5()
+            pattern = self._pattern(node["seed"])
+            full, rest = divmod(node["size"], PATTERN_SIZE)
+            for _ in range(full):
+                hasher.update(pattern)
+            hasher.update(pattern[:rest])
+            digest = self._md5[key] = hasher.hexdigest()
+        return digest
+
+    def download_url(self, node: dict[str, Any]) -> str:
+        expires = int(time.time() + self.url_ttl) if self.url_ttl else 0
+        return (
+            f"{self.base_url}/cdn/{node['fid']}/{quote(node['file_name'])}"
+            f"?expires={expires}&sign={self._sign(node['fid'], expires)}"
+        )
+
+    def _sign(self, fid: str, expires: int) -> str:
+        message = f"{fid}:{expires}".encode()
+        return hmac.new(self.secret, message, hashlib.sha1).hexdigest()[:16]
+
+    # API
+
+    def fail(
+        self,
+        path: str,
+        times: int = 1,
+        status: int = 200,
+        code: int = 500,
+        message: str = "fake failure",
+        retry_after: Union[float, None] = None,
+    ) -> None:
+        """Answer the next times calls of path with an error, with HTTP
+        status or with an error JSON body when status is 200."""
+        for _ in range(times):
+            self.failures[path].append(
+                {
+                    "status": status,
+                    "code": code,
+                    "message": message,
+                    "retry_after": retry_after,
+                }
+            )
+
+    @staticmethod
+    def ok(data: Any = None, **extra) -> dict[str, Any]:
+        return {"status": 200, "code": 0, "message": "ok", "data": data, **extra}
+
+    @staticmethod
+    def error(code: int, message: str, status: int = 400) -> dict[str, Any]:
+        return {"status": status, "code": code, "message": message, "data": None}
+
+    @staticmethod
+    def page(items: list, query: dict[str, str]) -> tuple[list, dict[str, Any]]:
+        size = max(int(query.get("_size") or 50), 1)
+        page = max(int(query.get("_page") or 1), 1)
+        chunk = items[(page - 1) * size : page * size]
+        return chunk, {
+            "_total": len(items),
+            "_size": size,
+            "_count": len(chunk),
+            "_page": page,
+        }
+
+    def _listing(self, pdir_fid: str) -> list[dict[str, Any]]:
+        # Folders first, the order the client asks for
+        fids = sorted(
+            self.children.get(pdir_fid, []),
+            key=lambda f: (not self.nodes[f]["dir"], self.nodes[f]["file_name"]),
+        )
+        return [self._entry(self.nodes[fid]) for fid in fids]
+
+    def _entry(self, node: dict[str, Any]) -> dict[str, Any]:
+        return {
+            "fid": node["fid"],
+            "file_name": node["file_name"],
+            "file_type": 0 if node["dir"] else 1,
+            "dir": node["dir"],
+            "pdir_fid": node["pdir_fid"],
+            "size": node["size"],
+            "updated_at": node["updated_at"],
+            "include_items": len(self.children.get(node["fid"], [])),
+            "share_fid_token": hashlib.sha1(node["fid"].encode()).hexdigest(),
+            "status": 1,
+        }
+
+    def _task(self, kind: str, **result) -> str:
+        task_id = secrets.token_hex(16)
+        self.tasks[task_id] = {"kind": kind, "polls": self.task_polls, **result}
+        return task_id
+
+    def api(
+        self, method: str, path: str, query: dict[str, str], body: dict[str, Any]
+    ) -> dict[str, Any]:
+        if path == "/1/clouddrive/share/sharepage/token":
+            share = self.shares.get(body.get("pwd_id"))
+            if share is None:
+                return self.error(41006, "分享不存在")
+            if share["passcode"] and body.get("passcode") != share["passcode"]:
+                return self.error(41008, "提取码错误")
+            stoken = secrets.token_urlsafe(24)
+            share["stokens"].add(stoken)
+            return self.ok({"stoken": stoken, "title": share["title"]})
+
+        if path == "/1/clouddrive/share/sharepage/detail":
+            share = self.shares.get(query.get("pwd_id"))
+            if share is None or query.get("stoken") not in share["stokens"]:
+                return self.error(41010, "stoken 无效")
+            pdir_fid = query.get("pdir_fid") or "0"
+            if pdir_fid == "0":
+                entries = [
+                    self._entry(self.nodes[f]) for f in share["fids"] if f in self.nodes
+                ]
+            else:
+                entries = self._listing(pdir_fid)
+            items, metadata = self.page(entries, query)
+            return self.ok(
+                {"is_owner": int(share["owner"]), "list": items}, metadata=metadata
+            )
+
+        if path == "/1/clouddrive/file/sort":
+            items, metadata = self.page(
+                self._listing(query.get("pdir_fid") or self.ROOT), query
+            )
+            return self.ok({"list": items}, metadata=metadata)
+
+        if path == "/account/info":
+            return {"success": True, "code": "OK", "data": {"nickname": "bench"}}
+
+        if path == "/1/clouddrive/file":
+            pdir_fid = body.get("pdir_fid") or self.ROOT
+            name = body.get("file_name") or "新建文件夹"
+            if any(
+                self.nodes[f]["file_name"] == name
+                for f in self.children.get(pdir_fid, [])
+            ):
+                return self.error(23008, "file is doloading[同名冲突]")
+            return self.ok({"fid": self.add_dir(name, pdir_fid), "finish": True})
+
+        if path == "/1/clouddrive/file/delete":
+            for fid in body.get("filelist") or []:
+                self._remove(fid)
+            return self.ok({"task_id": self._task("delete"), "finish": True})
+
+        if path == "/1/clouddrive/share/sharepage/save":
+            share = self.shares.get(body.get("pwd_id"))
+            if share is None or body.get("stoken") not in share["stokens"]:
+                return self.error(41010, "stoken 无效")
+            to_pdir_fid = body.get("to_pdir_fid") or self.ROOT
+            if to_pdir_fid not in self.nodes:
+                return self.error(41013, "目标文件夹不存在")
+            for fid in body.get("fid_list") or []:
+                if fid in self.nodes:
+                    self._copy(fid, to_pdir_fid)
+            task_id = self._task(
+                "save",
+                task_title="分享-转存",
+                save_as={
+                    "to_pdir_fid": to_pdir_fid,
+                    "to_pdir_name": self.nodes[to_pdir_fid]["file_name"],
+                },
+            )
+            return self.ok({"task_id": task_id})
+
+        if path == "/1/clouddrive/task":
+            task = self.tasks.get(query.get("task_id"))
+            if task is None:
+                return self.error(32001, "task not found", status=404)
+            if task["polls"] > 0:
+                task["polls"] -= 1
+                return self.ok({"task_id": query["task_id"], "status": 0})
+            data = {k: v for k, v in task.items() if k not in ("kind", "polls")}
+            return self.ok({"task_id": query["task_id"], "status": 2, **data})
+
+        if path == "/1/clouddrive/share":
+            fids = [f for f in body.get("fid_list") or [] if self._in_drive(f)]
+            if not fids:
+                return self.error(41011, "分享文件不存在")
+            url = self.add_share(
+                fids,
+                body.get("title", ""),
+                owner=True,
+                passcode=body.get("passcode", ""),
+            )
+            share = self.shares[self.get_pwd_id(url)]
+            return self.ok({"task_id": self._task("share", share_id=share["share_id"])})
+
+        if path == "/1/clouddrive/share/password":
+            for share in self.shares.values():
+                if share["share_id"] == body.get("share_id"):
+                    data = {
+                        "share_url": f"https://pan.quark.cn/s/{share['pwd_id']}",
+                        "title": share["title"],
+                    }
+                    if share["passcode"]:
+                        data["passcode"] = share["passcode"]
+                    return self.ok(data)
+            return self.error(41012, "分享不存在")
+
+        if path == "/1/clouddrive/share/delete":
+            share_ids = set(body.get("share_ids") or [])
+            for pwd_id in [
+                p for p, s in self.shares.items() if s["share_id"] in share_ids
+            ]:
+                del self.shares[pwd_id]
+            return self.ok()
+
+        if path == "/1/clouddrive/file/download":
+            data = []
+            for fid in body.get("fids") or []:
+                node = self.nodes.get(fid)
+                if node is None or node["dir"] or not self._in_drive(fid):
+                    continue
+                data.append(
+                    {
+                        **self._entry(node),
+                        "download_url": self.download_url(node),
+                        "md5": self.md5(node),
+                    }
+                )
+            return self.ok(data)
+
+        return self.error(404, f"unknown api {method} {path}", status=404)
+
+    @staticmethod
+    def get_pwd_id(share_url: str) -> str:
+        return share_url.split("?")[0].split("/s/")[-1]
+
+    # HTTP
+
+    async def _send(
+        self,
+        writer: asyncio.StreamWriter,
+        status: int,
+        body: bytes = b"",
+        headers: Union[dict[str, str], None] = None,
+        length: Union[int, None] = None,
+    ) -> None:
+        lines = [f"HTTP/1.1 {status} {REASONS.get(status, 'Unknown')}"]
+        headers = {
+            "Content-Length": str(len(body) if length is None else length),
+            "Connection": "keep-alive",
+            **(headers or {}),
+        }
+        lines += [f"{k}: {v}" for k, v in headers.items()]
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode() + body)
+        self.statuses[status] += 1
+        await writer.drain()
+
+    async def _send_json(
+        self, writer: asyncio.StreamWriter, payload: dict[str, Any], status: int = 200
+    ) -> None:
+        body = json.dumps(payload, ensure_ascii=False).encode()
+        await self._send(
+            writer, status, body, {"Content-Type": "application/json;charset=utf-8"}
+        )
+
+    def _over_rate(self, path: str) -> bool:
+        now = time.monotonic()
+        recent = self._recent[path]
+        while recent and recent[0] <= now - 1.0:
+            recent.popleft()
+        if len(recent) >= self.api_rate:
+            return True
+        recent.append(now)
+        return False
+
+    async def _handle_api(
+        self,
+        writer: asyncio.StreamWriter,
+        method: str,
+        path: str,
+        query: dict[str, str],
+        body: bytes,
+    ) -> None:
+        if self.api_latency:
+            await asyncio.sleep(self.api_latency)
+        if self.api_rate and self._over_rate(path):
+            payload = self.error(429, "请求过于频繁", 429)
+            body = json.dumps(payload, ensure_ascii=False).encode()
+            await self._send(writer, 429, body, {"Retry-After": "1"})
+            return
+        if self.failures.get(path):
+            failure = self.failures[path].pop(0)
+            headers = {}
+            if failure["retry_after"] is not None:
+                headers["Retry-After"] = str(failure["retry_after"])
+            payload = self.error(failure["code"], failure["message"], failure["status"])
+            if failure["status"] != 200:
+                body = json.dumps(payload, ensure_ascii=False).encode()
+                await self._send(writer, failure["status"], body, headers)
+            else:
+                await self._send_json(writer, payload)
+            return
+        try:
+            data = json.loads(body) if body else {}
+        except ValueError:
+            data = {}
+        await self._send_json(writer, self.api(method, path, query, data))
+
+    async def _handle_cdn(
+        self,
+        writer: asyncio.StreamWriter,
+        method: str,
+        path: str,
+        query: dict[str, str],
+        headers: dict[str, str],
+        received: float,
+    ) -> None:
+        if self.cdn_latency:
+            await asyncio.sleep(self.cdn_latency)
+        fid = path.split("/")[2]
+        node = self.nodes.get(fid)
+        if node is None or node["dir"]:
+            await self._send(writer, 404)
+            return
+        expires = int(query.get("expires") or 0)
+        if query.get("sign") != self._sign(fid, expires) or (
+            expires and expires < time.time()
+        ):
+            await self._send(writer, 403, b"expired")
+            return
+        if self.random.random() < self.error_rate:
+            await self._send(writer, 503, b"busy")
+            return
+
+        size = node["size"]
+        start, end, status = 0, size - 1, 200
+        content_range = None
+        requested = headers.get("range")
+        if requested and self.ranges:
+            parsed = parse_range(requested, size)
+            if parsed is None:
+                await self._send(
+                    writer, 416, headers={"Content-Range": f"bytes */{size}"}
+                )
+                return
+            start, end = parsed
+            status = 206
+            content_range = f"bytes {start}-{end}/{size}"
+        response_headers = {
+            "Content-Type": "application/octet-stream",
+            "Accept-Ranges": "bytes" if self.ranges else "none",
+        }
+        if content_range:
+            response_headers["Content-Range"] = content_range
+        length = end - start + 1
+        if method == "HEAD":
+            await self._send(writer, status, headers=response_headers, length=length)
+            return
+        await self._send(writer, status, headers=response_headers, length=length)
+
+        bandwidth = self.bandwidth
+        if self.random.random() < self.straggler_rate:
+            bandwidth = self.straggler_bandwidth
+        drop_at = (
+            start + int(length * self.random.random())
+            if self.random.random() < self.drop_rate
+            else None
+        )
+        self._limiter.configure(self.total_bandwidth)
+        started = time.monotonic()
+        sent = 0
+        pos = start
+        while pos <= end:
+            chunk_end = min(pos + CHUNK_SIZE - 1, end)
+            if drop_at is not None and chunk_end >= drop_at:
+                writer.write(self.read(node, pos, drop_at))
+                await writer.drain()
+                writer.transport.abort()
+                return
+            await self._limiter.consume(writer, chunk_end - pos + 1)
+            writer.write(self.read(node, pos, chunk_end))
+            await writer.drain()
+            sent += chunk_end - pos + 1
+            self.bytes_sent += chunk_end - pos + 1
+            pos = chunk_end + 1
+            if bandwidth:
+                ahead = sent / bandwidth - (time.monotonic() - started)
+                if ahead > 0:
+                    await asyncio.sleep(ahead)
+        self._limiter.forget(writer)
+        if status == 206:
+            self.segment_times.append(time.monotonic() - received)
+
+    async def _serve(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        self.connections += 1
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    return
+                received = time.monotonic()
+                method, target, _ = line.decode("latin-1").split(" ", 2)
+                headers: dict[str, str] = {}
+                while True:
+                    header = await reader.readline()
+                    if header in (b"\r\n", b"\n", b""):
+                        break
+                    key, _, value = header.decode("latin-1").partition(":")
+                    headers[key.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length") or 0))
+                parts = urlsplit(target)
+                query = dict(parse_qsl(parts.query))
+                if parts.path.startswith("/cdn/"):
+                    self.requests["/cdn"] += 1
+                    await self._handle_cdn(
+                        writer, method, parts.path, query, headers, received
+                    )
+                else:
+                    self.requests[parts.path] += 1
+                    await self._handle_api(writer, method, parts.path, query, body)
+                if headers.get("connection", "").lower() == "close":
+                    return
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        """Start listening on the running loop, returns the base URL."""
+        self._server = await asyncio.start_server(self._serve, host, port)
+        port = self._server.sockets[0].getsockname()[1]
+        self.base_url = f"http://{host}:{port}"
+        return self.base_url
+
+    def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        """Serve from a thread of its own, so the client's event loop isn't
+        also running the server. Returns the base URL."""
+        started = threading.Event()
+
+        def run() -> None:
+            self._loop = asyncio.new_event_loop()
+            self._loop.run_until_complete(self.serve(host, port))
+            started.set()
+            self._loop.run_forever()
+
+        self._thread = threading.Thread(target=run, daemon=True)
+        self._thread.start()
+        started.wait()
+        return self.base_url
+
+    def stop(self) -> None:
+        if self._loop is None:
+            return
+
+        async def close() -> None:
+            self._server.close()
+            await self._server.wait_closed()
+
+        asyncio.run_coroutine_threadsafe(close(), self._loop).result(5)
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(5)
+        self._loop = None
+
+    def summary(self) -> dict[str, Any]:
+        return {
+            "requests": dict(self.requests),
+            "statuses": dict(self.statuses),
+            "connections": self.connections,
+            "bytes_sent": self.bytes_sent,
+            "segments": len(self.segment_times),
+            "segment_p50": round(percentile(self.segment_times, 0.5), 4),
+            "segment_p99": round(percentile(self.segment_times, 0.99), 4),
+        }
+
+
+class LocalTransport(httpx.AsyncBaseTransport):
+    """Sends requests for the Quark API hosts to a FakeQuark, everything
+    else (the CDN URLs it hands out) goes through unchanged."""
+
+    def __init__(self, base_url: str, **options) -> None:
+        parts = urlsplit(base_url)
+        self.host = parts.hostname
+        self.port = parts.port
+        self.transport = httpx.AsyncHTTPTransport(**options)
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        if request.url.host in QUARK_HOSTS:
+            request.url = request.url.copy_with(
+                scheme="http", host=self.host, port=self.port
+            )
+        return await self.transport.handle_async_request(request)
+
+    async def aclose(self) -> None:
+        await self.transport.aclose()
+
+
+async def main() -> None:
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8765
+    server = FakeQuark()
+    base_url = await server.serve(port=port)
+    folder_fid, fids = server.populate(4, 64 * 1024 * 1024)
+    share_url = server.add_foreign_share(4, 16 * 1024 * 1024)
+    print(f"listening on {base_url}")
+    print(f"drive folder {folder_fid}: {', '.join(fids)}")
+    print(f"foreign share: {share_url}")
+    await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,1110 @@
+import asyncio
+import base64
+import binascii
+import hashlib
+import json
+import os
+import re
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Awaitable, Callable, Union
+
+
+class Segment:
+    """A byte range [start, end] of a file, ``pos`` is the next byte to write."""
+
+    def __init__(self, start: int, end: int) -> None:
+        self.start = start
+        self.end = end
+        self.pos = start
+        # md5 of start..pos-1 when the download is being verified
+        self.hasher = None
+        # Set when handed to a worker, for the straggler check
+        self.started: Union[float, None] = None
+        # Downloads this segment only, cancelled if its hedge twin wins
+        self.task: Union[asyncio.Task, None] = None
+        # The other side of a hedged pair, both fetch the same remainder
+        self.twin: Union["Segment", None] = None
+        self.hedge = False
+
+    @property
+    def remaining(self) -> int:
+        return max(self.end - self.pos + 1, 0)
+
+    @property
+    def done(self) -> bool:
+        return self.pos > self.end
+
+    def __repr__(self) -> str:
+        return f"Segment({self.start}-{self.end}, pos={self.pos})"
+
+
+class DownloadLink:
+    """Signed download URL of one file. The signature expires, so the URL
+    can be resolved again and all workers of the file pick up the new one."""
+
+    def __init__(
+        self, url: str, resolve: Union[Callable[[], Awaitable[str]], None] = None
+    ) -> None:
+        self.url = url
+        self.refreshes = 0
+        self._resolve = resolve
+        self._lock = asyncio.Lock()
+
+    async def refresh(self, stale_url: str) -> bool:
+        """Replace stale_url, True if a fresh URL is available."""
+        if self._resolve is None:
+            return False
+        async with self._lock:
+            # Several workers hit the expiry at once, only the first resolves
+            if self.url != stale_url:
+                return True
+            try:
+                self.url = await self._resolve()
+            except Exception:
+                return False
+            self.refreshes += 1
+            return True
+
+
+class SegmentScheduler:
+    """Hands out small segments to connection workers, idle workers steal
+    the unfinished half of the largest running segment.
+
+    Once nothing is left to hand out or steal, a segment running far
+    behind the typical segment time can be hedged: the rest of it is
+    queued again as a twin, whichever of the pair finishes first wins and
+    the other is abandoned."""
+
+    def __init__(
+        self,
+        file_size: int,
+        segment_size: int,
+        min_steal_size: int = 1024 * 1024,
+        ranges: Union[list[tuple[int, int]], None] = None,
+    ) -> None:
+        self.file_size = file_size
+        self.segment_size = max(segment_size, 1)
+        self.min_steal_size = max(min_steal_size, 1)
+        self.pending: deque[Segment] = deque()
+        self.active: set[Segment] = set()
+        # Hedge losers, recorded up to what they received like interrupted ones
+        self.abandoned: list[Segment] = []
+        self.steals = 0
+        self.hedges = 0
+        self.hedges_won = 0
+        self.hedged_bytes = 0
+        self.wasted_bytes = 0
+        # Throughput of recently finished segments, bytes per second
+        self.rates: deque[float] = deque(maxlen=32)
+        if ranges is None:
+            ranges = [(0, file_size - 1)]
+        for start, end in ranges:
+            self.add_range(start, end)
+
+    def add_range(self, start: int, end: int) -> None:
+        while start <= end:
+            stop = min(start + self.segment_size - 1, end)
+            self.pending.append(Segment(start, stop))
+            start = stop + 1
+
+    def next_segment(self) -> Union[Segment, None]:
+        if self.pending:
+            segment = self.pending.popleft()
+        else:
+            segment = self._steal()
+            if segment is None:
+                return None
+        self.active.add(segment)
+        segment.started = time.monotonic()
+        return segment
+
+    def _stealable(self) -> list[Segment]:
+        # A hedged pair must keep the same end, it can't be split
+        return [s for s in self.active if s.twin is None]
+
+    def _steal(self) -> Union[Segment, None]:
+        candidates = self._stealable()
+        if not candidates:
+            return None
+        victim = max(candidates, key=lambda s: s.remaining)
+        if victim.remaining < 2 * self.min_steal_size:
+            return None
+        # The victim keeps streaming the first half, its end is pulled in so
+        # it stops as soon as it reaches the split point
+        split = victim.pos + victim.remaining // 2
+        segment = Segment(split, victim.end)
+        victim.end = split - 1
+        self.steals += 1
+        return segment
+
+    def stragglers(self, threshold: float, budget: int) -> list[Segment]:
+        """Running segments taking over threshold times the typical time
+        for their size, as many as fit in budget bytes of duplicates."""
+        if len(self.rates) < 3 or self.has_work():
+            return []
+        rate = sorted(self.rates)[len(self.rates) // 2]
+        now = time.monotonic()
+        found = []
+        for segment in sorted(self.active, key=lambda s: s.started or now):
+            if segment.twin is not None or segment.done or segment.started is None:
+                continue
+            expected = (segment.end - segment.start + 1) / rate
+            if now - segment.started < threshold * expected:
+                continue
+            if self.hedged_bytes + segment.remaining > budget:
+                continue
+            found.append(segment)
+        return found
+
+    def hedge(self, segment: Segment) -> Segment:
+        """Queue a twin for the rest of segment, the next worker takes it."""
+        twin = Segment(segment.pos, segment.end)
+        twin.hedge = True
+        segment.twin, twin.twin = twin, segment
+        self.pending.appendleft(twin)
+        self.hedges += 1
+        self.hedged_bytes += twin.remaining
+        return twin
+
+    def finish(self, segment: Segment) -> Union[Segment, None]:
+        """Mark segment done, returns the twin it beat if it was hedged."""
+        self.active.discard(segment)
+        if segment.started is not None:
+            elapsed = time.monotonic() - segment.started
+            if elapsed > 0:
+                self.rates.append((segment.end - segment.start + 1) / elapsed)
+        loser = segment.twin
+        if loser is None:
+            return None
+        segment.twin = loser.twin = None
+        if segment.hedge:
+            self.hedges_won += 1
+        if loser in self.active:
+            self.active.discard(loser)
+            self.abandoned.append(loser)
+        else:
+            # Never picked up
+            try:
+                self.pending.remove(loser)
+            except ValueError:
+                pass
+        self.wasted_bytes += max(loser.pos - max(loser.start, segment.start), 0)
+        return loser
+
+    def release(self, segment: Segment) -> bool:
+        """Return the unfinished part of a failed segment to the queue.
+        False if a hedge twin still covers it and nothing was requeued."""
+        self.active.discard(segment)
+        twin = segment.twin
+        if twin is not None:
+            segment.twin = twin.twin = None
+            return False
+        if not segment.done:
+            self.pending.appendleft(Segment(segment.pos, segment.end))
+        return True
+
+    @property
+    def finished(self) -> bool:
+        return not self.pending and not self.active
+
+    def has_work(self) -> bool:
+        """Whether another worker could still get a segment."""
+        if self.pending:
+            return True
+        return any(s.remaining >= 2 * self.min_steal_size for s in self._stealable())
+
+
+class BufferPool:
+    """Reusable receive buffers of one size, shared by every WriteBuffer.
+
+    A buffer goes back to the pool once the writer thread has put it on
+    disk, so steady state downloading allocates nothing per buffer. At
+    most max_free idle buffers are kept."""
+
+    def __init__(self, size: int = 4 * 1024 * 1024, max_free: int = 32) -> None:
+        self.size = max(size, 1)
+        self.max_free = max_free
+        self._free: list[bytearray] = []
+        self.allocated = 0
+        self.reused = 0
+
+    def acquire(self) -> bytearray:
+        if self._free:
+            self.reused += 1
+            return self._free.pop()
+        self.allocated += 1
+        return bytearray(self.size)
+
+    def release(self, buffer: bytearray) -> None:
+        # A buffer grown past its size by an oversized chunk is not kept
+        if len(buffer) == self.size and len(self._free) < self.max_free:
+            self._free.append(buffer)
+
+
+class FileWriter:
+    """Positional writes to one file from a dedicated thread.
+
+    The event loop only hands over filled buffers, the syscalls run in the
+    writer thread in submission order. write() waits once more than
+    max_pending buffers are queued, which bounds memory when the disk is
+    slower than the network."""
+
+    def __init__(
+        self,
+        path: str,
+        buffer_size: int = 4 * 1024 * 1024,
+        max_pending: int = 16,
+        pool: Union[BufferPool, None] = None,
+    ) -> None:
+        self.path = path
+        self.buffer_size = max(buffer_size, 1)
+        self.max_pending = max(max_pending, 1)
+        # Slack above buffer_size so the chunk that fills a buffer still fits
+        self.pool = pool or BufferPool(self.buffer_size + 1024 * 1024)
+        self._fd = os.open(path, os.O_RDWR | getattr(os, "O_BINARY", 0))
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="writer")
+        self._pending: deque[asyncio.Future] = deque()
+        self.error: Union[BaseException, None] = None
+
+    def _on_done(self, future: asyncio.Future) -> None:
+        if not future.cancelled() and future.exception() and self.error is None:
+            self.error = future.exception()
+
+    def _write(
+        self, offset: int, data: Union[bytes, bytearray, memoryview], hasher=None
+    ) -> None:
+        view = memoryview(data)
+        while view:
+            if hasattr(os, "pwrite"):
+                written = os.pwrite(self._fd, view, offset)
+            else:
+                # No pwrite on Windows, a single writer thread keeps seek+write safe
+                os.lseek(self._fd, offset, os.SEEK_SET)
+                written = os.write(self._fd, view)
+            view = view[written:]
+            offset += written
+        # Hashed here rather than on the loop, in the order the stream arrived
+        if hasher is not None:
+            hasher.update(data)
+
+    def submit(
+        self,
+        offset: int,
+        data: Union[bytes, bytearray, memoryview],
+        hasher=None,
+        written: Union[Callable[[], None], None] = None,
+    ) -> asyncio.Future:
+        """Queue a write without waiting, data must not be modified afterwards.
+
+        written is called on the loop once the writer thread is done with
+        data. Unlike the returned future, which resolves as soon as it is
+        cancelled, it waits for a write already running."""
+        loop = asyncio.get_running_loop()
+        work = self._executor.submit(self._write, offset, data, hasher)
+        if written is not None:
+
+            def done(_: Future) -> None:
+                try:
+                    loop.call_soon_threadsafe(written)
+                except RuntimeError:
+                    # The loop is gone, and with it whoever wanted the data
+                    pass
+
+            work.add_done_callback(done)
+        future = asyncio.wrap_future(work, loop=loop)
+        future.add_done_callback(self._on_done)
+        self._pending.append(future)
+        return future
+
+    async def write(
+        self,
+        offset: int,
+        data: Union[bytes, bytearray, memoryview],
+        hasher=None,
+        written: Union[Callable[[], None], None] = None,
+    ) -> asyncio.Future:
+        """Queue a write, the returned future resolves once it is on disk."""
+        future = self.submit(offset, data, hasher, written)
+        while self._pending and self._pending[0].done():
+            self._pending.popleft().result()
+        while len(self._pending) > self.max_pending:
+            await self._wait_oldest()
+        return future
+
+    async def _wait_oldest(self) -> None:
+        """Wait for the oldest queued write. It stays queued until it is done,
+        so a waiter that gets cancelled can't cancel another worker's write."""
+        oldest = self._pending[0]
+        try:
+            await asyncio.shield(oldest)
+        except asyncio.CancelledError:
+            # A write cancelled on its own is skipped, only the waiter being
+            # cancelled stops here
+            if not oldest.cancelled():
+                raise
+        finally:
+            if oldest.done() and self._pending and self._pending[0] is oldest:
+                self._pending.popleft()
+
+    async def drain(self) -> None:
+        while self._pending:
+            await self._wait_oldest()
+
+    async def close(self) -> None:
+        try:
+            await self.drain()
+        finally:
+            # Queued behind any write still running, the thread exits after it
+            self._executor.submit(os.close, self._fd)
+            self._executor.shutdown(wait=False)
+
+
+class WriteBuffer:
+    """Collects the chunks of one contiguous stream into writer sized
+    buffers, offset is where the next buffer goes. With a hasher every
+    buffer is also fed to it once written.
+
+    Chunks are copied into a buffer from the writer's pool, which the
+    writer thread reads through a memoryview and which returns to the
+    pool once written."""
+
+    def __init__(self, writer: FileWriter, offset: int, hasher=None) -> None:
+        self.writer = writer
+        self.offset = offset
+        self.hasher = hasher
+        self.data: Union[bytearray, None] = None
+        self.size = 0
+        self._last: Union[asyncio.Future, None] = None
+
+    def append(self, chunk: Union[bytes, memoryview]) -> None:
+        if self.data is None:
+            self.data = self.writer.pool.acquire()
+        end = self.size + len(chunk)
+        # In place while it fits, a slice assignment past the end grows it
+        self.data[self.size : end] = chunk
+        self.size = end
+
+    @property
+    def full(self) -> bool:
+        return self.size >= self.writer.buffer_size
+
+    def _take(self) -> tuple[int, bytearray, memoryview]:
+        offset, data = self.offset, self.data
+        view = memoryview(data)[: self.size]
+        self.offset += self.size
+        self.data = None
+        self.size = 0
+        return offset, data, view
+
+    def _recycle(self, data: bytearray, view: memoryview) -> Callable[[], None]:
+        # Only once the writer thread let go of the view, a cancelled write
+        # may still be running
+        def written() -> None:
+            view.release()
+            self.writer.pool.release(data)
+
+        return written
+
+    async def flush(self) -> int:
+        """Hand the buffered bytes to the writer, returns how many."""
+        if not self.size:
+            return 0
+        size = self.size
+        offset, data, view = self._take()
+        self._last = await self.writer.write(
+            offset, view, self.hasher, self._recycle(data, view)
+        )
+        return size
+
+    def flush_nowait(self) -> int:
+        """Like flush but never waits, for cancellation paths."""
+        if not self.size:
+            return 0
+        size = self.size
+        offset, data, view = self._take()
+        self._last = self.writer.submit(
+            offset, view, self.hasher, self._recycle(data, view)
+        )
+        return size
+
+    async def wait(self) -> None:
+        """Wait until everything flushed so far is on disk."""
+        if self._last is not None:
+            # Writes run in order, the last one done means all are
+            await asyncio.shield(self._last)
+        if self.writer.error:
+            raise self.writer.error
+
+
+class DownloadManifest:
+    """Sidecar file recording which byte ranges of a download are on disk."""
+
+    SUFFIX = ".part.json"
+    # checkpoint() writes at most this often, save() at once
+    CHECKPOINT_INTERVAL = 1.0
+
+    def __init__(
+        self,
+        save_path: str,
+        fid: Union[str, None],
+        size: int,
+        updated_at: Union[int, str, None] = None,
+        completed: Union[list[list[int]], None] = None,
+        digests: Union[dict[str, str], None] = None,
+    ) -> None:
+        self.save_path = save_path
+        self.path = save_path + self.SUFFIX
+        self.fid = fid
+        self.size = size
+        self.updated_at = updated_at
+        self.completed: list[list[int]] = completed or []
+        # "start-end" -> md5 of that range as it was received
+        self.digests: dict[str, str] = digests or {}
+        self._saved = 0.0
+
+    @classmethod
+    def load(
+        cls,
+        save_path: str,
+        fid: Union[str, None],
+        size: int,
+        updated_at: Union[int, str, None] = None,
+    ) -> Union["DownloadManifest", None]:
+        """Load the manifest of save_path, None if missing or stale."""
+        try:
+            with open(save_path + cls.SUFFIX, "r", encoding="utf-8") as f:
+                data: dict[str, Any] = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        if data.get("size") != size:
+            return None
+        # Only compare what both sides know, a missing value can't prove staleness
+        if fid and data.get("fid") and data["fid"] != fid:
+            return None
+        if updated_at and data.get("updated_at") and data["updated_at"] != updated_at:
+            return None
+        try:
+            if os.path.getsize(save_path) != size:
+                return None
+        except OSError:
+            return None
+        return cls(
+            save_path,
+            fid,
+            size,
+            updated_at,
+            data.get("completed", []),
+            data.get("digests", {}),
+        )
+
+    def mark(self, start: int, end: int, digest: Union[str, None] = None) -> None:
+        if end < start:
+            return
+        if digest:
+            self.digests[f"{start}-{end}"] = digest
+        ranges = sorted(self.completed + [[start, end]])
+        merged: list[list[int]] = []
+        for r_start, r_end in ranges:
+            if merged and r_start <= merged[-1][1] + 1:
+                merged[-1][1] = max(merged[-1][1], r_end)
+            else:
+                merged.append([r_start, r_end])
+        self.completed = merged
+
+    def discard(self, start: int, end: int) -> None:
+        """Forget a range, e.g. one that failed verification."""
+        self.digests.pop(f"{start}-{end}", None)
+        remaining: list[list[int]] = []
+        for r_start, r_end in self.completed:
+            if r_end < start or r_start > end:
+                remaining.append([r_start, r_end])
+                continue
+            if r_start < start:
+                remaining.append([r_start, start - 1])
+            if r_end > end:
+                remaining.append([end + 1, r_end])
+        self.completed = remaining
+
+    def digest_ranges(self) -> list[tuple[int, int, str]]:
+        ranges = []
+        for key, digest in self.digests.items():
+            start, end = key.split("-")
+            ranges.append((int(start), int(end), digest))
+        return sorted(ranges)
+
+    @property
+    def completed_bytes(self) -> int:
+        return sum(end - start + 1 for start, end in self.completed)
+
+    def missing_ranges(self) -> list[tuple[int, int]]:
+        missing = []
+        pos = 0
+        for start, end in self.completed:
+            if start > pos:
+                missing.append((pos, start - 1))
+            pos = max(pos, end + 1)
+        if pos < self.size:
+            missing.append((pos, self.size - 1))
+        return missing
+
+    def checkpoint(self) -> None:
+        """Save, unless the last save was under CHECKPOINT_INTERVAL ago.
+        Each save rewrites the whole file, per segment it would stall the
+        event loop. A skipped one only lags behind the disk, the final
+        save() catches up."""
+        if time.monotonic() - self._saved >= self.CHECKPOINT_INTERVAL:
+            self.save()
+
+    def save(self) -> None:
+        data = {
+            "fid": self.fid,
+            "size": self.size,
+            "updated_at": self.updated_at,
+            "completed": self.completed,
+            "digests": self.digests,
+        }
+        # Write then rename so a crash never leaves a half written manifest
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, self.path)
+        self._saved = time.monotonic()
+
+    def remove(self) -> None:
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class RangeNotSupported(Exception):
+    """The server answered a Range request with the whole file."""
+
+
+def parse_content_range(
+    value: Union[str, None],
+) -> Union[tuple[int, int, Union[int, None]], None]:
+    """(start, end, total) of a "bytes start-end/total" header, total None for *."""
+    match = re.match(r"bytes (\d+)-(\d+)/(\d+|\*)", (value or "").strip())
+    if not match:
+        return None
+    total = None if match.group(3) == "*" else int(match.group(3))
+    return int(match.group(1)), int(match.group(2)), total
+
+
+def normalize_md5(value: Any) -> Union[str, None]:
+    """Hex md5 from an API field, which may be hex or base64 encoded."""
+    if not value or not isinstance(value, str):
+        return None
+    value = value.strip()
+    if len(value) == 32:
+        try:
+            bytes.fromhex(value)
+            return value.lower()
+        except ValueError:
+            return None
+    try:
+        raw = base64.b64decode(value, validate=True)
+    except (binascii.Error, ValueError):
+        return None
+    return raw.hex() if len(raw) == 16 else None
+
+
+def verify_file(
+    path: str,
+    size: int,
+    digests: list[tuple[int, int, str]],
+    block_size: int = 8 * 1024 * 1024,
+) -> tuple[str, list[tuple[int, int]], list[tuple[int, int]]]:
+    """Read the file once, blocking, meant for a worker thread.
+
+    Returns the md5 of the whole file, the digested ranges whose bytes on
+    disk no longer match what was received, and the ranges not covered by
+    any digest."""
+    whole = hashlib.md5()
+    mismatched = []
+    undigested = []
+    with open(path, "rb") as f:
+
+        def feed(start: int, end: int, hasher=None) -> None:
+            f.seek(start)
+            left = end - start + 1
+            while left > 0:
+                data = f.read(min(block_size, left))
+                if not data:
+                    raise OSError(f"unexpected end of file at {end - left + 1}")
+                whole.update(data)
+                if hasher is not None:
+                    hasher.update(data)
+                left -= len(data)
+
+        pos = 0
+        for start, end, digest in digests:
+            if start < pos or end >= size:
+                continue
+            if start > pos:
+                undigested.append((pos, start - 1))
+                feed(pos, start - 1)
+            hasher = hashlib.md5()
+            feed(start, end, hasher)
+            if hasher.hexdigest() != digest:
+                mismatched.append((start, end))
+            pos = end + 1
+        if pos < size:
+            undigested.append((pos, size - 1))
+            feed(pos, size - 1)
+    return whole.hexdigest(), mismatched, undigested
+
+
+class ConnectionBudget:
+    """Global cap on open download connections, shared fairly by all files.
+
+    Each registered job is entitled to its weighted share of the limit.
+    A job may borrow beyond its share only while no other job below its
+    own share is waiting, so the budget stays fully used but never starves
+    a newcomer."""
+
+    def __init__(self, limit: int = 16) -> None:
+        self.limit = max(limit, 1)
+        self.in_use = 0
+        self._held: dict[Any, int] = {}
+        self._waiting: dict[Any, int] = {}
+        self._weights: dict[Any, float] = {}
+        self._waiters: list[asyncio.Future] = []
+
+    def _wake(self) -> None:
+        # Every waiter re-checks its own condition, the set is small
+        for waiter in self._waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+        self._waiters.clear()
+
+    def register(self, job: Any, weight: float = 1.0) -> None:
+        self._weights[job] = weight if weight > 0 else 1.0
+        self._held.setdefault(job, 0)
+        self._waiting.setdefault(job, 0)
+        self._wake()
+
+    def unregister(self, job: Any) -> None:
+        self._weights.pop(job, None)
+        if not self._held.get(job):
+            self._held.pop(job, None)
+        if not self._waiting.get(job):
+            self._waiting.pop(job, None)
+        self._wake()
+
+    def fair_share(self, job: Any) -> int:
+        total = sum(self._weights.values()) or 1.0
+        weight = self._weights.get(job, 1.0)
+        return max(1, int(self.limit * weight / total))
+
+    def _can_acquire(self, job: Any) -> bool:
+        if self.in_use >= self.limit:
+            return False
+        if self._held.get(job, 0) < self.fair_share(job):
+            return True
+        return not any(
+            count and self._held.get(other, 0) < self.fair_share(other)
+            for other, count in self._waiting.items()
+            if other is not job
+        )
+
+    async def acquire(self, job: Any) -> None:
+        self._waiting[job] = self._waiting.get(job, 0) + 1
+        try:
+            while not self._can_acquire(job):
+                waiter = asyncio.get_running_loop().create_future()
+                self._waiters.append(waiter)
+                await waiter
+        except BaseException:
+            # Others may have been held back on this job's behalf
+            self._waiting[job] -= 1
+            self._wake()
+            raise
+        self._waiting[job] -= 1
+        self._held[job] = self._held.get(job, 0) + 1
+        self.in_use += 1
+
+    def release(self, job: Any) -> None:
+        self._held[job] -= 1
+        self.in_use -= 1
+        self._wake()
+
+    @asynccontextmanager
+    async def slot(self, job: Any) -> AsyncIterator[None]:
+        await self.acquire(job)
+        try:
+            yield
+        finally:
+            self.release(job)
+
+
+class SchedulePolicy:
+    """Listing order, every file gets an equal share of the connections.
+
+    A policy ranks the files waiting to start, lower priority first, and
+    weights each file's share of the ConnectionBudget. Sizes are the ones
+    the listing returned, 0 when unknown."""
+
+    name = "fifo"
+
+    def priority(self, size: int) -> float:
+        return 0.0
+
+    def weight(self, remaining: int) -> float:
+        return 1.0
+
+
+class LargestFirst(SchedulePolicy):
+    """Big files start first, small ones fill the gaps at the end instead
+    of a big file downloading alone."""
+
+    name = "largest"
+
+    def priority(self, size: int) -> float:
+        return -size
+
+
+class SmallestFirst(SchedulePolicy):
+    """Most files done soonest, at the cost of a long tail."""
+
+    name = "smallest"
+
+    def priority(self, size: int) -> float:
+        return size
+
+
+class SizeBalanced(LargestFirst):
+    """Largest first, and connections split in proportion to the bytes
+    each file has left, so files running together finish together."""
+
+    name = "balanced"
+
+    def weight(self, remaining: int) -> float:
+        return max(remaining / (1024 * 1024), 1.0)
+
+
+SCHEDULE_POLICIES: dict[str, type[SchedulePolicy]] = {
+    policy.name: policy
+    for policy in (SchedulePolicy, LargestFirst, SmallestFirst, SizeBalanced)
+}
+
+
+def get_schedule_policy(name: str) -> SchedulePolicy:
+    try:
+        return SCHEDULE_POLICIES[name]()
+    except KeyError:
+        raise ValueError(
+            f"未知的调度策略: {name}，可选 {', '.join(SCHEDULE_POLICIES)}"
+        ) from None
+
+
+def parse_rate(value: Union[int, float, str, None]) -> float:
+    """Bytes per second from a config value. Plain numbers are MB/s like
+    the other sizes in config.json, strings may carry a KB/MB/GB unit and
+    an optional "/s". 0 or empty means unlimited."""
+    if not value:
+        return 0.0
+    if isinstance(value, (int, float)):
+        return float(value) * 1024 * 1024
+    match = re.match(r"^(\d+(?:\.\d+)?)\s*([KMG]?)B?(?:/S)?$", value.strip().upper())
+    if not match:
+        raise ValueError(f"无效的限速值: {value}")
+    units = {"": 1024**2, "K": 1024, "M": 1024**2, "G": 1024**3}
+    return float(match.group(1)) * units[match.group(2)]
+
+
+def parse_schedule(
+    entries: Union[list[dict[str, Any]], None],
+) -> list[tuple[int, int, float]]:
+    """(start, end, rate) windows from [{"start": "HH:MM", "end": "HH:MM",
+    "limit": ...}], start and end in minutes of the day."""
+
+    def minutes(value: str) -> int:
+        hours, _, mins = value.strip().partition(":")
+        return int(hours) * 60 + int(mins or 0)
+
+    return [
+        (minutes(e["start"]), minutes(e["end"]), parse_rate(e.get("limit")))
+        for e in entries or []
+    ]
+
+
+class BandwidthLimiter:
+    """Token bucket shared by every download coroutine.
+
+    rate is in bytes per second, 0 means unlimited, and the bucket holds
+    burst seconds worth of tokens. Tokens go to the waiting job that has
+    been served the fewest bytes, so a file with many connections gets no
+    more than one with a single connection. A schedule window overrides
+    the rate while the local time is inside it, a window may wrap past
+    midnight."""
+
+    def __init__(
+        self,
+        rate: float = 0.0,
+        schedule: Union[list[tuple[int, int, float]], None] = None,
+        burst: float = 1.0,
+    ) -> None:
+        self.base_rate = rate
+        self.schedule = schedule or []
+        self.burst = burst
+        self._rate = rate
+        self._rate_checked = 0.0
+        self._tokens: Union[float, None] = None
+        self._updated = time.monotonic()
+        self._queues: dict[Any, deque[tuple[int, asyncio.Future]]] = {}
+        self._served: dict[Any, float] = {}
+        self._dispatcher: Union[asyncio.Task, None] = None
+
+    def configure(
+        self,
+        rate: Union[float, None] = None,
+        schedule: Union[list[tuple[int, int, float]], None] = None,
+    ) -> None:
+        """Change the limits, running transfers pick them up within a second."""
+        if rate is not None:
+            self.base_rate = rate
+        if schedule is not None:
+            self.schedule = schedule
+        self._rate_checked = 0.0
+
+    @property
+    def rate(self) -> float:
+        now = time.monotonic()
+        if now - self._rate_checked >= 1.0:
+            self._rate_checked = now
+            self._rate = self.base_rate
+            local = time.localtime()
+            minute = local.tm_hour * 60 + local.tm_min
+            for start, end, rate in self.schedule:
+                inside = (
+                    start <= minute < end
+                    if start <= end
+                    else minute >= start or minute < end
+                )
+                if inside:
+                    self._rate = rate
+                    break
+        return self._rate
+
+    def _refill(self, rate: float) -> float:
+        """Top up the bucket, returns its capacity."""
+        now = time.monotonic()
+        capacity = rate * self.burst
+        if self._tokens is None:
+            self._tokens = capacity
+        else:
+            self._tokens = min(self._tokens + (now - self._updated) * rate, capacity)
+        self._updated = now
+        return capacity
+
+    def forget(self, job: Any) -> None:
+        """Drop the accounting of a finished job."""
+        self._served.pop(job, None)
+        # Waiters cancelled with the job would otherwise linger until the
+        # dispatcher gets to them
+        queue = self._queues.get(job)
+        if queue is not None and all(future.done() for _, future in queue):
+            del self._queues[job]
+
+    async def consume(self, job: Any, n: int) -> None:
+        rate = self.rate
+        if rate <= 0:
+            return
+        if job not in self._served:
+            # A newcomer starts level with the others instead of at zero,
+            # which would let it take everything until it caught up
+            self._served[job] = min(
+                (
+                    self._served[other]
+                    for other in self._queues
+                    if other in self._served
+                ),
+                default=0.0,
+            )
+        capacity = self._refill(rate)
+        # A chunk larger than the bucket goes through once it is full and
+        # leaves the bucket in debt
+        if not self._queues and self._tokens >= min(n, capacity):
+            self._tokens -= n
+            self._served[job] += n
+            return
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._queues.setdefault(job, deque()).append((n, future))
+        if (
+            self._dispatcher is None
+            or self._dispatcher.done()
+            or self._dispatcher.get_loop() is not loop
+        ):
+            self._dispatcher = loop.create_task(self._dispatch())
+        # A cancelled waiter is skipped by the dispatcher
+        await future
+
+    async def _dispatch(self) -> None:
+        while self._queues:
+            for job in list(self._queues):
+                queue = self._queues[job]
+                while queue and queue[0][1].done():
+                    queue.popleft()
+                if not queue:
+                    del self._queues[job]
+            if not self._queues:
+                return
+
+            rate = self.rate
+            if rate <= 0:
+                # Limit lifted, let everyone through
+                for queue in self._queues.values():
+                    for _, future in queue:
+                        future.set_result(None)
+                self._queues.clear()
+                return
+
+            job = min(self._queues, key=lambda j: self._served.get(j, 0.0))
+            queue = self._queues[job]
+            n, future = queue[0]
+            need = min(n, self._refill(rate))
+            if self._tokens >= need:
+                self._tokens -= n
+                self._served[job] = self._served.get(job, 0.0) + n
+                queue.popleft()
+                future.set_result(None)
+                if not queue:
+                    del self._queues[job]
+                # Let the granted connection come back in line
+                await asyncio.sleep(0)
+            else:
+                # Short sleeps so a changed rate applies promptly
+                await asyncio.sleep(min((need - self._tokens) / rate, 0.25))
+
+
+class HostProfile:
+    """Per-host values remembered between runs, e.g. the connection count
+    the tuner settled on. Stored as JSON, each value with its timestamp."""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                self.hosts: dict[str, dict[str, Any]] = json.load(f)
+        except (OSError, ValueError):
+            self.hosts = {}
+
+    def get(
+        self, host: str, key: str, default: Any = None, ttl: Union[float, None] = None
+    ) -> Any:
+        entry = self.hosts.get(host, {}).get(key)
+        if not isinstance(entry, dict):
+            return default
+        if ttl is not None and time.time() - entry.get("updated", 0) > ttl:
+            return default
+        return entry.get("value", default)
+
+    def set(self, host: str, key: str, value: Any) -> None:
+        self.hosts.setdefault(host, {})[key] = {
+            "value": value,
+            "updated": int(time.time()),
+        }
+        self.save()
+
+    def save(self) -> None:
+        tmp_path = self.path + ".tmp"
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self.hosts, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+        except OSError:
+            pass
+
+
+class ConnectionTuner:
+    """AIMD controller for the number of connections of one download.
+
+    Every interval the aggregate rate is measured. After adding a
+    connection another one is added if the rate rose by more than
+    threshold, otherwise the extra one is removed again and the level is
+    held, re-probing every probe_every intervals. Throttling responses
+    (403/429/5xx) halve the level."""
+
+    THROTTLE_STATUS = (403, 429)
+
+    def __init__(
+        self,
+        initial: int,
+        maximum: int,
+        interval: float = 1.0,
+        threshold: float = 0.1,
+        probe_every: int = 5,
+    ) -> None:
+        self.maximum = max(maximum, 1)
+        self.target = min(max(initial, 1), self.maximum)
+        self.interval = interval
+        self.threshold = threshold
+        self.probe_every = probe_every
+        self.running = 0
+        self.bytes = 0
+        self.rate = 0.0
+        self._last_rate: Union[float, None] = None
+        self._last_bytes = 0
+        self._last_time: Union[float, None] = None
+        self._probing = False
+        self._steady = 0
+        self._last_decrease = 0.0
+
+    def record(self, n: int) -> None:
+        self.bytes += n
+
+    def should_retire(self) -> bool:
+        return self.running > self.target
+
+    def _increase(self) -> None:
+        if self.target < self.maximum:
+            self.target += 1
+            self._probing = True
+        self._steady = 0
+
+    def sample(self) -> None:
+        now = time.monotonic()
+        if self._last_time is None:
+            self._last_time, self._last_bytes = now, self.bytes
+            return
+        elapsed = now - self._last_time
+        if elapsed < self.interval:
+            return
+        self.rate = (self.bytes - self._last_bytes) / elapsed
+        self._last_time, self._last_bytes = now, self.bytes
+        last_rate, self._last_rate = self._last_rate, self.rate
+
+        if last_rate is None:
+            self._increase()
+        elif self._probing:
+            self._probing = False
+            if self.rate > last_rate * (1 + self.threshold):
+                self._increase()
+            else:
+                # The extra connection didn't pay off, give it back
+                self.target = max(1, self.target - 1)
+        else:
+            self._steady += 1
+            if self._steady >= self.probe_every:
+                self._increase()
+
+    def on_status(self, status_code: int) -> None:
+        if status_code not in self.THROTTLE_STATUS and status_code < 500:
+            return
+        now = time.monotonic()
+        # One halving per interval, a burst of errors is a single signal
+        if now - self._last_decrease < self.interval:
+            return
+        self._last_decrease = now
+        self.target = max(1, self.target // 2)
+        self._probing = False
+        self._steady = 0
@@ -0,0 +1,184 @@
+import asyncio
+import ipaddress
+import socket
+import time
+from typing import Any, Union
+from urllib.parse import urlsplit, urlunsplit
+
+import httpx
+
+from downloader import HostProfile
+from http_session import HttpSession
+from utils import custom_print
+
+
+class HostSelector:
+    """Picks the CDN addresses segment traffic goes to.
+
+    The candidates of a download host are the addresses its name resolves
+    to plus any configured alternate host names. Each one is probed with a
+    small Range request, ranked by throughput and then latency, and the
+    ranking is kept in the HostProfile for ttl seconds. Requests rotate
+    over the candidates close to the best one; an address that fails is
+    dropped for the rest of the run."""
+
+    def __init__(
+        self,
+        session: HttpSession,
+        profile: HostProfile,
+        ttl: float = 3600.0,
+        probe_bytes: int = 256 * 1024,
+        probe_timeout: float = 5.0,
+        max_candidates: int = 8,
+        keep_ratio: float = 0.7,
+    ) -> None:
+        self.session = session
+        self.profile = profile
+        self.enabled = True
+        self.ttl = ttl
+        self.probe_bytes = probe_bytes
+        self.probe_timeout = probe_timeout
+        self.max_candidates = max_candidates
+        self.keep_ratio = keep_ratio
+        # host -> alternate host names serving the same paths
+        self.alternates: dict[str, list[str]] = {}
+        self.routes: dict[str, list[dict[str, Any]]] = {}
+        self._turn: dict[str, int] = {}
+        self._locks: dict[str, asyncio.Lock] = {}
+
+    @staticmethod
+    def _is_ip(value: str) -> bool:
+        try:
+            ipaddress.ip_address(value)
+            return True
+        except ValueError:
+            return False
+
+    async def _candidates(self, host: str, port: int) -> list[str]:
+        try:
+            infos = await asyncio.get_running_loop().getaddrinfo(
+                host, port, type=socket.SOCK_STREAM
+            )
+        except OSError:
+            infos = []
+        targets = []
+        for info in infos:
+            address = info[4][0]
+            if address not in targets:
+                targets.append(address)
+        targets = targets[: self.max_candidates]
+        for alternate in self.alternates.get(host, []):
+            if alternate not in targets:
+                targets.append(alternate)
+        return targets
+
+    def _target_url(
+        self, parts, target: str
+    ) -> tuple[str, dict[str, str], dict[str, Any]]:
+        if not self._is_ip(target):
+            netloc = target if parts.port is None else f"{target}:{parts.port}"
+            return urlunsplit(parts._replace(netloc=netloc)), {}, {}
+        address = f"[{target}]" if ":" in target else target
+        netloc = address if parts.port is None else f"{address}:{parts.port}"
+        # Same server name and certificate, only the address is pinned
+        return (
+            urlunsplit(parts._replace(netloc=netloc)),
+            {"Host": parts.netloc},
+            {"sni_hostname": parts.hostname},
+        )
+
+    async def _probe(
+        self, parts, target: str, headers: dict
+    ) -> Union[dict[str, Any], None]:
+        url, extra_headers, extensions = self._target_url(parts, target)
+        probe_headers = {
+            **headers,
+            **extra_headers,
+            "Range": f"bytes=0-{self.probe_bytes - 1}",
+        }
+        received = 0
+        started = time.monotonic()
+        try:
+            async with self.session.stream(
+                "GET",
+                url,
+                headers=probe_headers,
+                timeout=self.probe_timeout,
+                extensions=extensions,
+            ) as response:
+                if response.status_code not in (200, 206):
+                    return None
+                latency = time.monotonic() - started
+                async for chunk in response.aiter_bytes():
+                    received += len(chunk)
+                    if received >= self.probe_bytes:
+                        break
+        except httpx.HTTPError:
+            return None
+        elapsed = max(time.monotonic() - started, 1e-6)
+        return {
+            "target": target,
+            "rate": round(received / elapsed),
+            "latency": round(latency, 4),
+        }
+
+    def _keep(self, ranked: list[dict[str, Any]]) -> list[dict[str, Any]]:
+        if not ranked:
+            return []
+        best = ranked[0]["rate"]
+        return [r for r in ranked if r["rate"] >= best * self.keep_ratio]
+
+    async def prepare(self, url: str, headers: dict) -> None:
+        """Rank the candidates of url's host, from the profile when fresh."""
+        parts = urlsplit(url)
+        host = parts.hostname
+        if not self.enabled or not host or self._is_ip(host) or host in self.routes:
+            return
+        lock = self._locks.setdefault(host, asyncio.Lock())
+        async with lock:
+            # Files starting together share one probe
+            if host in self.routes:
+                return
+            ranked = self.profile.get(host, "routes", ttl=self.ttl)
+            if ranked is None:
+                targets = await self._candidates(
+                    host, parts.port or (443 if parts.scheme == "https" else 80)
+                )
+                if len(targets) < 2:
+                    # Nothing to choose from, normal resolution is as good
+                    self.routes[host] = []
+                    return
+                results = await asyncio.gather(
+                    *(self._probe(parts, target, headers) for target in targets)
+                )
+                ranked = sorted(
+                    (r for r in results if r),
+                    key=lambda r: (-r["rate"], r["latency"]),
+                )
+                self.profile.set(host, "routes", ranked)
+                if ranked:
+                    custom_print(
+                        f"CDN 节点测速: {host}, {len(ranked)}/{len(targets)} 个可用，最快 "
+                        f"{ranked[0]['target']} {ranked[0]['rate'] / 1024 / 1024:.2f} MB/s"
+                    )
+            self.routes[host] = self._keep(ranked)
+
+    def rewrite(self, url: str) -> tuple[str, dict[str, str], dict[str, Any]]:
+        """The URL, extra headers and request extensions to fetch url through
+        the next of its host's best candidates, url itself if none."""
+        parts = urlsplit(url)
+        routes = self.routes.get(parts.hostname or "")
+        if not routes:
+            return url, {}, {}
+        turn = self._turn.get(parts.hostname, 0)
+        self._turn[parts.hostname] = turn + 1
+        return self._target_url(parts, routes[turn % len(routes)]["target"])
+
+    def demote(self, url: str, request_url: str) -> None:
+        """Stop using the candidate request_url went to, after it failed."""
+        host = urlsplit(url).hostname
+        target = urlsplit(request_url).hostname
+        routes = self.routes.get(host or "")
+        if not routes or target == host:
+            return
+        self.routes[host] = [r for r in routes if r["target"] != target]
@@ -0,0 +1,172 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Union
+from urllib.parse import urlsplit
+
+import httpx
+
+from metrics import Metrics
+from rate_limit import RateLimiter
+from utils import custom_print
+
+
+class HttpSession:
+    """Long-lived, pooled httpx client shared by every request of a manager."""
+
+    def __init__(
+        self,
+        max_connections: int = 64,
+        max_keepalive_connections: int = 32,
+        max_host_connections: int = 16,
+        keepalive_expiry: float = 30.0,
+        http2: bool = False,
+        timeout: float = 60.0,
+        verify: bool = False,
+        transport: Union[httpx.AsyncBaseTransport, None] = None,
+        metrics: Union[Metrics, None] = None,
+        limiter: Union[RateLimiter, None] = None,
+    ) -> None:
+        self.max_connections = max_connections
+        self.max_keepalive_connections = max_keepalive_connections
+        self.max_host_connections = max_host_connections
+        self.keepalive_expiry = keepalive_expiry
+        self.http2 = http2
+        self.timeout = timeout
+        self.verify = verify
+        self.transport = transport
+        # Records every request, by endpoint
+        self.metrics = metrics
+        # Paces the API requests, downloads aren't affected
+        self.limiter = limiter
+        self._client: Union[httpx.AsyncClient, None] = None
+        self._loop: Union[asyncio.AbstractEventLoop, None] = None
+        self._host_slots: dict[str, asyncio.Semaphore] = {}
+        self._stale = False
+
+    def configure(self, **options) -> None:
+        for key, value in options.items():
+            if not hasattr(self, key) or key.startswith("_"):
+                raise AttributeError(f"Unknown session option: {key}")
+            if getattr(self, key) != value:
+                setattr(self, key, value)
+                # Applied lazily, the current pool is replaced on next use
+                self._stale = True
+
+    def _build_client(self) -> httpx.AsyncClient:
+        http2 = self.http2
+        if http2:
+            try:
+                import h2  # noqa: F401
+            except ImportError:
+                custom_print("未安装 h2 模块，HTTP/2 已禁用 (pip install httpx[http2])")
+                http2 = self.http2 = False
+
+        limits = httpx.Limits(
+            max_connections=self.max_connections,
+            max_keepalive_connections=self.max_keepalive_connections,
+            keepalive_expiry=self.keepalive_expiry,
+        )
+        return httpx.AsyncClient(
+            verify=self.verify,
+            http2=http2,
+            limits=limits,
+            timeout=httpx.Timeout(self.timeout, connect=self.timeout),
+            transport=self.transport,
+        )
+
+    def get_client(self) -> httpx.AsyncClient:
+        loop = asyncio.get_running_loop()
+        if self._client is not None and self._loop is loop and self._stale:
+            loop.create_task(self._client.aclose())
+            self._client = None
+
+        # Pooled connections belong to the loop that opened them, a client
+        # left over from an earlier asyncio.run() can't be reused
+        if self._client is None or self._client.is_closed or self._loop is not loop:
+            self._client = self._build_client()
+            self._loop = loop
+            self._host_slots = {}
+            self._stale = False
+        return self._client
+
+    def _host_slot(self, url: Union[str, httpx.URL]) -> asyncio.Semaphore:
+        host = urlsplit(str(url)).netloc
+        slot = self._host_slots.get(host)
+        if slot is None:
+            slot = asyncio.Semaphore(self.max_host_connections)
+            self._host_slots[host] = slot
+        return slot
+
+    async def request(
+        self, method: str, url: Union[str, httpx.URL], **kwargs
+    ) -> httpx.Response:
+        client = self.get_client()
+        if self.limiter:
+            await self.limiter.acquire(url)
+        async with self._host_slot(url):
+            started = time.monotonic()
+            try:
+                response = await client.request(method, url, **kwargs)
+            except httpx.HTTPError as e:
+                if self.metrics:
+                    self.metrics.observe_error(url, e, time.monotonic() - started)
+                if self.limiter:
+                    self.limiter.observe_error(url, e)
+                raise
+        seconds = time.monotonic() - started
+        if self.metrics:
+            self.metrics.observe_response(url, response, seconds)
+        if self.limiter:
+            self.limiter.observe(url, response, seconds)
+        return response
+
+    async def get(self, url: Union[str, httpx.URL], **kwargs) -> httpx.Response:
+        return await self.request("GET", url, **kwargs)
+
+    async def post(self, url: Union[str, httpx.URL], **kwargs) -> httpx.Response:
+        return await self.request("POST", url, **kwargs)
+
+    async def head(self, url: Union[str, httpx.URL], **kwargs) -> httpx.Response:
+        return await self.request("HEAD", url, **kwargs)
+
+    @asynccontextmanager
+    async def stream(
+        self, method: str, url: Union[str, httpx.URL], **kwargs
+    ) -> AsyncIterator[httpx.Response]:
+        client = self.get_client()
+        async with self._host_slot(url):
+            started = time.monotonic()
+            try:
+                async with client.stream(method, url, **kwargs) as response:
+                    if self.metrics:
+                        self.metrics.observe_response(
+                            url, response, time.monotonic() - started, read=False
+                        )
+                    try:
+                        yield response
+                    finally:
+                        if self.metrics:
+                            self.metrics.add_bytes(url, response.num_bytes_downloaded)
+            except httpx.HTTPError as e:
+                # raise_for_status() by the caller is already counted as a status
+                if self.metrics and not isinstance(e, httpx.HTTPStatusError):
+                    self.metrics.observe_error(url, e, time.monotonic() - started)
+                raise
+
+    async def aclose(self) -> None:
+        client, self._client = self._client, None
+        if client is None or client.is_closed:
+            return
+        try:
+            if self._loop is asyncio.get_running_loop():
+                await client.aclose()
+        finally:
+            self._loop = None
+            self._host_slots = {}
+
+    async def __aenter__(self) -> "HttpSession":
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb) -> None:
+        await self.aclose()
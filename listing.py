@@ -0,0 +1,167 @@
+import asyncio
+import math
+import posixpath
+from typing import Any, AsyncIterator, Awaitable, Callable, Union
+
+from utils import custom_print
+
+_DONE = object()
+
+
+class Paginator:
+    """Fetches page 1, plans the remaining pages from metadata._total and
+    fetches them concurrently, yielding pages in order."""
+
+    def __init__(
+        self,
+        fetch_page: Callable[[int, int], Awaitable[dict[str, Any]]],
+        page_size: int = 50,
+        concurrency: int = 4,
+    ) -> None:
+        self.fetch_page = fetch_page
+        self.page_size = page_size
+        self.concurrency = max(concurrency, 1)
+
+    def plan(self, first: dict[str, Any]) -> int:
+        """Number of pages, 1 if the first response can't tell."""
+        metadata = first.get("metadata") or {}
+        total = metadata.get("_total") or 0
+        # The server may clamp the requested size, trust what it reports
+        size = metadata.get("_size") or self.page_size
+        count = metadata.get("_count")
+        if count is None:
+            count = len((first.get("data") or {}).get("list") or [])
+        if total <= size or count < size:
+            return 1
+        return math.ceil(total / size)
+
+    async def pages(self) -> AsyncIterator[dict[str, Any]]:
+        first = await self.fetch_page(1, self.page_size)
+        yield first
+        total_pages = self.plan(first)
+        if total_pages <= 1:
+            return
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def fetch(page: int) -> dict[str, Any]:
+            async with semaphore:
+                return await self.fetch_page(page, self.page_size)
+
+        tasks = [asyncio.create_task(fetch(page)) for page in range(2, total_pages + 1)]
+        try:
+            for task in tasks:
+                yield await task
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def items(self) -> list[dict[str, Any]]:
+        items = []
+        async for page in self.pages():
+            items.extend((page.get("data") or {}).get("list") or [])
+        return items
+
+
+class ShareCrawler:
+    """Breadth-first walk of a share tree with a bounded number of
+    concurrent get_detail calls. File records are yielded as soon as their
+    folder is listed, so consumers can start before the crawl finishes.
+    At most max_pending records are buffered, a slow consumer pauses the
+    listing instead of growing memory."""
+
+    def __init__(
+        self,
+        manager,
+        pwd_id: str,
+        stoken: str,
+        concurrency: int = 8,
+        max_pending: int = 1000,
+    ) -> None:
+        self.manager = manager
+        self.pwd_id = pwd_id
+        self.stoken = stoken
+        self.concurrency = max(concurrency, 1)
+        self.max_pending = max(max_pending, 1)
+        # Same shape as the folders_map quark_file_download builds paths from
+        self.folders_map: dict[str, dict[str, str]] = {}
+        self.files_count = 0
+        self.folders_count = 0
+
+    def _record(self, entry: dict[str, Any], path: str) -> dict[str, Any]:
+        record = dict(entry)
+        record["path"] = posixpath.join(path, entry["file_name"])
+        record["size"] = entry.get("size") or 0
+        return record
+
+    async def _dispatch(
+        self,
+        entries: list[dict[str, Any]],
+        path: str,
+        folders: asyncio.Queue,
+        records: asyncio.Queue,
+    ) -> None:
+        for entry in entries:
+            if entry["dir"]:
+                self.folders_count += 1
+                self.folders_map[entry["fid"]] = {
+                    "file_name": entry["file_name"],
+                    "pdir_fid": entry["pdir_fid"],
+                }
+                folders.put_nowait(
+                    (entry["fid"], posixpath.join(path, entry["file_name"]))
+                )
+            else:
+                self.files_count += 1
+                await records.put(self._record(entry, path))
+
+    async def _worker(self, folders: asyncio.Queue, records: asyncio.Queue) -> None:
+        while True:
+            fid, path = await folders.get()
+            try:
+                _, entries = await self.manager.get_detail(
+                    self.pwd_id, self.stoken, pdir_fid=fid
+                )
+                await self._dispatch(entries or [], path, folders, records)
+            except Exception as e:
+                custom_print(f"获取文件夹 {path} 列表失败: {e}", error_msg=True)
+                await records.put(e)
+            finally:
+                folders.task_done()
+
+    async def crawl(
+        self, entries: Union[list[dict[str, Any]], None] = None, path: str = ""
+    ) -> AsyncIterator[dict[str, Any]]:
+        """Yield a record (fid, path, size and the listing fields) for every
+        file below the given root entries, the share root if omitted."""
+        if entries is None:
+            _, entries = await self.manager.get_detail(self.pwd_id, self.stoken)
+
+        folders: asyncio.Queue = asyncio.Queue()
+        records: asyncio.Queue = asyncio.Queue(maxsize=self.max_pending)
+
+        async def close_when_done() -> None:
+            # Dispatched here, not inline, the bounded records queue may only
+            # drain once this generator yields
+            await self._dispatch(entries or [], path, folders, records)
+            await folders.join()
+            await records.put(_DONE)
+
+        tasks = [
+            asyncio.create_task(self._worker(folders, records))
+            for _ in range(self.concurrency)
+        ]
+        tasks.append(asyncio.create_task(close_when_done()))
+        try:
+            while True:
+                record = await records.get()
+                if record is _DONE:
+                    break
+                if isinstance(record, Exception):
+                    raise record
+                yield record
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
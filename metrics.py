@@ -0,0 +1,296 @@
+import asyncio
+import json
+import os
+import time
+from collections import Counter
+from typing import Any, Union
+from urllib.parse import urlsplit
+
+import httpx
+
+from utils import get_datetime
+
+# The control-plane hosts, anything else is a download server
+API_HOSTS = ("drive-pc.quark.cn", "drive.quark.cn", "pan.quark.cn")
+CDN = "cdn"
+LATENCY_BUCKETS = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+)
+
+
+def endpoint_name(url: Union[str, httpx.URL]) -> str:
+    """Metric label of a request URL, the API path without its version
+    prefix, e.g. share/sharepage/token. Every download host is "cdn"."""
+    parts = urlsplit(str(url))
+    if parts.hostname not in API_HOSTS:
+        return CDN
+    path = parts.path.strip("/")
+    if path.startswith("1/clouddrive/"):
+        path = path[len("1/clouddrive/") :]
+    elif path == "1/clouddrive":
+        path = "clouddrive"
+    return path or "/"
+
+
+def response_code(response: httpx.Response) -> Union[str, None]:
+    """The "code" of a JSON API response body, None for anything else."""
+    if "json" not in response.headers.get("content-type", ""):
+        return None
+    try:
+        code = response.json().get("code")
+    except (ValueError, AttributeError):
+        return None
+    return None if code is None else str(code)
+
+
+class Histogram:
+    """Cumulative-bucket histogram, the Prometheus kind."""
+
+    __slots__ = ("buckets", "counts", "count", "sum")
+
+    def __init__(self, buckets: tuple[float, ...] = LATENCY_BUCKETS) -> None:
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+    def quantile(self, q: float) -> Union[float, None]:
+        """Upper bound of the bucket holding the q quantile, None if empty
+        and inf past the last bucket."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(self.buckets, self.counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+    def summary(self) -> dict[str, Any]:
+        def rounded(value: Union[float, None]) -> Union[float, str, None]:
+            if value is None:
+                return None
+            return "inf" if value == float("inf") else round(value, 4)
+
+        return {
+            "count": self.count,
+            "avg": rounded(self.sum / self.count if self.count else None),
+            "p50": rounded(self.quantile(0.5)),
+            "p90": rounded(self.quantile(0.9)),
+            "p99": rounded(self.quantile(0.99)),
+        }
+
+
+class EndpointStats:
+    __slots__ = ("latency", "statuses", "codes", "errors", "retries", "bytes")
+
+    def __init__(self) -> None:
+        self.latency = Histogram()
+        # HTTP status -> count, and the "code" of JSON bodies
+        self.statuses: Counter = Counter()
+        self.codes: Counter = Counter()
+        # Exception class -> count, requests that got no response
+        self.errors: Counter = Counter()
+        self.retries = 0
+        self.bytes = 0
+
+
+class Metrics:
+    """Latency histograms, status, code and error counters, retries and
+    bytes per endpoint, plus download segment times.
+
+    HttpSession records every request it sends, callers add retries and
+    segments. Everything runs on the event loop thread, so the counters
+    are plain ints."""
+
+    def __init__(self) -> None:
+        self.reset()
+
+    def reset(self) -> None:
+        self.started = time.time()
+        self.endpoints: dict[str, EndpointStats] = {}
+        self.segments = Histogram()
+        self.segment_bytes = 0
+
+    def _stats(self, endpoint: str) -> EndpointStats:
+        stats = self.endpoints.get(endpoint)
+        if stats is None:
+            stats = self.endpoints[endpoint] = EndpointStats()
+        return stats
+
+    def observe_response(
+        self,
+        url: Union[str, httpx.URL],
+        response: httpx.Response,
+        seconds: float,
+        read: bool = True,
+    ) -> None:
+        """Count the response to a request for url. read is False for
+        streams, their body isn't there yet and its bytes are added by
+        add_bytes."""
+        stats = self._stats(endpoint_name(url))
+        stats.latency.observe(seconds)
+        stats.statuses[response.status_code] += 1
+        if not read:
+            return
+        stats.bytes += len(response.content)
+        code = response_code(response)
+        if code is not None:
+            stats.codes[code] += 1
+
+    def observe_error(
+        self, url: Union[str, httpx.URL], error: Exception, seconds: float
+    ) -> None:
+        stats = self._stats(endpoint_name(url))
+        stats.latency.observe(seconds)
+        stats.errors[type(error).__name__] += 1
+
+    def add_bytes(self, url: Union[str, httpx.URL], n: int) -> None:
+        self._stats(endpoint_name(url)).bytes += n
+
+    def retry(self, endpoint: str) -> None:
+        self._stats(endpoint).retries += 1
+
+    def observe_segment(self, seconds: float, n: int) -> None:
+        self.segments.observe(seconds)
+        self.segment_bytes += n
+
+    def snapshot(self) -> dict[str, Any]:
+        endpoints = {}
+        for name, stats in sorted(self.endpoints.items()):
+            endpoints[name] = {
+                "requests": sum(stats.statuses.values()) + sum(stats.errors.values()),
+                "latency": stats.latency.summary(),
+                "statuses": {str(k): v for k, v in sorted(stats.statuses.items())},
+                "codes": dict(sorted(stats.codes.items())),
+                "errors": dict(stats.errors),
+                "retries": stats.retries,
+                "bytes": stats.bytes,
+            }
+        return {
+            "time": get_datetime(),
+            "elapsed": round(time.time() - self.started, 1),
+            "endpoints": endpoints,
+            "segments": {**self.segments.summary(), "bytes": self.segment_bytes},
+        }
+
+    def save(self, path: str) -> None:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.snapshot(), f, ensure_ascii=False, indent=2)
+
+    def prometheus(self) -> str:
+        """The metrics in the Prometheus text exposition format."""
+        lines = []
+
+        def family(name: str, kind: str, help_text: str) -> None:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        def histogram(name: str, labels: str, h: Histogram) -> None:
+            cumulative = 0
+            for bound, n in zip(h.buckets, h.counts):
+                cumulative += n
+                lines.append(f'{name}_bucket{{{labels}le="{bound}"}} {cumulative}')
+            lines.append(f'{name}_bucket{{{labels}le="+Inf"}} {h.count}')
+            labels = labels.rstrip(",")
+            suffix = f"{{{labels}}}" if labels else ""
+            lines.append(f"{name}_sum{suffix} {h.sum:.6f}")
+            lines.append(f"{name}_count{suffix} {h.count}")
+
+        endpoints = sorted(self.endpoints.items())
+        family(
+            "quark_request_duration_seconds",
+            "histogram",
+            "Time to response headers per endpoint.",
+        )
+        for name, stats in endpoints:
+            histogram(
+                "quark_request_duration_seconds", f'endpoint="{name}",', stats.latency
+            )
+        family("quark_responses_total", "counter", "Responses by HTTP status.")
+        for name, stats in endpoints:
+            for status, n in sorted(stats.statuses.items()):
+                lines.append(
+                    f'quark_responses_total{{endpoint="{name}",status="{status}"}} {n}'
+                )
+        family("quark_api_codes_total", "counter", "Response body codes.")
+        for name, stats in endpoints:
+            for code, n in sorted(stats.codes.items()):
+                lines.append(
+                    f'quark_api_codes_total{{endpoint="{name}",code="{code}"}} {n}'
+                )
+        family("quark_request_errors_total", "counter", "Requests without a response.")
+        for name, stats in endpoints:
+            for error, n in sorted(stats.errors.items()):
+                lines.append(
+                    f'quark_request_errors_total{{endpoint="{name}",error="{error}"}} {n}'
+                )
+        family("quark_retries_total", "counter", "Retried calls.")
+        for name, stats in endpoints:
+            lines.append(f'quark_retries_total{{endpoint="{name}"}} {stats.retries}')
+        family("quark_received_bytes_total", "counter", "Response body bytes.")
+        for name, stats in endpoints:
+            lines.append(
+                f'quark_received_bytes_total{{endpoint="{name}"}} {stats.bytes}'
+            )
+        family(
+            "quark_segment_duration_seconds",
+            "histogram",
+            "Download segment times, first request to last byte.",
+        )
+        histogram("quark_segment_duration_seconds", "", self.segments)
+        family("quark_segment_bytes_total", "counter", "Bytes of finished segments.")
+        lines.append(f"quark_segment_bytes_total {self.segment_bytes}")
+        return "\n".join(lines) + "\n"
+
+    async def _handle(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        try:
+            request = await reader.readline()
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+            path = request.split(b" ")[1] if request.count(b" ") >= 2 else b""
+            if path.split(b"?")[0] in (b"/", b"/metrics"):
+                status, body = "200 OK", self.prometheus().encode()
+            else:
+                status, body = "404 Not Found", b"not found\n"
+            writer.write(
+                f"HTTP/1.1 {status}\r\n"
+                "Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode()
+                + body
+            )
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def serve(
+        self, port: int, host: str = "127.0.0.1"
+    ) -> asyncio.base_events.Server:
+        """Serve the Prometheus text at /metrics until the server is closed."""
+        return await asyncio.start_server(self._handle, host, port)
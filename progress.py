@@ -0,0 +1,244 @@
+import asyncio
+import json
+import sys
+import time
+from typing import Any, Callable, TextIO, Union
+
+from utils import get_datetime
+
+
+def format_bytes(n: float) -> str:
+    for unit in ("B", "KB", "MB", "GB"):
+        if abs(n) < 1024:
+            return f"{n:.1f} {unit}" if unit != "B" else f"{int(n)} B"
+        n /= 1024
+    return f"{n:.2f} TB"
+
+
+def format_duration(seconds: Union[float, None]) -> str:
+    if seconds is None:
+        return "--:--:--"
+    seconds = int(seconds)
+    return f"{seconds // 3600:02d}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
+
+
+class FileProgress:
+    """Byte counter of one file. Only its download coroutines write to it,
+    all on the event loop thread, so an update is a plain integer add."""
+
+    __slots__ = ("name", "total", "done", "started", "rate", "_seen")
+
+    def __init__(self, name: str, total: int = 0, initial: int = 0) -> None:
+        self.name = name
+        self.total = total
+        self.done = initial
+        self.started = time.monotonic()
+        self.rate = 0.0
+        self._seen = initial
+
+    def update(self, n: int) -> None:
+        self.done += n
+
+
+class ProgressDashboard:
+    """One summary of every running download, rendered every interval
+    seconds instead of a progress bar per file.
+
+    mode is "text" (a status line, redrawn in place on a terminal), "json"
+    (one JSON object per line, for CI logs) or "off"."""
+
+    MODES = ("text", "json", "off")
+
+    def __init__(
+        self,
+        mode: str = "text",
+        interval: float = 1.0,
+        top: int = 3,
+        connections: Union[Callable[[], int], None] = None,
+        stream: Union[TextIO, None] = None,
+    ) -> None:
+        self.mode = mode
+        self.interval = interval
+        self.top = top
+        self.connections = connections
+        self.stream = stream
+        self.reset()
+
+    def reset(self) -> None:
+        self.active: dict[int, FileProgress] = {}
+        self.files_done = 0
+        self.files_failed = 0
+        # Bytes of closed files, a failed file only counts what it got
+        self.closed_bytes = 0
+        # Announced by the pipeline before the file starts
+        self.queued_bytes = 0
+        self.hedges = 0
+        self.hedges_won = 0
+        self.hedge_wasted_bytes = 0
+        self.rate = 0.0
+        self._seen = 0
+        self._rendered_at: Union[float, None] = None
+        self._line_open = False
+
+    @property
+    def out(self) -> TextIO:
+        return self.stream or sys.stdout
+
+    @property
+    def interactive(self) -> bool:
+        return self.mode == "text" and self.out.isatty()
+
+    def expect(self, size: int) -> None:
+        """Count a file that is about to be downloaded into the total."""
+        self.queued_bytes += max(size, 0)
+
+    def track(self, name: str, total: int = 0, initial: int = 0) -> FileProgress:
+        progress = FileProgress(name, total, initial)
+        self.queued_bytes = max(self.queued_bytes - total, 0)
+        self.active[id(progress)] = progress
+        return progress
+
+    def close(self, progress: FileProgress, ok: bool = True) -> None:
+        if self.active.pop(id(progress), None) is None:
+            return
+        self.closed_bytes += progress.done
+        if ok:
+            self.files_done += 1
+        else:
+            self.files_failed += 1
+
+    def add_hedges(self, started: int, won: int, wasted_bytes: int) -> None:
+        self.hedges += started
+        self.hedges_won += won
+        self.hedge_wasted_bytes += wasted_bytes
+
+    @property
+    def done_bytes(self) -> int:
+        return self.closed_bytes + sum(p.done for p in self.active.values())
+
+    @property
+    def total_bytes(self) -> int:
+        return (
+            self.closed_bytes
+            + sum(max(p.total, p.done) for p in self.active.values())
+            + self.queued_bytes
+        )
+
+    def _sample(self) -> None:
+        now = time.monotonic()
+        done = self.done_bytes
+        if self._rendered_at is not None:
+            elapsed = max(now - self._rendered_at, 1e-3)
+            # Smoothed, a single stalled interval shouldn't swing the ETA
+            rate = max(done - self._seen, 0) / elapsed
+            self.rate = rate if not self.rate else 0.7 * self.rate + 0.3 * rate
+            for p in self.active.values():
+                file_rate = max(p.done - p._seen, 0) / elapsed
+                p.rate = file_rate if not p.rate else 0.7 * p.rate + 0.3 * file_rate
+                p._seen = p.done
+        self._seen = done
+        self._rendered_at = now
+
+    def _slowest(self) -> list[FileProgress]:
+        # Files younger than an interval have no meaningful rate yet
+        started_before = time.monotonic() - self.interval
+        running = [p for p in self.active.values() if p.started <= started_before]
+        return sorted(running, key=lambda p: p.rate)[: self.top]
+
+    def snapshot(self) -> dict[str, Any]:
+        done, total = self.done_bytes, self.total_bytes
+        eta = (total - done) / self.rate if self.rate > 0 else None
+        return {
+            "time": get_datetime(),
+            "files_done": self.files_done,
+            "files_failed": self.files_failed,
+            "files_active": len(self.active),
+            "bytes_done": done,
+            "bytes_total": total,
+            "rate": round(self.rate),
+            "eta": round(eta) if eta is not None else None,
+            "connections": self.connections() if self.connections else None,
+            "hedges": self.hedges,
+            "hedges_won": self.hedges_won,
+            "hedge_wasted_bytes": self.hedge_wasted_bytes,
+            "slowest": [
+                {
+                    "file": p.name,
+                    "rate": round(p.rate),
+                    "done": p.done,
+                    "total": p.total,
+                }
+                for p in self._slowest()
+            ],
+        }
+
+    def format(self, snapshot: dict[str, Any]) -> str:
+        parts = [
+            f"[{snapshot['time']}] 已完成 {snapshot['files_done']} 个文件，"
+            f"下载中 {snapshot['files_active']}",
+            f"{format_bytes(snapshot['bytes_done'])} / {format_bytes(snapshot['bytes_total'])}",
+            f"{format_bytes(snapshot['rate'])}/s",
+            f"剩余 {format_duration(snapshot['eta'])}",
+        ]
+        if snapshot["files_failed"]:
+            parts.insert(1, f"失败 {snapshot['files_failed']}")
+        if snapshot["connections"] is not None:
+            parts.append(f"连接 {snapshot['connections']}")
+        if snapshot["hedges"]:
+            parts.append(f"对冲 {snapshot['hedges_won']}/{snapshot['hedges']}")
+        if snapshot["slowest"] and snapshot["files_active"] > 1:
+            parts.append(
+                "最慢: "
+                + ", ".join(
+                    f"{s['file']} {format_bytes(s['rate'])}/s"
+                    for s in snapshot["slowest"]
+                )
+            )
+        return " | ".join(parts)
+
+    def render(self, final: bool = False) -> None:
+        if self.mode == "off":
+            return
+        self._sample()
+        snapshot = self.snapshot()
+        if self.mode == "json":
+            if final:
+                snapshot["final"] = True
+            self.out.write(json.dumps(snapshot, ensure_ascii=False) + "\n")
+        elif self.interactive and not final:
+            # Redrawn in place, write() clears it before other output
+            self.out.write("\r" + self.format(snapshot) + "\x1b[K")
+            self._line_open = True
+        else:
+            self._clear()
+            self.out.write(self.format(snapshot) + "\n")
+        self.out.flush()
+
+    def _clear(self) -> None:
+        if self._line_open:
+            self.out.write("\r\x1b[K")
+            self._line_open = False
+
+    def write(self, message: str) -> None:
+        """Print a message without breaking the status line."""
+        self._clear()
+        if self.mode == "json":
+            line = json.dumps(
+                {"time": get_datetime(), "message": message}, ensure_ascii=False
+            )
+        else:
+            line = f"[{get_datetime()}] {message}"
+        self.out.write(line + "\n")
+        self.out.flush()
+
+    async def run(self) -> None:
+        """Render until cancelled, then once more as the final summary."""
+        if self.mode == "off":
+            return
+        self._sample()
+        try:
+            while True:
+                await asyncio.sleep(self.interval)
+                self.render()
+        finally:
+            self.render(final=True)
@@ -1,4 +1,5 @@
 import asyncio
+import hashlib
 import json
 import os
 import shutil
@@ -6,14 +7,46 @@ import random
 import re
 import sys
 import argparse
+import itertools
 import math
-from typing import Any, Union
+import time
+from typing import Any, AsyncIterator, Awaitable, Callable, Union
+from urllib.parse import urlsplit
 
 import httpx
 from prettytable import PrettyTable
-from tqdm import tqdm
 
+from downloader import (
+    BandwidthLimiter,
+    BufferPool,
+    ConnectionBudget,
+    ConnectionTuner,
+    DownloadLink,
+    DownloadManifest,
+    FileWriter,
+    HostProfile,
+    SchedulePolicy,
+    RangeNotSupported,
+    Segment,
+    SegmentScheduler,
+    WriteBuffer,
+    get_schedule_policy,
+    normalize_md5,
+    parse_content_range,
+    parse_rate,
+    parse_schedule,
+    verify_file,
+)
+from host_selector import HostSelector
+from http_session import HttpSession
+from listing import Paginator, ShareCrawler
+from metrics import Metrics
+from progress import FileProgress, ProgressDashboard
 from quark_login import CONFIG_DIR, QuarkLogin
+from rate_limit import RateLimiter
+from retry import RetryEngine, RetryPolicy, is_endpoint_failure
+from sync_state import SyncState
+from task_tracker import TaskTracker
 from utils import (
     custom_print,
     generate_random_code,
@@ -27,6 +60,12 @@ from utils import (
 
 class QuarkPanFileManager:
     TEMP_DIR_NAME = "__________temp"
+    # Learned connection counts are trusted for a day
+    HOST_PROFILE_TTL = 24 * 3600
+    HEDGE_CHECK_INTERVAL = 0.5
+    # Retries on a fresh URL a segment gets for free, without receiving
+    # anything in between
+    MAX_URL_REFRESHES = 10
 
     def __init__(self, headless: bool = False, slow_mo: int = 0) -> None:
         self.headless: bool = headless
@@ -36,6 +75,12 @@ class QuarkPanFileManager:
         self.pdir_id: Union[str, None] = "0"
         self.dir_name: Union[str, None] = "根目录"
         self.block_size: int = 100
+        self.segment_size: int = 16
+        self.crawl_concurrency: int = 8
+        self.download_batch_size: int = 50
+        self.detail_page_size: int = 50
+        self.sort_page_size: int = 100
+        self.page_concurrency: int = 4
         self.concurrent_files: int = 3
         self.save_folder: str = "output/downloads"
         self.cookies: str = self.get_cookies()
@@ -47,6 +92,67 @@ class QuarkPanFileManager:
             "accept-language": "zh-CN,zh;q=0.9",
             "cookie": self.cookies,
         }
+        # Per endpoint latency, status and code counts of every request
+        self.metrics: Metrics = Metrics()
+        # Requests/s of each API endpoint, adapted to how the API copes
+        self.rate_limiter: RateLimiter = RateLimiter()
+        self.session: HttpSession = HttpSession(
+            metrics=self.metrics, limiter=self.rate_limiter
+        )
+        # Backoff, retry budget and circuit breaker of every retried call,
+        # "task" polls a save or share task until it finishes
+        self.retry: RetryEngine = RetryEngine(
+            self.metrics,
+            {
+                "cdn": RetryPolicy(attempts=3, base=1.0, cap=10.0),
+                "task": RetryPolicy(attempts=50, base=0.5, cap=3.0),
+                "share": RetryPolicy(attempts=3, base=1.0, cap=10.0),
+                "file/download": RetryPolicy(attempts=3, base=1.0, cap=10.0),
+            },
+        )
+        # Polls every outstanding save and share task, at most
+        # task_poll_rate requests/s however many there are
+        self.task_tracker: TaskTracker = TaskTracker(self.get_task, self.retry)
+        # Prometheus text at /metrics while --download runs, 0 is off
+        self.metrics_port: int = 0
+        self.metrics_host: str = "127.0.0.1"
+        self.connection_budget: ConnectionBudget = ConnectionBudget(16)
+        # Receive buffers recycled across every file and connection
+        self.buffer_pool: BufferPool = BufferPool(5 * 1024 * 1024)
+        self.schedule_policy: SchedulePolicy = get_schedule_policy("balanced")
+        self.adaptive_connections: bool = True
+        self.verify_downloads: bool = True
+        # A straggling segment is hedged past hedge_threshold times the
+        # typical segment time, with at most hedge_budget of the file size
+        # downloaded twice
+        self.hedge_threshold: float = 3.0
+        self.hedge_budget: float = 0.1
+        self.sync: bool = False
+        self.sync_delete: bool = False
+        self.sync_state: Union[SyncState, None] = None
+        # Files every download_pipeline so far failed, watch compares it
+        # across a round
+        self.failed_downloads: int = 0
+        self.bandwidth_limiter: BandwidthLimiter = BandwidthLimiter()
+        # --limit, wins over limit and limit_schedule in config.json
+        self.limit_override: Union[float, None] = None
+        self.config_mtime: Union[float, None] = None
+        # --progress, wins over config.json
+        self.progress_override: Union[str, None] = None
+        self.host_profile: HostProfile = HostProfile("output/host_profile.json")
+        self.host_selector: HostSelector = HostSelector(self.session, self.host_profile)
+        self.progress: ProgressDashboard = ProgressDashboard(
+            connections=lambda: self.connection_budget.in_use
+        )
+
+    async def __aenter__(self) -> "QuarkPanFileManager":
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb) -> None:
+        await self.aclose()
+
+    async def aclose(self) -> None:
+        await self.session.aclose()
 
     def get_cookies(self) -> str:
         quark_login = QuarkLogin(headless=self.headless, slow_mo=self.slow_mo)
@@ -72,75 +178,62 @@ class QuarkPanFileManager:
         }
         api = "https://drive-pc.quark.cn/1/clouddrive/share/sharepage/token"
         data = {"pwd_id": pwd_id, "passcode": password}
-        async with httpx.AsyncClient(verify=False) as client:
-            timeout = httpx.Timeout(60.0, connect=60.0)
-            response = await client.post(
-                api, json=data, params=params, headers=self.headers, timeout=timeout
-            )
-            json_data = response.json()
-            if json_data["status"] == 200 and json_data["data"]:
-                stoken = json_data["data"]["stoken"]
-            else:
-                stoken = ""
-                custom_print(f"文件转存失败，{json_data['message']}")
-            return stoken
+        response = await self.session.post(
+            api, json=data, params=params, headers=self.headers
+        )
+        json_data = response.json()
+        if json_data["status"] == 200 and json_data["data"]:
+            stoken = json_data["data"]["stoken"]
+        else:
+            stoken = ""
+            custom_print(f"文件转存失败，{json_data['message']}")
+        return stoken
 
     async def get_detail(
         self, pwd_id: str, stoken: str, pdir_fid: str = "0"
     ) -> str | tuple | None:
         api = "https://drive-pc.quark.cn/1/clouddrive/share/sharepage/detail"
-        page = 1
         file_list: list[dict[str, Union[int, str]]] = []
 
-        async with httpx.AsyncClient(verify=False) as client:
-            while True:
-                params = {
-                    "pr": "ucpro",
-                    "fr": "pc",
-                    "uc_param_str": "",
-                    "pwd_id": pwd_id,
-                    "stoken": stoken,
-                    "pdir_fid": pdir_fid,
-                    "force": "0",
-                    "_page": str(page),
-                    "_size": "50",
-                    "_sort": "file_type:asc,updated_at:desc",
-                    "__dt": random.randint(200, 9999),
-                    "__t": get_timestamp(13),
-                }
-
-                timeout = httpx.Timeout(60.0, connect=60.0)
-                response = await client.get(
-                    api, headers=self.headers, params=params, timeout=timeout
-                )
-                json_data = response.json()
-
-                is_owner = json_data["data"]["is_owner"]
-                _total = json_data["metadata"]["_total"]
-                if _total < 1:
-                    return is_owner, file_list
-
-                _size = json_data["metadata"]["_size"]  # 每页限制数量
-                _count = json_data["metadata"]["_count"]  # 当前页数量
-
-                _list = json_data["data"]["list"]
-
-                for file in _list:
-                    d: dict[str, Union[int, str]] = {
-                        "fid": file["fid"],
-                        "file_name": file["file_name"],
-                        "file_type": file["file_type"],
-                        "dir": file["dir"],
-                        "pdir_fid": file["pdir_fid"],
-                        "include_items": file.get("include_items", ""),
-                        "share_fid_token": file["share_fid_token"],
-                        "status": file["status"],
-                    }
-                    file_list.append(d)
-                if _total <= _size or _count < _size:
-                    return is_owner, file_list
+        async def fetch_page(page: int, size: int) -> dict[str, Any]:
+            params = {
+                "pr": "ucpro",
+                "fr": "pc",
+                "uc_param_str": "",
+                "pwd_id": pwd_id,
+                "stoken": stoken,
+                "pdir_fid": pdir_fid,
+                "force": "0",
+                "_page": str(page),
+                "_size": str(size),
+                "_sort": "file_type:asc,updated_at:desc",
+                "__dt": random.randint(200, 9999),
+                "__t": get_timestamp(13),
+            }
+            response = await self.session.get(api, headers=self.headers, params=params)
+            return response.json()
 
-                page += 1
+        is_owner = 0
+        paginator = Paginator(
+            fetch_page, self.detail_page_size, concurrency=self.page_concurrency
+        )
+        async for json_data in paginator.pages():
+            is_owner = json_data["data"]["is_owner"]
+            for file in json_data["data"]["list"]:
+                d: dict[str, Union[int, str]] = {
+                    "fid": file["fid"],
+                    "file_name": file["file_name"],
+                    "file_type": file["file_type"],
+                    "dir": file["dir"],
+                    "pdir_fid": file["pdir_fid"],
+                    "include_items": file.get("include_items", ""),
+                    "share_fid_token": file["share_fid_token"],
+                    "status": file["status"],
+                    "size": file.get("size", 0),
+                    "updated_at": file.get("updated_at"),
+                }
+                file_list.append(d)
+        return is_owner, file_list
 
     async def get_sorted_file_list(
         self, pdir_fid="0", page="1", size="100", fetch_total="false", sort=""
@@ -159,16 +252,26 @@ class QuarkPanFileManager:
             "__t": get_timestamp(13),
         }
 
-        async with httpx.AsyncClient(verify=False) as client:
-            timeout = httpx.Timeout(60.0, connect=60.0)
-            response = await client.get(
-                "https://drive-pc.quark.cn/1/clouddrive/file/sort",
-                params=params,
-                headers=self.headers,
-                timeout=timeout,
+        response = await self.session.get(
+            "https://drive-pc.quark.cn/1/clouddrive/file/sort",
+            params=params,
+            headers=self.headers,
+        )
+        json_data = response.json()
+        return json_data
+
+    async def get_all_sorted_files(
+        self, pdir_fid: str = "0", sort: str = ""
+    ) -> list[dict[str, Any]]:
+        async def fetch_page(page: int, size: int) -> dict[str, Any]:
+            return await self.get_sorted_file_list(
+                pdir_fid, page=str(page), size=str(size), fetch_total="1", sort=sort
             )
-            json_data = response.json()
-            return json_data
+
+        paginator = Paginator(
+            fetch_page, self.sort_page_size, concurrency=self.page_concurrency
+        )
+        return await paginator.items()
 
     async def get_user_info(self) -> str:
         # 1. Primary Validation: Use file list API (more reliable)
@@ -189,23 +292,20 @@ class QuarkPanFileManager:
             "fr": "pc",
             "platform": "pc",
         }
-        async with httpx.AsyncClient(verify=False) as client:
-            timeout = httpx.Timeout(60.0, connect=60.0)
-            try:
-                response = await client.get(
-                    "https://pan.quark.cn/account/info",
-                    params=params,
-                    headers=self.headers,
-                    timeout=timeout,
-                )
-                json_data = response.json()
+        try:
+            response = await self.session.get(
+                "https://pan.quark.cn/account/info",
+                params=params,
+                headers=self.headers,
+            )
+            json_data = response.json()
 
-                # Try to extract nickname if possible, but don't fail if structure varies
-                if json_data.get("data") and isinstance(json_data["data"], dict):
-                    return json_data["data"].get("nickname", "Quark User")
+            # Try to extract nickname if possible, but don't fail if structure varies
+            if json_data.get("data") and isinstance(json_data["data"], dict):
+                return json_data["data"].get("nickname", "Quark User")
 
-            except Exception:
-                pass  # Ignore nickname fetch errors if cookie is already verified
+        except Exception:
+            pass  # Ignore nickname fetch errors if cookie is already verified
 
         return "Quark User"
 
@@ -227,47 +327,42 @@ class QuarkPanFileManager:
             "dir_init_lock": False,
         }
 
-        async with httpx.AsyncClient(verify=False) as client:
-            timeout = httpx.Timeout(60.0, connect=60.0)
-            response = await client.post(
-                "https://drive-pc.quark.cn/1/clouddrive/file",
-                params=params,
-                json=json_data,
-                headers=self.headers,
-                timeout=timeout,
-            )
-            json_data = response.json()
-            if json_data["code"] == 0:
-                custom_print(f"根目录下 {pdir_name} 文件夹创建成功！")
+        response = await self.session.post(
+            "https://drive-pc.quark.cn/1/clouddrive/file",
+            params=params,
+            json=json_data,
+            headers=self.headers,
+        )
+        json_data = response.json()
+        if json_data["code"] == 0:
+            custom_print(f"根目录下 {pdir_name} 文件夹创建成功！")
 
-                # Only update config and instance state if requested
-                # This prevents interference when create_dir is used for other purposes
-                if update_config:
-                    new_config = {
-                        "user": self.user,
-                        "pdir_id": json_data["data"]["fid"],
-                        "dir_name": pdir_name,
-                    }
-                    save_config(
-                        "output/state.json",
-                        content=json.dumps(new_config, ensure_ascii=False),
-                    )
-                    global to_dir_id
-                    to_dir_id = json_data["data"]["fid"]
+            # Only update config and instance state if requested
+            # This prevents interference when create_dir is used for other purposes
+            if update_config:
+                new_config = {
+                    "user": self.user,
+                    "pdir_id": json_data["data"]["fid"],
+                    "dir_name": pdir_name,
+                }
+                save_config(
+                    "output/state.json",
+                    content=json.dumps(new_config, ensure_ascii=False),
+                )
+                global to_dir_id
+                to_dir_id = json_data["data"]["fid"]
 
-                    # Update instance variables to ensure current session uses new dir
-                    self.pdir_id = to_dir_id
-                    self.dir_name = pdir_name
+                # Update instance variables to ensure current session uses new dir
+                self.pdir_id = to_dir_id
+                self.dir_name = pdir_name
 
-                    custom_print(f"自动将保存目录切换至 {pdir_name} 文件夹")
+                custom_print(f"自动将保存目录切换至 {pdir_name} 文件夹")
 
-                return json_data["data"]["fid"]
-            elif json_data["code"] == 23008:
-                custom_print(
-                    "文件夹同名冲突，请更换一个文件夹名称后重试", error_msg=True
-                )
-            else:
-                custom_print(f"错误信息：{json_data['message']}", error_msg=True)
+            return json_data["data"]["fid"]
+        elif json_data["code"] == 23008:
+            custom_print("文件夹同名冲突，请更换一个文件夹名称后重试", error_msg=True)
+        else:
+            custom_print(f"错误信息：{json_data['message']}", error_msg=True)
         return None
 
     async def delete_file(self, fid: str) -> bool:
@@ -278,24 +373,23 @@ class QuarkPanFileManager:
             "uc_param_str": "",
         }
         data = {"filelist": [fid]}
-        async with httpx.AsyncClient(verify=False) as client:
-            timeout = httpx.Timeout(60.0, connect=60.0)
-            response = await client.post(
-                api, json=data, params=params, headers=self.headers, timeout=timeout
-            )
-            json_data = response.json()
-            if json_data["code"] == 0:
-                custom_print(f"文件夹/文件 (FID: {fid}) 删除成功")
-                return True
-            else:
-                custom_print(f"删除失败: {json_data['message']}", error_msg=True)
-                return False
+        response = await self.session.post(
+            api, json=data, params=params, headers=self.headers
+        )
+        json_data = response.json()
+        if json_data["code"] == 0:
+            custom_print(f"文件夹/文件 (FID: {fid}) 删除成功")
+            return True
+        else:
+            custom_print(f"删除失败: {json_data['message']}", error_msg=True)
+            return False
 
     async def run(
         self,
         input_line: str,
         folder_id: Union[str, None] = None,
         download: bool = False,
+        sync_source: Union[tuple[str, dict[str, dict[str, Any]], str], None] = None,
     ) -> Union[str, None]:
         self.folder_id = folder_id
         share_url = input_line.strip()
@@ -314,9 +408,7 @@ class QuarkPanFileManager:
         folders_count = 0
         files_list: list[str] = []
         folders_list: list[str] = []
-        folders_map = {}
         files_id_list = []
-        file_fid_list = []
 
         if data_list:
             total_files_count = len(data_list)
@@ -324,10 +416,6 @@ class QuarkPanFileManager:
                 if data["dir"]:
                     folders_count += 1
                     folders_list.append(data["file_name"])
-                    folders_map[data["fid"]] = {
-                        "file_name": data["file_name"],
-                        "pdir_fid": data["pdir_fid"],
-                    }
                 else:
                     files_count += 1
                     files_list.append(data["file_name"])
@@ -355,58 +443,15 @@ class QuarkPanFileManager:
                     )
                     return None
 
-                for i in data_list:
-                    if i["dir"]:
-                        data_list2 = [i]
-                        not_dir = False
-                        while True:
-                            data_list3 = []
-                            for i2 in data_list2:
-                                custom_print(
-                                    f'开始下载：{i2["file_name"]} 文件夹中的{i2["include_items"]}个文件'
-                                )
-                                is_owner, file_data_list = await self.get_detail(
-                                    pwd_id, stoken, pdir_fid=i2["fid"]
-                                )
-
-                                # record folder's fid start
-                                if file_data_list:
-                                    for data in file_data_list:
-                                        if data["dir"]:
-                                            folders_map[data["fid"]] = {
-                                                "file_name": data["file_name"],
-                                                "pdir_fid": data["pdir_fid"],
-                                            }
-
-                                # record folder's fid stop
-                                folder = i["file_name"]
-                                fid_list = [i["fid"] for i in file_data_list]
-                                await self.quark_file_download(
-                                    fid_list, folder=folder, folders_map=folders_map
-                                )
-                                file_fid_list.extend(
-                                    [i for i in file_data_list if not i2["dir"]]
-                                )
-                                dir_list = [i for i in file_data_list if i["dir"]]
-
-                                if not dir_list:
-                                    not_dir = True
-                                data_list3.extend(dir_list)
-                            data_list2 = data_list3
-                            if not data_list2 or not_dir:
-                                break
-
-                if len(files_id_list) > 0 or len(file_fid_list) > 0:
-                    fid_list = [i[0] for i in files_id_list]
-                    file_fid_list.extend(fid_list)
-                    # Use self.dir_name if folder is '.' to respect the save directory structure if needed,
-                    # but quark_file_download logic handles path construction.
-                    # The issue is that files_id_list are from the root of the share.
-                    # We should probably pass the correct folder name if we want them organized.
-                    # However, the current logic for root files is folder='.'.
-                    await self.quark_file_download(
-                        file_fid_list, folder=".", folders_map=folders_map
-                    )
+                crawler = ShareCrawler(
+                    self, pwd_id, stoken, concurrency=self.crawl_concurrency
+                )
+                await self.download_crawl(
+                    crawler, data_list, share=pwd_id, sync_source=sync_source
+                )
+                custom_print(
+                    f"遍历完成，共 {crawler.files_count} 个文件，{crawler.folders_count} 个文件夹"
+                )
 
             else:
                 if is_owner == 1:
@@ -436,6 +481,64 @@ class QuarkPanFileManager:
             print()
             return None
 
+    async def download_crawl(
+        self,
+        crawler: ShareCrawler,
+        entries: list[dict[str, Any]],
+        share: str = "",
+        sync_source: Union[tuple[str, dict[str, dict[str, Any]], str], None] = None,
+    ) -> None:
+        """Download everything the crawler finds. In sync mode files whose
+        remote entry matches the sync state are skipped, and with
+        sync_delete local files the share no longer has are removed.
+
+        sync_source is (share, records by path, root folder) when the
+        crawled share is a copy of another one, as in the one-click
+        pipeline. Paths are then taken relative to the root folder and
+        files are compared with the source records."""
+        sources: dict[str, dict[str, Any]] = {}
+        root = ""
+        if sync_source:
+            share, sources, root = sync_source
+        if self.sync:
+            self.sync_state = SyncState(self.save_folder, share)
+        seen: set[str] = set()
+        skipped = 0
+
+        # Downloads start while the crawler keeps listing folders
+        async def changed() -> AsyncIterator[dict[str, Any]]:
+            nonlocal skipped
+            async for record in crawler.crawl(entries):
+                if root and record["path"].startswith(root + "/"):
+                    record["path"] = record["path"][len(root) + 1 :]
+                if self.sync_state is None:
+                    yield record
+                    continue
+                seen.add(record["path"])
+                record["source"] = sources.get(record["path"], record)
+                if self.sync_state.unchanged(record["path"], record["source"]):
+                    skipped += 1
+                    continue
+                yield record
+
+        try:
+            await self.download_pipeline(changed(), crawler.folders_map)
+            if self.sync_state is not None:
+                custom_print(f"同步: {skipped} 个文件未变化，已跳过")
+                if self.sync_delete:
+                    self.delete_removed(self.sync_state, seen)
+        finally:
+            if self.sync_state is not None:
+                self.sync_state.save()
+                self.sync_state = None
+
+    @staticmethod
+    def delete_removed(state: SyncState, seen: set[str]) -> None:
+        """Delete synced files whose path the share no longer lists."""
+        for rel_path in state.missing(seen):
+            custom_print(f"同步: 远端已删除，删除本地文件 {state.remove(rel_path)}")
+        state.save()
+
     async def get_share_save_task_id(
         self,
         pwd_id: str,
@@ -462,113 +565,465 @@ class QuarkPanFileManager:
             "scene": "link",
         }
 
-        async with httpx.AsyncClient(verify=False) as client:
-            timeout = httpx.Timeout(60.0, connect=60.0)
-            response = await client.post(
-                task_url,
-                json=data,
-                headers=self.headers,
-                params=params,
-                timeout=timeout,
-            )
-            json_data = response.json()
-            task_id = json_data["data"]["task_id"]
-            custom_print(f"获取任务ID：{task_id}")
-            return task_id
+        response = await self.session.post(
+            task_url,
+            json=data,
+            headers=self.headers,
+            params=params,
+        )
+        json_data = response.json()
+        task_id = json_data["data"]["task_id"]
+        custom_print(f"获取任务ID：{task_id}")
+        return task_id
 
-    @staticmethod
     async def download_part(
-        url: str,
+        self,
+        link: DownloadLink,
+        headers: dict,
+        scheduler: SegmentScheduler,
+        save_path: str,
+        writer: FileWriter,
+        progress: FileProgress,
+        manifest: DownloadManifest = None,
+        tuner: ConnectionTuner = None,
+        hash_segments: bool = False,
+        hedge: bool = False,
+    ) -> None:
+        """One connection worker, downloads segments until none are left.
+        A hedge worker takes a single segment, the hedge twin queued for
+        it, outside the tuner's count so it can't be retired first."""
+        counted = tuner is not None and not hedge
+        if counted:
+            tuner.running += 1
+        try:
+            while True:
+                # The tuner lowered the connection count, give this one up
+                if counted and tuner.should_retire():
+                    return
+                segment = scheduler.next_segment()
+                if segment is None:
+                    return
+                if hash_segments and segment.hasher is None:
+                    segment.hasher = hashlib.md5()
+                # A task per segment, so losing a hedge race cancels the
+                # segment but not the worker
+                segment.task = asyncio.create_task(
+                    self.download_segment(
+                        link,
+                        headers,
+                        scheduler,
+                        segment,
+                        save_path,
+                        writer,
+                        progress,
+                        manifest=manifest,
+                        tuner=tuner,
+                    )
+                )
+                try:
+                    await asyncio.wait({segment.task})
+                except asyncio.CancelledError:
+                    # What it received must be queued before download_segments
+                    # drains the writer and records the segment
+                    segment.task.cancel()
+                    await asyncio.wait({segment.task})
+                    if not segment.task.cancelled():
+                        # Failed as it was cut off, the cancel wins
+                        segment.task.exception()
+                    raise
+                if not segment.task.cancelled():
+                    segment.task.result()
+                if hedge:
+                    return
+        finally:
+            if counted:
+                tuner.running -= 1
+
+    async def download_segment(
+        self,
+        link: DownloadLink,
         headers: dict,
-        start: int,
-        end: int,
+        scheduler: SegmentScheduler,
+        segment: Segment,
         save_path: str,
-        pbar: tqdm,
-        pbar_lock: asyncio.Lock = None,
+        writer: FileWriter,
+        progress: FileProgress,
+        manifest: DownloadManifest = None,
+        tuner: ConnectionTuner = None,
     ) -> None:
-        async with httpx.AsyncClient(verify=False) as client:
-            timeout = httpx.Timeout(60.0, connect=60.0, read=60.0)
-            headers = headers.copy()
-            headers["Range"] = f"bytes={start}-{end}"
-            retries = 3
-            for attempt in range(retries):
+        """Download one segment, retried from where it broke off."""
+        timeout = httpx.Timeout(60.0, connect=60.0, read=60.0)
+        buffer = None
+        attempt = refreshes = 0
+        try:
+            while True:
+                # Held back while the CDN is failing in bulk
+                await self.retry.admit("cdn", attempt)
+                # Resume from the last received byte on retry
+                buffer = WriteBuffer(writer, segment.pos, segment.hasher)
+                resumed = segment.pos
+                url = request_url = link.url
                 try:
-                    async with client.stream(
-                        "GET", url, headers=headers, timeout=timeout
+                    range_headers = headers.copy()
+                    range_headers["Range"] = f"bytes={segment.pos}-{segment.end}"
+                    requested_end = segment.end
+                    # Pinned to one of the fastest CDN addresses, if probed
+                    request_url, route_headers, extensions = self.host_selector.rewrite(
+                        url
+                    )
+                    range_headers.update(route_headers)
+                    async with self.connection_budget.slot(
+                        save_path
+                    ), self.session.stream(
+                        "GET",
+                        request_url,
+                        headers=range_headers,
+                        timeout=timeout,
+                        extensions=extensions,
                     ) as response:
                         response.raise_for_status()
-                        # Use r+b to allow seeking
-                        with open(save_path, "r+b") as f:
-                            f.seek(start)
-                            async for chunk in response.aiter_bytes():
-                                if chunk:
-                                    f.write(chunk)
-                                    if pbar:
-                                        if pbar_lock:
-                                            async with pbar_lock:
-                                                pbar.update(len(chunk))
-                                        else:
-                                            pbar.update(len(chunk))
+                        # A server ignoring Range hands back the whole file,
+                        # only right if the segment is the whole file
+                        content_range = parse_content_range(
+                            response.headers.get("content-range")
+                        )
+                        whole = (
+                            response.status_code == 200
+                            and not response.headers.get("content-range")
+                        )
+                        if whole and (
+                            segment.pos != 0 or requested_end != scheduler.file_size - 1
+                        ):
+                            raise RangeNotSupported(
+                                f"服务器不支持范围请求: HTTP {response.status_code}"
+                            )
+                        if not whole and (
+                            response.status_code != 206
+                            or not content_range
+                            or content_range[0] != segment.pos
+                            or content_range[2] not in (None, scheduler.file_size)
+                        ):
+                            raise Exception(
+                                f"范围响应不匹配: HTTP {response.status_code}, "
+                                f"Content-Range: {response.headers.get('content-range')}"
+                            )
+                        async for chunk in response.aiter_bytes():
+                            if not chunk:
+                                continue
+                            # The tail may have been stolen by an idle worker
+                            chunk = chunk[: segment.remaining]
+                            await self.bandwidth_limiter.consume(save_path, len(chunk))
+                            buffer.append(chunk)
+                            segment.pos += len(chunk)
+                            progress.update(len(chunk))
+                            if tuner:
+                                tuner.record(len(chunk))
+                            if buffer.full:
+                                await buffer.flush()
+                            # Stop early only if the tail was stolen, reading
+                            # to the end keeps the connection reusable
+                            if segment.done and segment.end < requested_end:
+                                break
+                    await buffer.flush()
+                    if not segment.done:
+                        raise Exception(
+                            f"分段下载不完整: {segment.pos}/{segment.end + 1}"
+                        )
+                    self.retry.success("cdn")
                     break
+                except RangeNotSupported:
+                    # No retry gets a range out of it, download_file falls
+                    # back to a single stream
+                    raise
                 except Exception as e:
-                    if attempt == retries - 1:
-                        raise e
-                    await asyncio.sleep(1)
+                    refreshed = False
+                    # Only the address is to blame for a dead connection or
+                    # a 5xx, not for an expired signature or a bad range
+                    if (
+                        request_url != url
+                        and isinstance(e, httpx.HTTPError)
+                        and is_endpoint_failure(e)
+                    ):
+                        self.host_selector.demote(url, request_url)
+                    if isinstance(e, httpx.HTTPStatusError):
+                        # A 403 usually means the signed URL expired
+                        if e.response.status_code == 403:
+                            refreshed = await link.refresh(url)
+                        if tuner and not refreshed:
+                            tuner.on_status(e.response.status_code)
+                    # What was received is kept, the retry continues after it
+                    await buffer.flush()
+                    # A fresh URL is worth trying at once
+                    if not await self.retry.failure(
+                        "cdn", attempt, e, backoff=not refreshed
+                    ):
+                        if manifest:
+                            await buffer.wait()
+                            manifest.mark(
+                                segment.start,
+                                segment.pos - 1,
+                                segment.hasher and segment.hasher.hexdigest(),
+                            )
+                            manifest.checkpoint()
+                        if scheduler.release(segment):
+                            raise e
+                        # Its hedge twin still covers the range
+                        return
+                    if segment.pos > resumed:
+                        refreshes = 0
+                    # An expired URL is routine, only so many in a row
+                    # without progress use up an attempt
+                    if refreshed and refreshes < self.MAX_URL_REFRESHES:
+                        refreshes += 1
+                    else:
+                        attempt += 1
+            self.metrics.observe_segment(
+                time.monotonic() - segment.started, segment.end - segment.start + 1
+            )
+            loser = scheduler.finish(segment)
+            if loser is not None and loser.task is not None:
+                # The other side of the hedge is cut off mid-stream, its
+                # worker moves on and download_segments records what it got
+                loser.task.cancel()
+            if manifest:
+                # Wait for the disk so the manifest never runs ahead of it
+                await buffer.wait()
+                manifest.mark(
+                    segment.start,
+                    segment.end,
+                    segment.hasher and segment.hasher.hexdigest(),
+                )
+                manifest.checkpoint()
+        finally:
+            if buffer:
+                # Cancelled mid segment, download_segments drains the writer
+                # before recording how far the segment got
+                buffer.flush_nowait()
+
+    async def download_segments(
+        self,
+        link: DownloadLink,
+        headers: dict,
+        scheduler: SegmentScheduler,
+        save_path: str,
+        writer: FileWriter,
+        progress: FileProgress,
+        manifest: DownloadManifest,
+        thread_count: int = 1,
+        tuner: ConnectionTuner = None,
+        hash_segments: bool = False,
+    ) -> None:
+        """Run download_part workers until the scheduler is empty, growing
+        the pool as the tuner asks for more connections."""
+        tasks = set()
+
+        def spawn(hedge: bool = False) -> asyncio.Task:
+            task = asyncio.create_task(
+                self.download_part(
+                    link,
+                    headers,
+                    scheduler,
+                    save_path,
+                    writer,
+                    progress,
+                    manifest=manifest,
+                    tuner=tuner,
+                    hash_segments=hash_segments,
+                    hedge=hedge,
+                )
+            )
+            tasks.add(task)
+            return task
+
+        for _ in range(thread_count):
+            spawn()
+
+        interval = tuner.interval if tuner else None
+        if self.hedge_budget > 0:
+            interval = min(
+                interval or self.HEDGE_CHECK_INTERVAL, self.HEDGE_CHECK_INTERVAL
+            )
+        try:
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, timeout=interval, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    task.result()
+                if self.hedge_budget > 0:
+                    for segment in scheduler.stragglers(
+                        self.hedge_threshold,
+                        int(self.hedge_budget * scheduler.file_size),
+                    ):
+                        scheduler.hedge(segment)
+                        # On a connection of its own, not the straggler's
+                        pending.add(spawn(hedge=True))
+                if not tuner:
+                    continue
+                tuner.sample()
+                # Workers above the target retire on their own, only
+                # growth needs new ones
+                while len(pending) < tuner.target and scheduler.has_work():
+                    pending.add(spawn())
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            # Interrupted segments are recorded up to what they received
+            # once the writer has put it on disk
+            try:
+                await writer.drain()
+            finally:
+                if writer.error is None:
+                    for segment in list(scheduler.active) + scheduler.abandoned:
+                        manifest.mark(
+                            segment.start,
+                            segment.pos - 1,
+                            segment.hasher and segment.hasher.hexdigest(),
+                        )
+                manifest.save()
+                if scheduler.hedges:
+                    self.progress.add_hedges(
+                        scheduler.hedges, scheduler.hedges_won, scheduler.wasted_bytes
+                    )
+                    self.progress.write(
+                        f"对冲请求: {os.path.basename(save_path)}, 发起 {scheduler.hedges} 次, "
+                        f"胜出 {scheduler.hedges_won} 次, 重复下载 {scheduler.wasted_bytes / 1024 / 1024:.2f} MB"
+                    )
+
+    async def verify_download(
+        self, save_path: str, manifest: DownloadManifest, md5: str
+    ) -> list[tuple[int, int]]:
+        """Hash the finished file in a worker thread, returns the ranges to
+        fetch again, empty if it matches. Raises when the file is wrong but
+        no range can be blamed."""
+        (
+            file_md5,
+            mismatched,
+            undigested,
+        ) = await asyncio.get_running_loop().run_in_executor(
+            None, verify_file, save_path, manifest.size, manifest.digest_ranges()
+        )
+        if file_md5 == md5:
+            return []
+        # Ranges that changed on disk are known bad, failing that only the
+        # ranges no digest vouches for are left
+        refetch = mismatched or undigested
+        if not refetch:
+            # Every range is on disk as received, the next run starts over
+            manifest.remove()
+            raise Exception(f"文件校验失败: md5 {file_md5}, 应为 {md5}")
+        return refetch
+
+    async def probe_size(self, download_url: str, save_path: str, headers: dict) -> int:
+        """Ask the server for the size of a file, 0 if it can't tell."""
+        file_size = 0
+        timeout = httpx.Timeout(10.0, connect=10.0)
+        async with self.connection_budget.slot(save_path):
+            try:
+                head_resp = await self.session.head(
+                    download_url, headers=headers, timeout=timeout
+                )
+                # Some servers might not return Content-Length on HEAD, try Range GET
+                # Also if Content-Length is suspiciously small (< 10MB), verify with Range
+                content_length = int(head_resp.headers.get("content-length", 0))
+
+                if (
+                    "content-length" not in head_resp.headers
+                    or content_length < 10 * 1024 * 1024
+                ):
+                    # Try getting first byte
+                    h_range = headers.copy()
+                    h_range["Range"] = "bytes=0-0"
+                    get_resp = await self.session.get(
+                        download_url, headers=h_range, timeout=timeout
+                    )
+                    if "content-range" in get_resp.headers:
+                        # Content-Range: bytes 0-0/123456
+                        file_size = int(
+                            get_resp.headers["content-range"].split("/")[-1]
+                        )
+                        # If Range returns a valid larger size, use it
+                    elif content_length > 0:
+                        file_size = content_length
+                else:
+                    file_size = content_length
+            except Exception as e:
+                # Fallback to simple download if size unknown
+                custom_print(f"获取文件大小失败: {e}", error_msg=True)
+                pass
+        return file_size
+
+    async def download_stream(
+        self,
+        link: DownloadLink,
+        headers: dict,
+        save_path: str,
+        progress: FileProgress,
+        md5: Union[str, None] = None,
+        size: int = 0,
+    ) -> None:
+        """Download the whole file over one connection, for a file of
+        unknown size or a server that ignores Range."""
+        async with self.connection_budget.slot(save_path), self.session.stream(
+            "GET", link.url, headers=headers
+        ) as response:
+            response.raise_for_status()
+            open(save_path, "wb").close()
+            writer = FileWriter(save_path, pool=self.buffer_pool)
+            # Hashed as it streams, there is nothing to re-read later
+            hasher = hashlib.md5() if md5 else None
+            received = 0
+            try:
+                buffer = WriteBuffer(writer, 0, hasher)
+                async for chunk in response.aiter_bytes():
+                    await self.bandwidth_limiter.consume(save_path, len(chunk))
+                    buffer.append(chunk)
+                    received += len(chunk)
+                    progress.update(len(chunk))
+                    if buffer.full:
+                        await buffer.flush()
+                await buffer.flush()
+            finally:
+                await writer.close()
+        if size and received != size:
+            raise Exception(f"文件大小不一致: 收到 {received}, 应为 {size}")
+        if hasher and hasher.hexdigest() != md5:
+            raise Exception(f"文件校验失败: md5 {hasher.hexdigest()}, 应为 {md5}")
 
-    @staticmethod
     async def download_file(
+        self,
         download_url: str,
         save_path: str,
         headers: dict,
         block_size: int = 100,
+        segment_size: int = 16,
         semaphore: asyncio.Semaphore = None,
-        position_queue: asyncio.Queue = None,
+        fid: Union[str, None] = None,
+        updated_at: Union[int, str, None] = None,
+        size: int = 0,
+        md5: Union[str, None] = None,
+        refresh_url: Union[Callable[[], Awaitable[str]], None] = None,
     ) -> None:
+        link = DownloadLink(download_url, refresh_url)
         if semaphore:
             await semaphore.acquire()
 
-        position = None
-        if position_queue:
-            position = await position_queue.get()
-
-        pbar = None
+        name = os.path.basename(save_path)
+        progress = None
+        ok = False
+        # Files and their segments all draw connections from one budget
+        self.connection_budget.register(save_path, self.schedule_policy.weight(size))
         try:
-            # 1. Get Content-Length
-            file_size = 0
-            async with httpx.AsyncClient(verify=False) as client:
-                timeout = httpx.Timeout(10.0, connect=10.0)
-                try:
-                    head_resp = await client.head(
-                        download_url, headers=headers, timeout=timeout
-                    )
-                    # Some servers might not return Content-Length on HEAD, try Range GET
-                    # Also if Content-Length is suspiciously small (< 10MB), verify with Range
-                    content_length = int(head_resp.headers.get("content-length", 0))
+            # 1. The listing already knows the size, probing costs one or two
+            # requests per file and is only the fallback
+            file_size = size
+            if file_size <= 0:
+                file_size = await self.probe_size(link.url, save_path, headers)
 
-                    if (
-                        "content-length" not in head_resp.headers
-                        or content_length < 10 * 1024 * 1024
-                    ):
-                        # Try getting first byte
-                        h_range = headers.copy()
-                        h_range["Range"] = "bytes=0-0"
-                        get_resp = await client.get(
-                            download_url, headers=h_range, timeout=timeout
-                        )
-                        if "content-range" in get_resp.headers:
-                            # Content-Range: bytes 0-0/123456
-                            file_size = int(
-                                get_resp.headers["content-range"].split("/")[-1]
-                            )
-                            # If Range returns a valid larger size, use it
-                        elif content_length > 0:
-                            file_size = content_length
-                    else:
-                        file_size = content_length
-                except Exception as e:
-                    # Fallback to simple download if size unknown
-                    custom_print(f"获取文件大小失败: {e}", error_msg=True)
-                    pass
+            # Only the md5 from file/download can tell a wrong file apart
+            md5 = normalize_md5(md5) if self.verify_downloads else None
 
             # Calculate thread count
             block_size_bytes = block_size * 1024 * 1024
@@ -577,95 +1032,167 @@ class QuarkPanFileManager:
                 # Use ceil to ensure we use extra threads for the remainder
                 # e.g., 440MB / 300MB = 1.46 -> ceil -> 2 threads
                 thread_count = math.ceil(file_size / block_size_bytes)
+                # More workers than the whole budget would only sit waiting
+                thread_count = min(thread_count, self.connection_budget.limit)
 
-            custom_print(
-                f"文件: {os.path.basename(save_path)}, 大小: {file_size / 1024 / 1024:.2f} MB, 块大小: {block_size} MB, 线程数: {thread_count}"
+            self.progress.write(
+                f"文件: {name}, 大小: {file_size / 1024 / 1024:.2f} MB, 块大小: {block_size} MB, 线程数: {thread_count}"
             )
 
-            # Setup Progress Bar
-            tqdm_kwargs = {
-                "unit": "B",
-                "unit_scale": True,
-                "desc": os.path.basename(save_path),
-                "ncols": 80,  # Fixed width to prevent staircase effect
-                "ascii": True,  # Use ASCII characters for better compatibility
-                "leave": False,
-                "total": file_size if file_size > 0 else None,
-                "mininterval": 1.0,  # Update max once per second to reduce spam
-                "file": sys.stdout,  # Use stdout instead of stderr
-            }
-            # Remove position to avoid cursor issues in incompatible terminals
-            # if position is not None:
-            #    tqdm_kwargs["position"] = position
-
-            pbar = tqdm(**tqdm_kwargs)
-
-            # 2. Decide Strategy
-            # If thread_count is 1, use single thread
-            if thread_count == 1:
-                async with httpx.AsyncClient(verify=False) as client:
-                    timeout = httpx.Timeout(60.0, connect=60.0)
-                    async with client.stream(
-                        "GET", download_url, headers=headers, timeout=timeout
-                    ) as response:
-                        with open(save_path, "wb") as f:
-                            async for chunk in response.aiter_bytes():
-                                f.write(chunk)
-                                pbar.update(len(chunk))
+            # 2. Resume from the manifest of an earlier, interrupted run
+            manifest = None
+            ranges = None
+            if file_size > 0:
+                manifest = DownloadManifest.load(save_path, fid, file_size, updated_at)
+                if manifest:
+                    ranges = manifest.missing_ranges()
+                    self.progress.write(
+                        f"断点续传: {name}, 已完成 {manifest.completed_bytes / 1024 / 1024:.2f} MB"
+                    )
+                else:
+                    manifest = DownloadManifest(save_path, fid, file_size, updated_at)
+                # Weighted by what is left, which the probe or the manifest
+                # may only now tell
+                self.connection_budget.register(
+                    save_path,
+                    self.schedule_policy.weight(file_size - manifest.completed_bytes),
+                )
+
+            # The dashboard renders every file, this only counts bytes
+            progress = self.progress.track(
+                name,
+                max(file_size, 0),
+                manifest.completed_bytes if ranges is not None else 0,
+            )
+
+            # 3. Decide Strategy
+            # Without a known size ranges can't be planned, use a single stream
+            if file_size <= 0:
+                await self.download_stream(link, headers, save_path, progress, md5)
             else:
-                # 3. Multi-part Download
-                # Create placeholder file
-                with open(save_path, "wb") as f:
-                    f.truncate(file_size)
-
-                # Ensure minimum part size (e.g., 10MB) to avoid too many small threads
-                # Although we used block_size to calculate thread count, so threads shouldn't be too many.
-                # Just use simple division for now as requested.
-                part_size = file_size // thread_count
-                tasks = []
-                pbar_lock = asyncio.Lock()  # Lock for pbar updates
-                for i in range(thread_count):
-                    start = i * part_size
-                    if i == thread_count - 1:
-                        end = file_size - 1
-                    else:
-                        end = (i + 1) * part_size - 1
+                # 4. Multi-part Download
+                if ranges is None:
+                    # Create placeholder file
+                    with open(save_path, "wb") as f:
+                        f.truncate(file_size)
+                    manifest.save()
+
+                # Probed once per host, cached in the host profile
+                await self.host_selector.prepare(link.url, headers)
+
+                # Many small segments on a queue, each worker holds one
+                # connection and steals from the slowest when it runs dry
+                scheduler = SegmentScheduler(
+                    file_size, segment_size * 1024 * 1024, ranges=ranges
+                )
+                tuner = None
+                host = urlsplit(link.url).netloc
+                if self.adaptive_connections:
+                    # Start from what this host settled on last time
+                    initial = self.host_profile.get(
+                        host, "connections", thread_count, ttl=self.HOST_PROFILE_TTL
+                    )
+                    tuner = ConnectionTuner(
+                        initial,
+                        min(
+                            self.connection_budget.limit,
+                            math.ceil(file_size / (segment_size * 1024 * 1024)),
+                        ),
+                    )
+                    thread_count = tuner.target
 
-                    task = asyncio.create_task(
-                        QuarkPanFileManager.download_part(
-                            download_url,
+                # Network coroutines only fill buffers, disk writes happen
+                # in the writer thread
+                writer = FileWriter(save_path, pool=self.buffer_pool)
+                unranged = None
+                try:
+                    try:
+                        await self.download_segments(
+                            link,
                             headers,
-                            start,
-                            end,
+                            scheduler,
                             save_path,
-                            pbar,
-                            pbar_lock=pbar_lock,
+                            writer,
+                            progress,
+                            manifest,
+                            thread_count=thread_count,
+                            tuner=tuner,
+                            hash_segments=bool(md5),
                         )
+                    except RangeNotSupported as e:
+                        # Streamed again from the start once the writer is done
+                        unranged = e
+                    if tuner and not unranged:
+                        target = tuner.target
+                        capped = tuner.maximum < self.connection_budget.limit
+                        if capped and target >= tuner.maximum:
+                            # Capped by the file's segment count, it says
+                            # nothing about the host beyond that many
+                            saved = self.host_profile.get(
+                                host, "connections", 0, ttl=self.HOST_PROFILE_TTL
+                            )
+                            target = max(saved, target)
+                        self.host_profile.set(host, "connections", target)
+                    refetch = (
+                        await self.verify_download(save_path, manifest, md5)
+                        if md5 and not unranged
+                        else []
+                    )
+                    if refetch:
+                        self.progress.write(
+                            f"文件校验失败: {name}, 重新下载 {len(refetch)} 个分段"
+                        )
+                        for start, end in refetch:
+                            manifest.discard(start, end)
+                            progress.update(-(end - start + 1))
+                        manifest.save()
+                        scheduler = SegmentScheduler(
+                            file_size, segment_size * 1024 * 1024, ranges=refetch
+                        )
+                        await self.download_segments(
+                            link,
+                            headers,
+                            scheduler,
+                            save_path,
+                            writer,
+                            progress,
+                            manifest,
+                            thread_count=tuner.target if tuner else thread_count,
+                            tuner=tuner,
+                            hash_segments=True,
+                        )
+                        if await self.verify_download(save_path, manifest, md5):
+                            raise Exception("文件校验失败: 重新下载后仍不一致")
+                finally:
+                    await writer.close()
+                manifest.remove()
+                if unranged:
+                    self.progress.write(f"{unranged}, 改为单线程下载: {name}")
+                    # Whatever the segments got is thrown away
+                    progress.update(-progress.done)
+                    await self.download_stream(
+                        link, headers, save_path, progress, md5, size=file_size
                     )
-                    tasks.append(task)
-
-                await asyncio.gather(*tasks)
 
-            if position is not None:
-                tqdm.write(f"下载完成: {os.path.basename(save_path)}")
+            ok = True
+            self.progress.write(f"下载完成: {name}")
 
         except Exception as e:
-            tqdm.write(f"下载失败 {os.path.basename(save_path)}: {e}")
+            self.progress.write(f"下载失败 {name}: {e}")
             # Clean up failed file? Maybe not, allow resume later?
             # os.remove(save_path)
             raise e
         finally:
-            if pbar:
-                pbar.close()
-            if position is not None and position_queue:
-                position_queue.put_nowait(position)
+            self.connection_budget.unregister(save_path)
+            self.bandwidth_limiter.forget(save_path)
+            if progress is not None:
+                self.progress.close(progress, ok)
             if semaphore:
                 semaphore.release()
 
-    async def quark_file_download(
-        self, fids: list[str], folder: str = "", folders_map=None
-    ) -> None:
-        folders_map = folders_map or {}
+    async def get_download_urls(self, fids: list[str]) -> list[dict[str, Any]]:
+        """Resolve fids to file/download entries, each with a signed
+        download_url that is only valid for a limited time."""
         params = {
             "pr": "ucpro",
             "fr": "pc",
@@ -702,140 +1229,267 @@ class QuarkPanFileManager:
         # - Cancel Share: POST https://drive-pc.quark.cn/1/clouddrive/share/delete (Inferred from file/delete pattern)
 
         for _ in range(2):
-            async with httpx.AsyncClient(verify=False) as client:
-                timeout = httpx.Timeout(60.0, connect=60.0)
-                response = await client.post(
-                    download_api,
-                    json=data,
-                    headers=headers,
-                    params=params,
-                    timeout=timeout,
+            response = await self.session.post(
+                download_api,
+                json=data,
+                headers=headers,
+                params=params,
+            )
+            json_data = response.json()
+
+            if json_data.get("code") == 23018:
+                self.metrics.retry("file/download")
+                headers["User-Agent"] = (
+                    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
+                    "(KHTML, like Gecko) quark-cloud-drive/2.5.56 Chrome/100.0.4896.160 "
+                    "Electron/18.3.5.12-a038f7b798 Safari/537.36 Channel/pckk_other_ch"
                 )
-                json_data = response.json()
+                continue
 
-                if json_data.get("code") == 23018:
-                    headers["User-Agent"] = (
-                        "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
-                        "(KHTML, like Gecko) quark-cloud-drive/2.5.56 Chrome/100.0.4896.160 "
-                        "Electron/18.3.5.12-a038f7b798 Safari/537.36 Channel/pckk_other_ch"
-                    )
-                    continue
+            if json_data["status"] != 200:
+                custom_print(
+                    f"文件下载地址列表获取失败, {json_data['message']}",
+                    error_msg=True,
+                )
+                return []
+            custom_print(f"文件下载地址列表获取成功 ({len(fids)} 个)")
+            return json_data.get("data") or []
+        return []
+
+    async def refresh_download_url(self, fid: str) -> str:
+        items = await self.get_download_urls([fid])
+        if not items or not items[0].get("download_url"):
+            raise Exception(f"刷新下载地址失败: {fid}")
+        return items[0]["download_url"]
+
+    async def download_item(
+        self,
+        item: dict[str, Any],
+        folders_map: dict[str, dict[str, str]],
+    ) -> None:
+        """Download one file/download entry below save_folder, at the path
+        the crawler recorded or else mirroring its folders from folders_map."""
+        filename = item["file_name"]
+
+        # build save path start
+        if item.get("path"):
+            save_path = os.path.join(self.save_folder, *item["path"].split("/"))
+            final_save_folder = os.path.dirname(save_path)
+        else:
+            base_path = ""
+            if "pdir_fid" in item:
+                pdir_fid = item["pdir_fid"]
+                while pdir_fid in folders_map:
+                    base_path = "/" + folders_map[pdir_fid]["file_name"] + base_path
+                    pdir_fid = folders_map[pdir_fid]["pdir_fid"]
+            final_save_folder = f"{self.save_folder}/{base_path}"
+            save_path = os.path.join(final_save_folder, filename)
+        os.makedirs(final_save_folder, exist_ok=True)
+        # build save path stop
 
-                data_list = json_data.get("data", None)
-                if json_data["status"] != 200:
-                    custom_print(
-                        f"文件下载地址列表获取失败, {json_data['message']}",
-                        error_msg=True,
+        headers = {
+            "user-agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, "
+            "like Gecko) Chrome/143.0.0.0 Safari/537.36 Edg/143.0.0.0",
+            "origin": "https://pan.quark.cn",
+            "referer": "https://pan.quark.cn/",
+            "cookie": self.cookies,
+        }
+        fid = item.get("fid")
+
+        async def refresh_url() -> str:
+            return await self.refresh_download_url(fid)
+
+        await self.download_file(
+            item["download_url"],
+            save_path,
+            headers,
+            block_size=self.block_size,
+            segment_size=self.segment_size,
+            fid=fid,
+            updated_at=item.get("updated_at"),
+            size=item.get("size") or 0,
+            md5=item.get("md5"),
+            refresh_url=refresh_url if fid else None,
+        )
+        if self.sync_state is not None and item.get("path"):
+            # Keyed by what the share listed, which is what the next run compares
+            self.sync_state.update(item["path"], item.get("source") or item)
+
+    async def download_pipeline(
+        self,
+        records: AsyncIterator[dict[str, Any]],
+        folders_map: Union[dict[str, dict[str, str]], None] = None,
+    ) -> int:
+        """Resolve download URLs batch by batch just ahead of the downloads.
+        records need a fid, their other fields (path, size...) are kept
+        unless file/download returns newer values. Returns how many files
+        failed, also added to failed_downloads.
+
+        URLs are signed and expire, so only about one batch is resolved
+        before a download worker is free for it. The first batch is sent as
+        soon as a fid is known, later ones take whatever queued up. Every
+        queue is bounded, a slow download holds back the listing."""
+        folders_map = folders_map if folders_map is not None else {}
+        os.makedirs(self.save_folder, exist_ok=True)
+        pending: asyncio.Queue = asyncio.Queue(maxsize=self.download_batch_size)
+        # The schedule policy picks which resolved file starts next, ties
+        # and unknown sizes keep the listing order
+        resolved: asyncio.PriorityQueue = asyncio.PriorityQueue(
+            maxsize=self.download_batch_size
+        )
+        order = itertools.count()
+        end = (math.inf, math.inf, None)
+        count = failed = 0
+
+        # A failing stage fails the gather below, which cancels the others,
+        # so the end markers are only needed on success
+        async def feed() -> None:
+            async for record in records:
+                await pending.put(record)
+            await pending.put(None)
+
+        async def resolve() -> None:
+            nonlocal count, failed
+            while True:
+                record = await pending.get()
+                if record is None:
+                    break
+                batch = {record["fid"]: record}
+                while len(batch) < self.download_batch_size and not pending.empty():
+                    record = pending.get_nowait()
+                    if record is None:
+                        break
+                    batch[record["fid"]] = record
+                try:
+                    items = await self.retry.call(
+                        "file/download",
+                        lambda: self.get_download_urls(list(batch)),
                     )
-                    return
-                elif data_list:
-                    custom_print("文件下载地址列表获取成功")
+                except Exception as e:
+                    # Out of retries, the files still being downloaded and
+                    # the later batches go on
+                    custom_print(f"文件下载地址列表获取失败, {e}", error_msg=True)
+                    items = []
+                # A failed batch is empty, its files never reach a worker
+                # and fail here
+                missing = len(batch.keys() - {item.get("fid") for item in items})
+                count += missing
+                failed += missing
+                for item in items:
+                    item = {**batch.get(item.get("fid"), {}), **item}
+                    size = item.get("size") or 0
+                    self.progress.expect(size)
+                    await resolved.put(
+                        (self.schedule_policy.priority(size), next(order), item)
+                    )
+                if record is None:
+                    break
+            await resolved.put(end)
 
-                    save_folder = self.save_folder
-                os.makedirs(save_folder, exist_ok=True)
-                n = 0
+        # A fixed pool of workers, memory stays flat however many files
+        custom_print(
+            f"开始下载，同时下载数: {self.concurrent_files}，单文件块大小: {self.block_size}MB"
+        )
 
-                # Limit concurrent files to 3 to avoid overwhelming the system/display
-                MAX_CONCURRENT_FILES = self.concurrent_files
-                semaphore = asyncio.Semaphore(MAX_CONCURRENT_FILES)
-                position_queue = asyncio.Queue()
-                for i in range(MAX_CONCURRENT_FILES):
-                    position_queue.put_nowait(i)
+        async def work() -> None:
+            nonlocal count, failed
+            while True:
+                _, _, item = await resolved.get()
+                if item is None:
+                    # Pass the end marker on to the next worker
+                    resolved.put_nowait(end)
+                    return
+                count += 1
+                try:
+                    await self.download_item(item, folders_map)
+                except Exception:
+                    # Already reported by download_file
+                    failed += 1
+
+        tasks = [asyncio.create_task(feed()), asyncio.create_task(resolve())]
+        tasks += [asyncio.create_task(work()) for _ in range(self.concurrent_files)]
+        self.progress.reset()
+        background = [
+            asyncio.create_task(self.watch_config()),
+            asyncio.create_task(self.progress.run()),
+        ]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks + background:
+                task.cancel()
+            await asyncio.gather(*tasks, *background, return_exceptions=True)
 
-                tasks = []
-                custom_print(
-                    f"开始批量下载 {len(data_list)} 个文件，同时下载数: {MAX_CONCURRENT_FILES}，单文件块大小: {self.block_size}MB"
-                )
+        self.failed_downloads += failed
+        if failed:
+            custom_print(
+                f"{failed}/{count} 个文件下载失败，重新运行可断点续传",
+                error_msg=True,
+            )
+        return failed
 
-                for i in data_list:
-                    n += 1
-                    filename = i["file_name"]
-                    # custom_print(f'开始下载第{n}个文件-{filename}')
-
-                    # build save path start
-                    base_path = ""
-                    if "pdir_fid" in i:
-                        pdir_fid = i["pdir_fid"]
-                        while pdir_fid in folders_map:
-                            base_path = (
-                                "/" + folders_map[pdir_fid]["file_name"] + base_path
-                            )
-                            pdir_fid = folders_map[pdir_fid]["pdir_fid"]
-                    final_save_folder = f"{save_folder}/{base_path}"
-                    os.makedirs(final_save_folder, exist_ok=True)
-                    # build save path stop
-
-                    download_url = i["download_url"]
-                    save_path = os.path.join(final_save_folder, filename)
-                    headers = {
-                        "user-agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, "
-                        "like Gecko) Chrome/143.0.0.0 Safari/537.36 Edg/143.0.0.0",
-                        "origin": "https://pan.quark.cn",
-                        "referer": "https://pan.quark.cn/",
-                        "cookie": self.cookies,
-                    }
-                    task = asyncio.create_task(
-                        self.download_file(
-                            download_url,
-                            save_path,
-                            headers,
-                            block_size=self.block_size,
-                            semaphore=semaphore,
-                            position_queue=position_queue,
-                        )
-                    )
-                    tasks.append(task)
+    async def quark_file_download(
+        self, fids: list[str], folder: str = "", folders_map=None
+    ) -> int:
+        async def iterate() -> AsyncIterator[dict[str, Any]]:
+            for fid in fids:
+                yield {"fid": fid}
 
-                if tasks:
-                    await asyncio.gather(*tasks, return_exceptions=True)
-            return
+        return await self.download_pipeline(iterate(), folders_map)
+
+    async def get_task(self, task_id: str, retry_index: int = 0) -> dict[str, Any]:
+        params = {
+            "pr": "ucpro",
+            "fr": "pc",
+            "uc_param_str": "",
+            "task_id": task_id,
+            "retry_index": str(retry_index),
+            "__dt": random.randint(100, 9999),
+            "__t": get_timestamp(13),
+        }
+        response = await self.session.get(
+            "https://drive-pc.quark.cn/1/clouddrive/task",
+            params=params,
+            headers=self.headers,
+        )
+        return response.json()
 
     async def submit_task(self, task_id: str, retry: int = 50) -> bool | dict:
 
-        for i in range(retry):
-            await asyncio.sleep(random.randint(500, 1000) / 1000)
-            custom_print(f"第{i + 1}次提交任务")
-            submit_url = (
-                f"https://drive-pc.quark.cn/1/clouddrive/task?pr=ucpro&fr=pc&uc_param_str=&task_id={task_id}"
-                f"&retry_index={i}&__dt=21192&__t={get_timestamp(13)}"
-            )
+        def settled(json_data: dict[str, Any]) -> bool:
+            return json_data["message"] != "ok" or json_data["data"]["status"] == 2
 
-            async with httpx.AsyncClient(verify=False) as client:
-                timeout = httpx.Timeout(60.0, connect=60.0)
-                response = await client.get(
-                    submit_url, headers=self.headers, timeout=timeout
-                )
-                json_data = response.json()
+        custom_print(f"等待转存任务完成：{task_id}")
+        json_data = await self.task_tracker.wait(task_id, settled, retry)
+        if json_data is None:
+            custom_print(f"转存任务超时：{task_id}", error_msg=True)
+            return None
 
-            if json_data["message"] == "ok":
-                if json_data["data"]["status"] == 2:
-                    custom_print(f"DEBUG: submit_task response: {json_data}")
-                    if "to_pdir_name" in json_data["data"]["save_as"]:
-                        folder_name = json_data["data"]["save_as"]["to_pdir_name"]
-                    else:
-                        folder_name = " 根目录"
-                    if json_data["data"]["task_title"] == "分享-转存":
-                        custom_print(f"结束任务ID：{task_id}")
-                        custom_print(f"文件保存位置：{folder_name} 文件夹")
-                    return json_data
+        if json_data["message"] == "ok":
+            custom_print(f"DEBUG: submit_task response: {json_data}")
+            if "to_pdir_name" in json_data["data"]["save_as"]:
+                folder_name = json_data["data"]["save_as"]["to_pdir_name"]
             else:
-                if (
-                    json_data["code"] == 32003
-                    and "capacity limit" in json_data["message"]
-                ):
-                    custom_print(
-                        "转存失败，网盘容量不足！请注意当前已成功保存的个数，避免重复保存",
-                        error_msg=True,
-                    )
-                elif json_data["code"] == 41013:
-                    custom_print(
-                        f"”{to_dir_name}“ 网盘文件夹不存在，请重新运行按3切换保存目录后重试！",
-                        error_msg=True,
-                    )
-                else:
-                    custom_print(f"错误信息：{json_data['message']}", error_msg=True)
-                input(f"[{get_datetime()}] 已退出程序")
-                sys.exit()
+                folder_name = " 根目录"
+            if json_data["data"]["task_title"] == "分享-转存":
+                custom_print(f"结束任务ID：{task_id}")
+                custom_print(f"文件保存位置：{folder_name} 文件夹")
+            return json_data
+        else:
+            if json_data["code"] == 32003 and "capacity limit" in json_data["message"]:
+                custom_print(
+                    "转存失败，网盘容量不足！请注意当前已成功保存的个数，避免重复保存",
+                    error_msg=True,
+                )
+            elif json_data["code"] == 41013:
+                custom_print(
+                    f"”{to_dir_name}“ 网盘文件夹不存在，请重新运行按3切换保存目录后重试！",
+                    error_msg=True,
+                )
+            else:
+                custom_print(f"错误信息：{json_data['message']}", error_msg=True)
+            input(f"[{get_datetime()}] 已退出程序")
+            sys.exit()
 
     async def one_click_download_pipeline(self, share_url: str) -> None:
         # Check if the share link belongs to the current user
@@ -863,6 +1517,14 @@ class QuarkPanFileManager:
 
         # Use a random temp directory name to avoid "Content Violation" flags
         self.TEMP_DIR_NAME = f"_Download_{generate_random_code()}"
+
+        sync_source = None
+        if self.sync:
+            # Compare before saving anything, an unchanged share costs only
+            # its listing
+            sync_source = await self.compare_share(share_url)
+            if sync_source is None:
+                return
         custom_print(f"=== 步骤0: 准备临时目录 {self.TEMP_DIR_NAME} ===")
 
         # 0. Check and create temp dir (search for any old temp dirs and clean if possible, but focus on new one)
@@ -894,37 +1556,18 @@ class QuarkPanFileManager:
             target_fid = saved_fid if saved_fid else temp_dir_fid
 
             custom_print("\n=== 步骤2: 批量生成分享链接 ===")
-            # Step 2: Share
-            max_retries = 3
-            share_success = False
-            for i in range(max_retries):
-                try:
-                    shares = await self.share_run(
-                        share_url="",
-                        folder_id=target_fid,
-                        fid=target_fid,
-                        url_type=1,
-                        expired_type=2,
-                        traverse_depth=0,
-                    )
-                    if shares:
-                        created_shares.extend(shares)
-                        share_success = True
-                        break
-                    else:
-                        raise Exception("生成的分享ID列表为空")
-                except Exception as e:
-                    custom_print(
-                        f"分享失败 (尝试 {i+1}/{max_retries}): {e}", error_msg=True
-                    )
-                    if i < max_retries - 1:
-                        wait_time = 2 * (i + 1)
-                        custom_print(f"等待 {wait_time} 秒后重试...")
-                        await asyncio.sleep(wait_time)
-                    else:
-                        custom_print("多次尝试分享失败，跳过。", error_msg=True)
+            # Step 2: Share, create_share retries it with backoff
+            shares = await self.share_run(
+                share_url="",
+                folder_id=target_fid,
+                fid=target_fid,
+                url_type=1,
+                expired_type=2,
+                traverse_depth=0,
+            )
+            created_shares.extend(shares)
 
-            if not share_success:
+            if not shares:
                 custom_print("无法生成有效的分享链接，终止下载流程。", error_msg=True)
                 sys.exit(104)  # Exit code 104: Share Creation Failed
 
@@ -942,7 +1585,12 @@ class QuarkPanFileManager:
                         # For downloading, the save path structure is handled internally,
                         # but passing temp_dir_fid keeps context if needed
                         # Note: run(download=True) relies on quark_file_download which might raise exceptions
-                        await self.run(url.strip(), temp_dir_fid, download=True)
+                        await self.run(
+                            url.strip(),
+                            temp_dir_fid,
+                            download=True,
+                            sync_source=sync_source,
+                        )
 
                     # Mark as success if we get here without exception
                     download_success = True
@@ -996,6 +1644,113 @@ class QuarkPanFileManager:
                         "由于下载已成功，忽略清理错误，正常退出。", error_msg=True
                     )
 
+    async def compare_share(
+        self, share_url: str
+    ) -> Union[tuple[str, dict[str, dict[str, Any]], str], None]:
+        """List a share someone else owns and compare it with the sync state.
+
+        Returns the sync_source for download_crawl, whose copy of the share
+        is listed below the temp folder, or None if nothing changed."""
+        pwd_id = self.get_pwd_id(share_url).split("#")[0]
+        match_password = re.search("pwd=(.*?)(?=$|&)", share_url)
+        password = match_password.group(1) if match_password else ""
+        stoken = await self.get_stoken(pwd_id, password)
+        if not stoken:
+            raise Exception("获取分享 stoken 失败，无法比较")
+
+        state = SyncState(self.save_folder, pwd_id)
+        crawler = ShareCrawler(self, pwd_id, stoken, concurrency=self.crawl_concurrency)
+        sources: dict[str, dict[str, Any]] = {}
+        async for record in crawler.crawl():
+            sources[record["path"]] = record
+        changed = sum(not state.unchanged(path, r) for path, r in sources.items())
+        if changed:
+            custom_print(f"同步: {changed}/{len(sources)} 个文件需要下载")
+            return pwd_id, sources, self.TEMP_DIR_NAME
+
+        if self.sync_delete:
+            self.delete_removed(state, set(sources))
+        custom_print(f"同步: 分享中 {len(sources)} 个文件均未变化，无需下载")
+        return None
+
+    async def list_share(
+        self, share_url: str
+    ) -> tuple[int, dict[str, tuple[Any, int, Any]]]:
+        """is_owner and a snapshot of the share, (fid, size, updated_at) by
+        the path of every file."""
+        pwd_id = self.get_pwd_id(share_url).split("#")[0]
+        match_password = re.search("pwd=(.*?)(?=$|&)", share_url)
+        password = match_password.group(1) if match_password else ""
+        stoken = await self.get_stoken(pwd_id, password)
+        if not stoken:
+            raise Exception("获取分享 stoken 失败")
+        is_owner, entries = await self.get_detail(pwd_id, stoken)
+        crawler = ShareCrawler(self, pwd_id, stoken, concurrency=self.crawl_concurrency)
+        snapshot = {}
+        async for record in crawler.crawl(entries):
+            snapshot[record["path"]] = (
+                record["fid"],
+                record["size"],
+                record.get("updated_at"),
+            )
+        return is_owner, snapshot
+
+    async def watch(
+        self, share_url: str, min_interval: float = 60.0, max_interval: float = 3600.0
+    ) -> None:
+        """Poll a share and download what changed, until cancelled.
+
+        Each poll only lists the share. When the listing differs from the
+        previous one a sync run downloads the new and changed files, for
+        a share of someone else through the one-click pipeline. The
+        interval doubles while nothing changes or polls fail, up to
+        max_interval, and drops back to min_interval after a change. The
+        manager and its connection pool are reused across polls.
+
+        A round in which any file failed keeps the previous listing, so
+        the next poll tries again, after the same backoff as a failed
+        poll. Sync mode skips the files that did finish."""
+        self.sync = True
+        interval = min_interval
+        snapshot = None
+        custom_print(f"监控模式启动: {share_url}")
+        while True:
+            changed = False
+            try:
+                is_owner, current = await self.list_share(share_url)
+                if current != snapshot:
+                    if snapshot is not None:
+                        added = len(current.keys() - snapshot.keys())
+                        custom_print(
+                            f"监控: 分享有变化 (新增 {added}，共 {len(current)} 个文件)"
+                        )
+                    failed = self.failed_downloads
+                    if is_owner == 1:
+                        await self.run(share_url, self.pdir_id, download=True)
+                    else:
+                        await self.one_click_download_pipeline(share_url)
+                    failed = self.failed_downloads - failed
+                    if failed:
+                        custom_print(
+                            f"监控: 本轮 {failed} 个文件下载失败，稍后重试",
+                            error_msg=True,
+                        )
+                    else:
+                        changed = True
+                        snapshot = current
+            except SystemExit as e:
+                # The one-click pipeline exits on failure, a watch keeps going
+                custom_print(f"监控: 本轮下载失败 (退出码 {e.code})", error_msg=True)
+            except Exception as e:
+                custom_print(f"监控: 检查分享失败: {e}", error_msg=True)
+
+            if changed:
+                interval = min_interval
+            else:
+                interval = min(interval * 2, max_interval)
+            custom_print(f"监控: {interval:.0f} 秒后再次检查")
+            await asyncio.sleep(interval)
+
     def parse_size(self, size_str: Union[str, int]) -> int:
         """Parse size string with units (MB, GB) to MB integer."""
         if isinstance(size_str, int):
@@ -1017,6 +1772,107 @@ class QuarkPanFileManager:
             return value * 1024
         return value
 
+    def apply_bandwidth_config(self, cfg: dict[str, Any]) -> None:
+        if self.limit_override is not None:
+            # --limit wins over both limit and limit_schedule, also after
+            # config.json is edited
+            self.bandwidth_limiter.configure(self.limit_override, [])
+            return
+        try:
+            rate = parse_rate(cfg.get("limit"))
+            schedule = parse_schedule(cfg.get("limit_schedule"))
+        except (ValueError, KeyError, TypeError) as e:
+            custom_print(f"限速配置无效，已忽略: {e}", error_msg=True)
+            return
+        self.bandwidth_limiter.configure(rate, schedule)
+
+    def apply_progress_config(self, cfg: dict[str, Any]) -> None:
+        mode = self.progress_override or cfg.get("progress", "text")
+        if mode not in ProgressDashboard.MODES:
+            custom_print(f"进度显示模式无效，已忽略: {mode}", error_msg=True)
+            mode = "text"
+        self.progress.mode = mode
+        self.progress.interval = (
+            max(int(cfg.get("progress_interval", 1000)), 100) / 1000
+        )
+
+    async def serve_metrics(self) -> Union[asyncio.base_events.Server, None]:
+        if not self.metrics_port:
+            return None
+        try:
+            server = await self.metrics.serve(self.metrics_port, self.metrics_host)
+        except OSError as e:
+            custom_print(f"指标端口 {self.metrics_port} 监听失败: {e}", error_msg=True)
+            return None
+        custom_print(
+            f"Prometheus 指标: http://{self.metrics_host}:{self.metrics_port}/metrics"
+        )
+        return server
+
+    def report_metrics(self, path: str = "output/metrics.json") -> None:
+        """Save the request metrics and print where the time went."""
+        self.metrics.save(path)
+        snapshot = self.metrics.snapshot()
+        if self.progress.mode == "json":
+            self.progress.out.write(
+                json.dumps(
+                    {"metrics": snapshot, "rates": self.rate_limiter.rates()},
+                    ensure_ascii=False,
+                )
+                + "\n"
+            )
+            self.progress.out.flush()
+            return
+        # Slowest in total first
+        endpoints = sorted(
+            snapshot["endpoints"].items(),
+            key=lambda e: -(e[1]["latency"]["avg"] or 0) * e[1]["requests"],
+        )
+        rates = self.rate_limiter.rates()
+        for name, stats in endpoints:
+            latency = stats["latency"]
+            failed = sum(stats["errors"].values()) + sum(
+                n for status, n in stats["statuses"].items() if int(status) >= 400
+            )
+            codes = ", ".join(
+                f"{code}×{n}" for code, n in stats["codes"].items() if code != "0"
+            )
+            custom_print(
+                f"请求统计 {name}: {stats['requests']} 次, "
+                f"平均 {(latency['avg'] or 0) * 1000:.0f} ms, p99 ≤ {latency['p99']} s, "
+                f"失败 {failed}, 重试 {stats['retries']}"
+                + (f", 错误码 {codes}" if codes else "")
+                + (f", 速率 {rates[name]}/s" if name in rates else "")
+            )
+        segments = snapshot["segments"]
+        if segments["count"]:
+            custom_print(
+                f"分段统计: {segments['count']} 个, 平均 {segments['avg']} s, "
+                f"p99 ≤ {segments['p99']} s"
+            )
+        custom_print(f"请求统计已保存至 {path}")
+
+    async def watch_config(self, interval: float = 2.0) -> None:
+        """Apply edits to the limits in config.json while downloads run."""
+        path = f"{CONFIG_DIR}/config.json"
+        while True:
+            try:
+                mtime = os.path.getmtime(path)
+                if self.config_mtime is None:
+                    self.config_mtime = mtime
+                elif mtime != self.config_mtime:
+                    self.config_mtime = mtime
+                    self.apply_bandwidth_config(read_config(path, "json"))
+                    rate = self.bandwidth_limiter.rate
+                    custom_print(
+                        f"配置已更新，当前限速: {rate / 1024 / 1024:.2f} MB/s"
+                        if rate
+                        else "配置已更新，当前不限速"
+                    )
+            except (OSError, ValueError):
+                pass
+            await asyncio.sleep(interval)
+
     def init_config(self, _user, _pdir_id, _dir_name):
         try:
             os.makedirs("output", exist_ok=True)
@@ -1029,6 +1885,54 @@ class QuarkPanFileManager:
                 raw_block_size = cfg.get("block_size", 100)
                 self.block_size = self.parse_size(raw_block_size)
                 self.concurrent_files = cfg.get("concurrent_files", 3)
+                self.segment_size = self.parse_size(cfg.get("segment_size", 16))
+                self.crawl_concurrency = int(cfg.get("crawl_concurrency", 8))
+                self.download_batch_size = max(
+                    int(cfg.get("download_batch_size", 50)), 1
+                )
+                self.page_concurrency = int(cfg.get("page_concurrency", 4))
+                if cfg.get("page_size"):
+                    self.detail_page_size = self.sort_page_size = int(cfg["page_size"])
+                self.connection_budget.limit = max(
+                    int(cfg.get("max_connections", 16)), 1
+                )
+                self.adaptive_connections = bool(cfg.get("adaptive_connections", True))
+                self.verify_downloads = bool(cfg.get("verify_downloads", True))
+                self.host_selector.enabled = bool(cfg.get("cdn_selection", True))
+                self.host_selector.ttl = float(cfg.get("cdn_probe_ttl", 3600))
+                self.host_selector.alternates = cfg.get("cdn_alternates") or {}
+                self.hedge_threshold = max(float(cfg.get("hedge_threshold", 3.0)), 1.0)
+                self.hedge_budget = max(float(cfg.get("hedge_budget", 0.1)), 0.0)
+                try:
+                    self.retry.configure(cfg.get("retry") or {})
+                except (AttributeError, TypeError, ValueError) as e:
+                    custom_print(f"重试配置无效，已忽略: {e}", error_msg=True)
+                self.task_tracker.rate = max(float(cfg.get("task_poll_rate", 5.0)), 0.1)
+                try:
+                    self.rate_limiter.configure(cfg.get("rate_limit", {}))
+                except (AttributeError, TypeError, ValueError) as e:
+                    custom_print(f"接口速率配置无效，已忽略: {e}", error_msg=True)
+                self.metrics_port = int(cfg.get("metrics_port", 0))
+                self.metrics_host = cfg.get("metrics_host", "127.0.0.1")
+                try:
+                    self.schedule_policy = get_schedule_policy(
+                        cfg.get("schedule_policy", "balanced")
+                    )
+                except ValueError as e:
+                    custom_print(f"{e}，已使用 balanced", error_msg=True)
+                self.apply_progress_config(cfg)
+                self.apply_bandwidth_config(cfg)
+                # The --sync flags can only switch these on
+                self.sync = self.sync or bool(cfg.get("sync", False))
+                self.sync_delete = self.sync_delete or bool(
+                    cfg.get("sync_delete", False)
+                )
+                self.session.configure(
+                    http2=bool(cfg.get("http2", False)),
+                    max_host_connections=int(cfg.get("max_host_connections", 16)),
+                    # Room for the whole download budget plus API calls
+                    max_connections=max(64, self.connection_budget.limit + 16),
+                )
                 updated = False
                 if "thread_count" in cfg:
                     del cfg["thread_count"]
@@ -1123,10 +2027,9 @@ class QuarkPanFileManager:
                 )
 
             elif len(pdir_id) < 32:
-                file_list_data = await self.get_sorted_file_list(
+                fd_list = await self.get_all_sorted_files(
                     sort="file_type:asc,file_name:asc"
                 )
-                fd_list = file_list_data["data"]["list"]
                 fd_list = [{i["fid"]: i["file_name"]} for i in fd_list if i.get("dir")]
                 if fd_list:
                     table = PrettyTable(["序号", "文件夹ID", "文件夹名称"])
@@ -1185,67 +2088,43 @@ class QuarkPanFileManager:
             "uc_param_str": "",
         }
 
-        async with httpx.AsyncClient(verify=False) as client:
-            timeout = httpx.Timeout(60.0, connect=60.0)
-            response = await client.post(
-                "https://drive-pc.quark.cn/1/clouddrive/share",
-                params=params,
-                json=json_data,
-                headers=self.headers,
-                timeout=timeout,
-            )
-            json_data = response.json()
-            if json_data.get("status") != 200 or not json_data.get("data"):
-                custom_print(f"创建分享任务失败: {json_data}", error_msg=True)
-                raise Exception(f"Create share task failed: {json_data.get('message')}")
-            return json_data["data"]["task_id"]
+        response = await self.session.post(
+            "https://drive-pc.quark.cn/1/clouddrive/share",
+            params=params,
+            json=json_data,
+            headers=self.headers,
+        )
+        json_data = response.json()
+        if json_data.get("status") != 200 or not json_data.get("data"):
+            custom_print(f"创建分享任务失败: {json_data}", error_msg=True)
+            raise Exception(f"Create share task failed: {json_data.get('message')}")
+        return json_data["data"]["task_id"]
 
     async def get_share_id(self, task_id: str) -> str:
-        for i in range(20):  # Retry loop for async task completion
-            params = {
-                "pr": "ucpro",
-                "fr": "pc",
-                "uc_param_str": "",
-                "task_id": task_id,
-                "retry_index": str(i),
-            }
-            async with httpx.AsyncClient(verify=False) as client:
-                timeout = httpx.Timeout(60.0, connect=60.0)
-                response = await client.get(
-                    "https://drive-pc.quark.cn/1/clouddrive/task",
-                    params=params,
-                    headers=self.headers,
-                    timeout=timeout,
-                )
-                json_data = response.json()
-                data = json_data.get("data", {})
-
-                if not data:
-                    await asyncio.sleep(1)
-                    continue
 
-                # Status 2 seems to be success for tasks
-                if "share_id" in data:
-                    return data["share_id"]
-
-                status = data.get("status")
-                if status == 2:
-                    # Should have share_id, but if not, maybe next poll?
-                    pass
-                elif status == 0:
-                    # Pending/Running
-                    await asyncio.sleep(1)
-                    continue
-                else:
-                    # Failure status
-                    custom_print(
-                        f"获取share_id失败 (Task Status {status}): {json_data}",
-                        error_msg=True,
-                    )
-                    raise Exception(f"Share task failed with status {status}")
+        def settled(json_data: dict[str, Any]) -> bool:
+            data = json_data.get("data", {})
+            if not data:
+                return False
+            # Status 2 seems to be success for tasks
+            if "share_id" in data:
+                return True
+            status = data.get("status")
+            # 0 is pending/running, a 2 without share_id may have it next poll
+            if status in (0, 2):
+                return False
+            # Failure status
+            custom_print(
+                f"获取share_id失败 (Task Status {status}): {json_data}",
+                error_msg=True,
+            )
+            raise Exception(f"Share task failed with status {status}")
 
-        custom_print(f"获取share_id超时: {json_data}", error_msg=True)
-        raise Exception("Timeout waiting for share_id")
+        json_data = await self.task_tracker.wait(task_id, settled, 20)
+        if json_data is None:
+            custom_print(f"获取share_id超时 (TaskID: {task_id})", error_msg=True)
+            raise Exception("Timeout waiting for share_id")
+        return json_data["data"]["share_id"]
 
     async def submit_share(self, share_id: str) -> tuple:
         params = {
@@ -1257,21 +2136,46 @@ class QuarkPanFileManager:
         json_data = {
             "share_id": share_id,
         }
-        async with httpx.AsyncClient(verify=False) as client:
-            timeout = httpx.Timeout(60.0, connect=60.0)
-            response = await client.post(
-                "https://drive-pc.quark.cn/1/clouddrive/share/password",
-                params=params,
-                json=json_data,
-                headers=self.headers,
-                timeout=timeout,
+        response = await self.session.post(
+            "https://drive-pc.quark.cn/1/clouddrive/share/password",
+            params=params,
+            json=json_data,
+            headers=self.headers,
+        )
+        json_data = response.json()
+        share_url = json_data["data"]["share_url"]
+        title = json_data["data"]["title"]
+        if "passcode" in json_data["data"]:
+            share_url = share_url + f"?pwd={json_data['data']['passcode']}"
+        return share_url, title
+
+    async def create_share(
+        self,
+        fid: str,
+        title: str,
+        url_type: int = 1,
+        expired_type: int = 2,
+        password: str = "",
+    ) -> tuple[str, str, str]:
+        """Share fid, retried as a whole. Returns share_id, share_url, title."""
+
+        async def attempt() -> tuple[str, str, str]:
+            task_id = await self.get_share_task_id(
+                fid,
+                title,
+                url_type=url_type,
+                expired_type=expired_type,
+                password=password,
             )
-            json_data = response.json()
-            share_url = json_data["data"]["share_url"]
-            title = json_data["data"]["title"]
-            if "passcode" in json_data["data"]:
-                share_url = share_url + f"?pwd={json_data['data']['passcode']}"
-            return share_url, title
+            share_id = await self.get_share_id(task_id)
+            share_url, share_title = await self.submit_share(share_id)
+            return share_id, share_url, share_title
+
+        try:
+            return await self.retry.call("share", attempt)
+        except Exception as e:
+            custom_print(f"分享失败: {e}", error_msg=True)
+            raise
 
     async def cancel_share(self, share_id: str) -> bool:
         # Note: The 'delete' API endpoint is inferred from standard RESTful patterns and similar drive APIs.
@@ -1285,21 +2189,19 @@ class QuarkPanFileManager:
         }
         data = {"share_ids": [share_id]}
         try:
-            async with httpx.AsyncClient(verify=False) as client:
-                timeout = httpx.Timeout(60.0, connect=60.0)
-                response = await client.post(
-                    api, json=data, params=params, headers=self.headers, timeout=timeout
+            response = await self.session.post(
+                api, json=data, params=params, headers=self.headers
+            )
+            json_data = response.json()
+            if json_data.get("code") == 0:
+                custom_print(f"分享链接 (ShareID: {share_id}) 取消成功")
+                return True
+            else:
+                custom_print(
+                    f"取消分享失败 (API返回错误): {json_data}",
+                    error_msg=True,
                 )
-                json_data = response.json()
-                if json_data.get("code") == 0:
-                    custom_print(f"分享链接 (ShareID: {share_id}) 取消成功")
-                    return True
-                else:
-                    custom_print(
-                        f"取消分享失败 (API返回错误): {json_data}",
-                        error_msg=True,
-                    )
-                    return False
+                return False
         except Exception as e:
             custom_print(f"取消分享请求异常 (已忽略): {e}", error_msg=True)
             return False
@@ -1326,7 +2228,6 @@ class QuarkPanFileManager:
                 custom_print(f"文件夹网页地址：{share_url}")
                 pwd_id = share_url.rsplit("/", maxsplit=1)[1].split("-")[0]
 
-            first_page = 1
             n = 0
             error = 0
             os.makedirs("output", exist_ok=True)
@@ -1341,15 +2242,13 @@ class QuarkPanFileManager:
                 try:
                     share_name = "转存文件夹" if fid and fid != "0" else "根目录"
                     custom_print(f"开始分享: {share_name}")
-                    task_id = await self.get_share_task_id(
+                    share_id, share_url, title = await self.create_share(
                         pwd_id,
                         share_name,
                         url_type=url_type,
                         expired_type=expired_type,
                         password=password,
                     )
-                    share_id = await self.get_share_id(task_id)
-                    share_url, title = await self.submit_share(share_id)
                     created_share_ids.append(share_id)
                     with open(save_share_path, "a", encoding="utf-8") as f:
                         content = f"1 | {title} | {share_url}"
@@ -1360,146 +2259,83 @@ class QuarkPanFileManager:
                     print("分享失败：", e)
                     return created_share_ids
 
-            while True:
-                json_data = await self.get_sorted_file_list(
-                    pwd_id,
-                    page=str(first_page),
-                    size="50",
-                    fetch_total="1",
-                    sort="file_type:asc,file_name:asc",
-                )
-                for i1 in json_data["data"]["list"]:
-                    if i1["dir"]:
-                        first_dir = i1["file_name"]
-                        # 如果遍历深度为1，直接分享一级目录
-                        if traverse_depth == 1:
+            for i1 in await self.get_all_sorted_files(
+                pwd_id, sort="file_type:asc,file_name:asc"
+            ):
+                if i1["dir"]:
+                    first_dir = i1["file_name"]
+                    # 如果遍历深度为1，直接分享一级目录
+                    if traverse_depth == 1:
+                        n += 1
+                        fid = i1["fid"]
+                        custom_print(f"{n}.开始分享 {first_dir} 文件夹")
+                        try:
+                            share_id, share_url, title = await self.create_share(
+                                fid,
+                                first_dir,
+                                url_type=url_type,
+                                expired_type=expired_type,
+                                password=password,
+                            )
+                            created_share_ids.append(share_id)
+                            with open(save_share_path, "a", encoding="utf-8") as f:
+                                content = f"{n} | {first_dir} | {share_url}"
+                                f.write(content + "\n")
+                                custom_print(f"{n}.分享成功 {first_dir} 文件夹")
+                        except Exception as e:
+                            error += 1
+                            print("分享失败：", e)
+                            save_config(
+                                "output/share_error.txt",
+                                content=f"{error}.{first_dir} 文件夹\n",
+                                mode="a",
+                            )
+                            save_config(
+                                "output/retry.txt",
+                                content=f"{n} | {first_dir} | {fid}\n",
+                                mode="a",
+                            )
+                        continue
+
+                    # 遍历深度为2，遍历二级目录
+                    for i2 in await self.get_all_sorted_files(
+                        i1["fid"], sort="file_type:asc,file_name:asc"
+                    ):
+                        if i2["dir"]:
                             n += 1
-                            share_success = False
-                            share_error_msg = ""
-                            fid = ""
-                            for i in range(3):
-                                try:
-                                    custom_print(f"{n}.开始分享 {first_dir} 文件夹")
-                                    random_time = random.choice([0.5, 1, 1.5, 2])
-                                    await asyncio.sleep(random_time)
-                                    fid = i1["fid"]
-                                    task_id = await self.get_share_task_id(
-                                        fid,
-                                        first_dir,
-                                        url_type=url_type,
-                                        expired_type=expired_type,
-                                        password=password,
+                            second_dir = i2["file_name"]
+                            fid = i2["fid"]
+                            custom_print(
+                                f"{n}.开始分享 {first_dir}/{second_dir} 文件夹"
+                            )
+                            try:
+                                share_id, share_url, title = await self.create_share(
+                                    fid,
+                                    second_dir,
+                                    url_type=url_type,
+                                    expired_type=expired_type,
+                                    password=password,
+                                )
+                                created_share_ids.append(share_id)
+                                with open(save_share_path, "a", encoding="utf-8") as f:
+                                    content = f"{n} | {first_dir} | {second_dir} | {share_url}"
+                                    f.write(content + "\n")
+                                    custom_print(
+                                        f"{n}.分享成功 {first_dir}/{second_dir} 文件夹"
                                     )
-                                    share_id = await self.get_share_id(task_id)
-                                    share_url, title = await self.submit_share(share_id)
-                                    created_share_ids.append(share_id)
-                                    with open(
-                                        save_share_path, "a", encoding="utf-8"
-                                    ) as f:
-                                        content = f"{n} | {first_dir} | {share_url}"
-                                        f.write(content + "\n")
-                                        custom_print(f"{n}.分享成功 {first_dir} 文件夹")
-                                        share_success = True
-                                        break
-                                except Exception as e:
-                                    share_error_msg = e
-                                    error += 1
-
-                            if not share_success:
-                                print("分享失败：", share_error_msg)
+                            except Exception as e:
+                                error += 1
+                                print("分享失败：", e)
                                 save_config(
                                     "output/share_error.txt",
-                                    content=f"{error}.{first_dir} 文件夹\n",
+                                    content=f"{error}.{first_dir}/{second_dir} 文件夹\n",
                                     mode="a",
                                 )
                                 save_config(
                                     "output/retry.txt",
-                                    content=f"{n} | {first_dir} | {fid}\n",
+                                    content=f"{n} | {first_dir} | {second_dir} | {fid}\n",
                                     mode="a",
                                 )
-                            continue
-
-                        # 遍历深度为2，遍历二级目录
-                        second_page = 1
-                        while True:
-                            # print(f'正在获取{first_dir}第{first_page}页，二级目录第{second_page}页，目前共分享{n}文件')
-                            json_data2 = await self.get_sorted_file_list(
-                                i1["fid"],
-                                page=str(second_page),
-                                size="50",
-                                fetch_total="1",
-                                sort="file_type:asc,file_name:asc",
-                            )
-                            for i2 in json_data2["data"]["list"]:
-                                if i2["dir"]:
-                                    n += 1
-                                    share_success = False
-                                    share_error_msg = ""
-                                    fid = ""
-                                    for i in range(3):
-                                        try:
-                                            second_dir = i2["file_name"]
-                                            custom_print(
-                                                f"{n}.开始分享 {first_dir}/{second_dir} 文件夹"
-                                            )
-                                            random_time = random.choice(
-                                                [0.5, 1, 1.5, 2]
-                                            )
-                                            await asyncio.sleep(random_time)
-                                            # print('获取到文件夹ID：', i2['fid'])
-                                            fid = i2["fid"]
-                                            task_id = await self.get_share_task_id(
-                                                fid,
-                                                second_dir,
-                                                url_type=url_type,
-                                                expired_type=expired_type,
-                                                password=password,
-                                            )
-                                            share_id = await self.get_share_id(task_id)
-                                            share_url, title = await self.submit_share(
-                                                share_id
-                                            )
-                                            created_share_ids.append(share_id)
-                                            with open(
-                                                save_share_path, "a", encoding="utf-8"
-                                            ) as f:
-                                                content = f"{n} | {first_dir} | {second_dir} | {share_url}"
-                                                f.write(content + "\n")
-                                                custom_print(
-                                                    f"{n}.分享成功 {first_dir}/{second_dir} 文件夹"
-                                                )
-                                                share_success = True
-                                                break
-
-                                        except Exception as e:
-                                            share_error_msg = e
-                                            error += 1
-
-                                    if not share_success:
-                                        print("分享失败：", share_error_msg)
-                                        save_config(
-                                            "output/share_error.txt",
-                                            content=f"{error}.{first_dir}/{second_dir} 文件夹\n",
-                                            mode="a",
-                                        )
-                                        save_config(
-                                            "output/retry.txt",
-                                            content=f"{n} | {first_dir} | {second_dir} | {fid}\n",
-                                            mode="a",
-                                        )
-                            second_total = json_data2["metadata"]["_total"]
-                            second_size = json_data2["metadata"]["_size"]
-                            second_page = json_data2["metadata"]["_page"]
-                            if second_size * second_page >= second_total:
-                                break
-                            second_page += 1
-
-                second_total = json_data["metadata"]["_total"]
-                second_size = json_data["metadata"]["_size"]
-                second_page = json_data["metadata"]["_page"]
-                if second_size * second_page >= second_total:
-                    break
-                first_page += 1
             custom_print(f"总共分享了 {n} 个文件夹，已经保存至 {save_share_path}")
             return created_share_ids
 
@@ -1528,42 +2364,39 @@ class QuarkPanFileManager:
                 first_dir = data[-3]
                 second_dir = data[-2]
                 fid = data[-1]
-                share_error_msg = ""
-                for i in range(3):
-                    try:
-                        task_id = await self.get_share_task_id(
-                            fid,
-                            second_dir,
-                            url_type=url_type,
-                            expired_type=expired_type,
-                            password=password,
-                        )
-                        share_id = await self.get_share_id(task_id)
-                        share_url, title = await self.submit_share(share_id)
-                        with open(save_share_path, "a", encoding="utf-8") as f:
-                            content = f"{n} | {first_dir} | {second_dir} | {share_url}"
-                            f.write(content + "\n")
-                            custom_print(
-                                f"{n}.分享成功 {first_dir}/{second_dir} 文件夹"
-                            )
-                            share_success = True
-                            break
-                    except Exception as e:
-                        share_error_msg = e
-                        error += 1
-
-                if not share_success:
-                    print("分享失败：", share_error_msg)
+                try:
+                    _, share_url, title = await self.create_share(
+                        fid,
+                        second_dir,
+                        url_type=url_type,
+                        expired_type=expired_type,
+                        password=password,
+                    )
+                    with open(save_share_path, "a", encoding="utf-8") as f:
+                        content = f"{n} | {first_dir} | {second_dir} | {share_url}"
+                        f.write(content + "\n")
+                        custom_print(f"{n}.分享成功 {first_dir}/{second_dir} 文件夹")
+                except Exception as e:
+                    error += 1
+                    print("分享失败：", e)
                     error_data.append(i1)
         error_content = "\n".join(error_data)
         save_config(path="output/retry.txt", content=error_content, mode="w")
 
 
-def clean_share_dir():
+def clean_share_dir(keep: Union[list[str], None] = None):
     share_dir = "output"
+    # Never wipe the download folder, it holds resumable partial files
+    keep_paths = {os.path.abspath(p) for p in keep or []}
     if os.path.exists(share_dir):
         for filename in os.listdir(share_dir):
             file_path = os.path.join(share_dir, filename)
+            if any(
+                p == os.path.abspath(file_path)
+                or p.startswith(os.path.abspath(file_path) + os.sep)
+                for p in keep_paths
+            ):
+                continue
             try:
                 if os.path.isfile(file_path) or os.path.islink(file_path):
                     os.unlink(file_path)
@@ -1641,123 +2474,151 @@ def print_menu() -> None:
     )
 
 
-if __name__ == "__main__":
-    # CLI Argument Parsing
-    parser = argparse.ArgumentParser(description="QuarkPanTool Automation")
-    parser.add_argument("--download", help="Shared URL to download")
-    parser.add_argument("--cookie", help="Cookie string to use")
-    parser.add_argument("--path", help="Download directory to save files")
-    parser.add_argument("--headless", action="store_true", help="Run in headless mode")
-    args, unknown = parser.parse_known_args()
-
-    if args.cookie:
-        save_config(f"{CONFIG_DIR}/cookies.txt", args.cookie)
+async def main(args: argparse.Namespace) -> None:
+    global to_dir_id, to_dir_name
 
-    quark_file_manager = QuarkPanFileManager(headless=args.headless, slow_mo=500)
-    if args.path and args.path.strip():
-        quark_file_manager.save_folder = args.path.strip()
+    rate = None
+    if args.limit:
+        # Before the manager, which may open the login browser
         try:
-            os.makedirs(quark_file_manager.save_folder, exist_ok=True)
-        except Exception:
-            pass
+            rate = parse_rate(args.limit)
+        except ValueError as e:
+            custom_print(f"{e}，示例: 10MB、500KB", error_msg=True)
+            # Like argparse's own usage errors
+            sys.exit(2)
 
-    if args.download:
-        # Automation Mode
-        clean_share_dir()  # Clean share directory before running
+    quark_file_manager = QuarkPanFileManager(headless=args.headless, slow_mo=500)
+    try:
+        if rate is not None:
+            quark_file_manager.limit_override = rate
+            quark_file_manager.bandwidth_limiter.configure(rate, [])
 
-        # Initialize user info first to populate self.user etc.
-        user_name = asyncio.run(quark_file_manager.get_user_info())
-        # We need to ensure config is loaded/initialized
-        asyncio.run(quark_file_manager.load_folder_id())
+        if args.progress:
+            quark_file_manager.progress_override = args.progress
+            quark_file_manager.progress.mode = args.progress
 
-        custom_print(f"自动化模式启动")
-        custom_print(f"目标URL: {args.download}")
+        if args.sync or args.sync_delete:
+            quark_file_manager.sync = True
+            quark_file_manager.sync_delete = args.sync_delete
 
-        asyncio.run(quark_file_manager.one_click_download_pipeline(args.download))
-        sys.exit(0)
+        if args.path and args.path.strip():
+            quark_file_manager.save_folder = args.path.strip()
+            try:
+                os.makedirs(quark_file_manager.save_folder, exist_ok=True)
+            except Exception:
+                pass
 
-    while True:
-        print_menu()
+        if args.download:
+            # Automation Mode
+            # Clean share directory before running
+            clean_share_dir(keep=[quark_file_manager.save_folder])
 
-        to_dir_id, to_dir_name = asyncio.run(quark_file_manager.load_folder_id())
+            # Initialize user info first to populate self.user etc.
+            user_name = await quark_file_manager.get_user_info()
+            # We need to ensure config is loaded/initialized
+            await quark_file_manager.load_folder_id()
+            if args.metrics_port is not None:
+                quark_file_manager.metrics_port = args.metrics_port
 
-        input_text = input("请输入你的选择(1—7或q退出)：")
+            custom_print(f"自动化模式启动")
+            custom_print(f"目标URL: {args.download}")
 
-        if input_text and input_text.strip() in ["q", "Q"]:
-            print("已退出程序！")
+            metrics_server = await quark_file_manager.serve_metrics()
+            try:
+                if args.watch:
+                    await quark_file_manager.watch(
+                        args.download,
+                        min_interval=args.interval,
+                        max_interval=max(args.max_interval, args.interval),
+                    )
+                else:
+                    await quark_file_manager.one_click_download_pipeline(args.download)
+            finally:
+                # Also when the pipeline gave up with sys.exit
+                quark_file_manager.report_metrics()
+                if metrics_server:
+                    metrics_server.close()
             sys.exit(0)
 
-        if input_text and input_text.strip() in [str(i) for i in range(1, 8)]:
-            if input_text.strip() == "1":
-                save_option = input("是否批量转存(1是 2否)：")
-                if save_option and save_option == "1":
-                    try:
-                        urls = load_url_file("config/url.txt")
-                        if not urls:
-                            custom_print(
-                                "\n分享地址为空！请先在config/url.txt文件中输入分享地址(一行一个)"
-                            )
-                            continue
+        while True:
+            print_menu()
 
-                        custom_print(
-                            f"\r检测到config/url.txt文件中有{len(urls)}条分享链接"
-                        )
-                        ok = input("请你确认是否开始批量保存(确认请按2):")
-                        if ok and ok.strip() == "2":
-                            for index, url in enumerate(urls):
-                                print(f"正在转存第{index + 1}个")
-                                asyncio.run(
-                                    quark_file_manager.run(url.strip(), to_dir_id)
+            to_dir_id, to_dir_name = await quark_file_manager.load_folder_id()
+
+            input_text = input("请输入你的选择(1—7或q退出)：")
+
+            if input_text and input_text.strip() in ["q", "Q"]:
+                print("已退出程序！")
+                sys.exit(0)
+
+            if input_text and input_text.strip() in [str(i) for i in range(1, 8)]:
+                if input_text.strip() == "1":
+                    save_option = input("是否批量转存(1是 2否)：")
+                    if save_option and save_option == "1":
+                        try:
+                            urls = load_url_file("config/url.txt")
+                            if not urls:
+                                custom_print(
+                                    "\n分享地址为空！请先在config/url.txt文件中输入分享地址(一行一个)"
                                 )
-                    except FileNotFoundError:
-                        with open("config/url.txt", "w", encoding="utf-8"):
-                            sys.exit(-1)
-                else:
-                    url = input("请输入夸克文件分享地址：")
-                    if url and len(url.strip()) > 20:
-                        asyncio.run(quark_file_manager.run(url.strip(), to_dir_id))
+                                continue
 
-            elif input_text.strip() == "2":
-                share_option = input("请输入你的选择(1分享 2重试分享)：")
-                if share_option and share_option == "1":
-                    url = input("请输入需要分享的文件夹网页端页面地址：")
-                    if not url or len(url.strip()) < 20:
-                        continue
-                else:
-                    try:
-                        url = read_config(path="output/retry.txt", mode="r")
-                        if not url:
-                            print("\nretry.txt 为空！请检查文件")
+                            custom_print(
+                                f"\r检测到config/url.txt文件中有{len(urls)}条分享链接"
+                            )
+                            ok = input("请你确认是否开始批量保存(确认请按2):")
+                            if ok and ok.strip() == "2":
+                                for index, url in enumerate(urls):
+                                    print(f"正在转存第{index + 1}个")
+                                    await quark_file_manager.run(url.strip(), to_dir_id)
+                        except FileNotFoundError:
+                            with open("config/url.txt", "w", encoding="utf-8"):
+                                sys.exit(-1)
+                    else:
+                        url = input("请输入夸克文件分享地址：")
+                        if url and len(url.strip()) > 20:
+                            await quark_file_manager.run(url.strip(), to_dir_id)
+
+                elif input_text.strip() == "2":
+                    share_option = input("请输入你的选择(1分享 2重试分享)：")
+                    if share_option and share_option == "1":
+                        url = input("请输入需要分享的文件夹网页端页面地址：")
+                        if not url or len(url.strip()) < 20:
+                            continue
+                    else:
+                        try:
+                            url = read_config(path="output/retry.txt", mode="r")
+                            if not url:
+                                print("\nretry.txt 为空！请检查文件")
+                                continue
+                        except FileNotFoundError:
+                            save_config("output/retry.txt", content="")
+                            print("\noutput/retry.txt 文件为空！")
                             continue
-                    except FileNotFoundError:
-                        save_config("output/retry.txt", content="")
-                        print("\noutput/retry.txt 文件为空！")
-                        continue
 
-                expired_option = {"1": 2, "2": 3, "3": 4, "4": 1}
-                print("1.1天  2.7天  3.30天  4.永久")
-                select_option = input("请输入分享时长选项：")
-                _expired_type = expired_option.get(select_option, 4)
-                is_private = input("是否加密(1否/2是)：")
-                url_encrypt = 2 if is_private == "2" else 1
-                passcode = (
-                    input("请输入你想设置的分享提取码(直接回车，可随机生成):")
-                    if url_encrypt == 2
-                    else ""
-                )
+                    expired_option = {"1": 2, "2": 3, "3": 4, "4": 1}
+                    print("1.1天  2.7天  3.30天  4.永久")
+                    select_option = input("请输入分享时长选项：")
+                    _expired_type = expired_option.get(select_option, 4)
+                    is_private = input("是否加密(1否/2是)：")
+                    url_encrypt = 2 if is_private == "2" else 1
+                    passcode = (
+                        input("请输入你想设置的分享提取码(直接回车，可随机生成):")
+                        if url_encrypt == 2
+                        else ""
+                    )
 
-                print("\n\r请选择遍历深度：")
-                print("0.不遍历（只分享根目录-默认）")
-                print("1.遍历只分享一级目录")
-                print("2.遍历只分享两级目录\n")
-                traverse_option = input("请输入选项(0/1/2)：")
-                _traverse_depth = 0  # 默认只分享根目录
-                if traverse_option in ["1", "2"]:
-                    _traverse_depth = int(traverse_option)
-
-                if share_option and share_option == "1":
-                    asyncio.run(
-                        quark_file_manager.share_run(
+                    print("\n\r请选择遍历深度：")
+                    print("0.不遍历（只分享根目录-默认）")
+                    print("1.遍历只分享一级目录")
+                    print("2.遍历只分享两级目录\n")
+                    traverse_option = input("请输入选项(0/1/2)：")
+                    _traverse_depth = 0  # 默认只分享根目录
+                    if traverse_option in ["1", "2"]:
+                        _traverse_depth = int(traverse_option)
+
+                    if share_option and share_option == "1":
+                        await quark_file_manager.share_run(
                             url.strip(),
                             folder_id=to_dir_id,
                             url_type=int(url_encrypt),
@@ -1765,73 +2626,124 @@ if __name__ == "__main__":
                             password=passcode,
                             traverse_depth=_traverse_depth,
                         )
-                    )
-                else:
-                    asyncio.run(
-                        quark_file_manager.share_run_retry(
+                    else:
+                        await quark_file_manager.share_run_retry(
                             url.strip(),
                             url_type=url_encrypt,
                             expired_type=_expired_type,
                             password=passcode,
                         )
-                    )
 
-            elif input_text.strip() == "3":
-                to_dir_id, to_dir_name = asyncio.run(
-                    quark_file_manager.load_folder_id(renew=True)
-                )
-                custom_print(f"已切换保存目录至网盘 {to_dir_name} 文件夹\n")
+                elif input_text.strip() == "3":
+                    to_dir_id, to_dir_name = await quark_file_manager.load_folder_id(
+                        renew=True
+                    )
+                    custom_print(f"已切换保存目录至网盘 {to_dir_name} 文件夹\n")
 
-            elif input_text.strip() == "4":
-                create_name = input("请输入需要创建的文件夹名称：")
-                if create_name:
-                    asyncio.run(quark_file_manager.create_dir(create_name.strip()))
-                else:
-                    custom_print("创建的文件夹名称不可为空！", error_msg=True)
+                elif input_text.strip() == "4":
+                    create_name = input("请输入需要创建的文件夹名称：")
+                    if create_name:
+                        await quark_file_manager.create_dir(create_name.strip())
+                    else:
+                        custom_print("创建的文件夹名称不可为空！", error_msg=True)
 
-            elif input_text.strip() == "5":
-                try:
-                    is_batch = input("输入你的选择(1单个地址下载，2批量下载):")
-                    if is_batch:
-                        if is_batch.strip() == "1":
-                            url = input("请输入夸克文件分享地址：")
-                            asyncio.run(
-                                quark_file_manager.run(
+                elif input_text.strip() == "5":
+                    try:
+                        is_batch = input("输入你的选择(1单个地址下载，2批量下载):")
+                        if is_batch:
+                            if is_batch.strip() == "1":
+                                url = input("请输入夸克文件分享地址：")
+                                await quark_file_manager.run(
                                     url.strip(), to_dir_id, download=True
                                 )
-                            )
-                        elif is_batch.strip() == "2":
-                            urls = load_url_file("config/url.txt")
-                            if not urls:
-                                print(
-                                    "\n分享地址为空！请先在config/url.txt文件中输入分享地址(一行一个)"
-                                )
-                                continue
+                            elif is_batch.strip() == "2":
+                                urls = load_url_file("config/url.txt")
+                                if not urls:
+                                    print(
+                                        "\n分享地址为空！请先在config/url.txt文件中输入分享地址(一行一个)"
+                                    )
+                                    continue
 
-                            for index, url in enumerate(urls):
-                                asyncio.run(
-                                    quark_file_manager.run(
+                                for index, url in enumerate(urls):
+                                    await quark_file_manager.run(
                                         url.strip(), to_dir_id, download=True
                                     )
-                                )
 
-                except FileNotFoundError:
-                    with open("config/url.txt", "w", encoding="utf-8"):
-                        sys.exit(-1)
-
-            elif input_text.strip() == "6":
-                save_config(f"{CONFIG_DIR}/cookies.txt", "")
-                quark_file_manager = QuarkPanFileManager(headless=False, slow_mo=500)
-                quark_file_manager.get_cookies()
+                    except FileNotFoundError:
+                        with open("config/url.txt", "w", encoding="utf-8"):
+                            sys.exit(-1)
 
-            elif input_text.strip() == "7":
-                url = input("请输入夸克文件分享地址：")
-                if url and len(url.strip()) > 20:
-                    asyncio.run(
-                        quark_file_manager.one_click_download_pipeline(url.strip())
+                elif input_text.strip() == "6":
+                    save_config(f"{CONFIG_DIR}/cookies.txt", "")
+                    await quark_file_manager.aclose()
+                    quark_file_manager = QuarkPanFileManager(
+                        headless=False, slow_mo=500
                     )
-                else:
-                    custom_print("输入的链接无效", error_msg=True)
+                    quark_file_manager.get_cookies()
 
-        else:
-            custom_print("输入无效，请重新输入")
+                elif input_text.strip() == "7":
+                    url = input("请输入夸克文件分享地址：")
+                    if url and len(url.strip()) > 20:
+                        await quark_file_manager.one_click_download_pipeline(
+                            url.strip()
+                        )
+                    else:
+                        custom_print("输入的链接无效", error_msg=True)
+
+            else:
+                custom_print("输入无效，请重新输入")
+    finally:
+        await quark_file_manager.aclose()
+
+
+if __name__ == "__main__":
+    # CLI Argument Parsing
+    parser = argparse.ArgumentParser(description="QuarkPanTool Automation")
+    parser.add_argument("--download", help="Shared URL to download")
+    parser.add_argument("--cookie", help="Cookie string to use")
+    parser.add_argument("--path", help="Download directory to save files")
+    parser.add_argument("--headless", action="store_true", help="Run in headless mode")
+    parser.add_argument(
+        "--sync", action="store_true", help="Only download new or changed files"
+    )
+    parser.add_argument(
+        "--limit", help="Total download bandwidth, e.g. 10MB or 500KB per second"
+    )
+    parser.add_argument(
+        "--progress",
+        choices=ProgressDashboard.MODES,
+        help="Progress output: a status line, JSON lines for CI logs, or off",
+    )
+    parser.add_argument(
+        "--sync-delete",
+        action="store_true",
+        help="With --sync, also delete local files removed from the share",
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="Keep polling the --download share and sync its changes",
+    )
+    parser.add_argument(
+        "--interval",
+        type=float,
+        default=60.0,
+        help="Seconds between polls in watch mode, doubled while idle",
+    )
+    parser.add_argument(
+        "--max-interval",
+        type=float,
+        default=3600.0,
+        help="Upper bound of the watch mode poll interval in seconds",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        help="Serve Prometheus metrics on this port while --download runs",
+    )
+    args, unknown = parser.parse_known_args()
+
+    if args.cookie:
+        save_config(f"{CONFIG_DIR}/cookies.txt", args.cookie)
+
+    asyncio.run(main(args))
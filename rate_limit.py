@@ -0,0 +1,185 @@
+import asyncio
+import time
+from typing import Any, Union
+
+import httpx
+
+from metrics import CDN, endpoint_name, response_code
+from retry import parse_retry_after
+
+
+class TokenBucket:
+    """Requests per second of one endpoint, with up to burst at once.
+
+    Callers queue in arrival order and the first waits for a token at the
+    current rate, so a rate change applies to everyone already waiting."""
+
+    def __init__(self, rate: float, burst: float) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self._lock: Union[asyncio.Lock, None] = None
+        self._loop: Union[asyncio.AbstractEventLoop, None] = None
+
+    def available(self) -> float:
+        now = time.monotonic()
+        self.tokens = min(self.tokens + (now - self.updated) * self.rate, self.burst)
+        self.updated = now
+        return self.tokens
+
+    async def take(self) -> None:
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._lock, self._loop = asyncio.Lock(), loop
+        async with self._lock:
+            while (tokens := self.available()) < 1:
+                await asyncio.sleep((1 - tokens) / self.rate)
+            self.tokens -= 1
+
+    def pause(self, seconds: float) -> None:
+        """Hand out no tokens for the next seconds."""
+        self.available()
+        self.tokens = min(self.tokens, 1 - seconds * self.rate)
+
+
+class EndpointRate:
+    __slots__ = ("bucket", "latency", "held_until", "threshold")
+
+    def __init__(self, rate: float, burst: float) -> None:
+        self.bucket = TokenBucket(rate, burst)
+        # Usual latency, follows drops at once and rises slowly
+        self.latency: Union[float, None] = None
+        # No further slowdown before this, one burst of errors counts once
+        self.held_until = 0.0
+        # Below it the rate doubles every second, past it grows linearly
+        self.threshold = float("inf")
+
+
+class RateLimiter:
+    """Adaptive request rate of each control-plane API endpoint.
+
+    An endpoint starts at rate requests/s. While callers use up its bucket
+    and the answers are good, the rate doubles every second until the
+    endpoint first pushes back and then grows by about increase every
+    second. A 429 or 5xx, one of throttle_codes, a request error or a
+    response slower than slow_factor times the usual latency multiplies it
+    by decrease, at most once a second. A Retry-After stops the endpoint
+    for as long as asked. Download hosts aren't limited."""
+
+    def __init__(
+        self,
+        rate: float = 5.0,
+        min_rate: float = 0.5,
+        max_rate: float = 50.0,
+        burst: float = 5.0,
+        increase: float = 1.0,
+        decrease: float = 0.7,
+        slow_factor: float = 4.0,
+        slow_latency: float = 1.0,
+        throttle_codes: tuple[str, ...] = (),
+    ) -> None:
+        self.enabled = True
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.burst = burst
+        self.increase = increase
+        self.decrease = decrease
+        self.slow_factor = slow_factor
+        # Slower than the usual latency but under this is never "slow"
+        self.slow_latency = slow_latency
+        self.throttle_codes = set(throttle_codes)
+        self.endpoints: dict[str, EndpointRate] = {}
+
+    def configure(self, options: Union[dict[str, Any], bool]) -> None:
+        """Apply the rate_limit config, false switches limiting off."""
+        if isinstance(options, bool):
+            self.enabled = options
+            return
+        self.enabled = bool(options.get("enabled", True))
+        self.rate = float(options.get("rate", self.rate))
+        self.min_rate = max(float(options.get("min_rate", self.min_rate)), 0.01)
+        self.max_rate = max(
+            float(options.get("max_rate", self.max_rate)), self.min_rate
+        )
+        self.burst = max(float(options.get("burst", self.burst)), 1.0)
+        if "throttle_codes" in options:
+            self.throttle_codes = {str(code) for code in options["throttle_codes"]}
+        self.rate = min(max(self.rate, self.min_rate), self.max_rate)
+        # Learned rates were bounded by the old limits
+        self.endpoints = {}
+
+    def _endpoint(self, url: Union[str, httpx.URL]) -> Union[EndpointRate, None]:
+        if not self.enabled:
+            return None
+        name = endpoint_name(url)
+        if name == CDN:
+            return None
+        state = self.endpoints.get(name)
+        if state is None:
+            state = self.endpoints[name] = EndpointRate(self.rate, self.burst)
+        return state
+
+    async def acquire(self, url: Union[str, httpx.URL]) -> None:
+        """Wait for the turn of a request to url."""
+        state = self._endpoint(url)
+        if state is None:
+            return
+        await state.bucket.take()
+
+    def observe(
+        self, url: Union[str, httpx.URL], response: httpx.Response, seconds: float
+    ) -> None:
+        state = self._endpoint(url)
+        if state is None:
+            return
+        status = response.status_code
+        throttled = (
+            status == 429
+            or status >= 500
+            or response_code(response) in self.throttle_codes
+        )
+        after = parse_retry_after(response.headers.get("retry-after"))
+        if after:
+            state.bucket.pause(after)
+        usual = state.latency
+        if usual is None or seconds < usual:
+            state.latency = seconds
+        else:
+            state.latency = usual + (seconds - usual) * 0.05
+        slow = usual is not None and seconds > max(
+            usual * self.slow_factor, self.slow_latency
+        )
+        if throttled or slow:
+            self._slow_down(state)
+        elif state.bucket.available() < 1:
+            # Only a rate that is actually used up has shown it holds
+            bucket = state.bucket
+            if bucket.rate < state.threshold:
+                rate = bucket.rate + 1
+            else:
+                rate = bucket.rate + self.increase / bucket.rate
+            bucket.rate = min(rate, self.max_rate)
+
+    def observe_error(self, url: Union[str, httpx.URL], error: Exception) -> None:
+        state = self._endpoint(url)
+        if state is not None:
+            self._slow_down(state)
+
+    def _slow_down(self, state: EndpointRate) -> None:
+        now = time.monotonic()
+        if now < state.held_until:
+            return
+        state.held_until = now + 1.0
+        bucket = state.bucket
+        bucket.available()
+        bucket.rate = max(bucket.rate * self.decrease, self.min_rate)
+        state.threshold = bucket.rate
+
+    def rates(self) -> dict[str, float]:
+        """Current requests/s per endpoint."""
+        return {
+            name: round(state.bucket.rate, 2)
+            for name, state in sorted(self.endpoints.items())
+        }
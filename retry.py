@@ -0,0 +1,251 @@
+import asyncio
+import itertools
+import random
+import time
+from collections import deque
+from email.utils import parsedate_to_datetime
+from typing import Any, Awaitable, Callable, TypeVar, Union
+
+import httpx
+
+from metrics import Metrics
+from utils import custom_print
+
+T = TypeVar("T")
+
+
+def retry_after(error: BaseException) -> Union[float, None]:
+    """Seconds the server asked to wait in a Retry-After header, if any."""
+    if not isinstance(error, httpx.HTTPStatusError):
+        return None
+    return parse_retry_after(error.response.headers.get("retry-after"))
+
+
+def parse_retry_after(value: Union[str, None]) -> Union[float, None]:
+    """A Retry-After value in seconds, it may be a delay or an HTTP date."""
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+def is_endpoint_failure(error: BaseException) -> bool:
+    """Whether an error says the endpoint itself is in trouble. A 403 of an
+    expired URL or a 404 is the request's fault and doesn't count."""
+    if isinstance(error, httpx.HTTPStatusError):
+        status = error.response.status_code
+        return status == 429 or status >= 500
+    return True
+
+
+class RetryPolicy:
+    """How often and how patiently an endpoint is retried.
+
+    Attempt n (from 0) waits between half and all of min(cap, base * 2**n),
+    the random half keeps callers that failed together from retrying
+    together. A Retry-After from the server is waited out in full."""
+
+    def __init__(self, attempts: int = 3, base: float = 1.0, cap: float = 30.0) -> None:
+        self.attempts = max(attempts, 1)
+        self.base = base
+        self.cap = cap
+
+    def delay(self, attempt: int, after: Union[float, None] = None) -> float:
+        backoff = min(self.cap, self.base * 2**attempt)
+        backoff = backoff / 2 + random.uniform(0, backoff / 2)
+        return max(backoff, after) if after is not None else backoff
+
+
+class RetryBudget:
+    """Retries one endpoint may spend: ratio of a retry per call made, on
+    top of a reserve. When an endpoint fails every call, retrying it is only
+    extra load, so past the budget failures are returned at once."""
+
+    def __init__(self, ratio: float = 0.2, reserve: float = 10.0) -> None:
+        self.ratio = ratio
+        self.reserve = reserve
+        self.tokens = reserve
+
+    def deposit(self) -> None:
+        self.tokens = min(self.tokens + self.ratio, self.reserve)
+
+    def withdraw(self) -> bool:
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class CircuitBreaker:
+    """Pauses every caller of an endpoint that fails in bulk.
+
+    Opens once at least threshold of the last window outcomes (and
+    min_calls of them) are failures. Callers then wait cooldown seconds,
+    after which a single trial call goes through: success closes the
+    breaker, failure opens it again for twice as long, up to max_cooldown."""
+
+    def __init__(
+        self,
+        name: str,
+        window: int = 20,
+        threshold: float = 0.5,
+        min_calls: int = 10,
+        cooldown: float = 5.0,
+        max_cooldown: float = 60.0,
+    ) -> None:
+        self.name = name
+        self.threshold = threshold
+        self.min_calls = min_calls
+        self.base_cooldown = cooldown
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.outcomes: deque[bool] = deque(maxlen=window)
+        self.state = "closed"
+        self.opened_until = 0.0
+        self.opened = 0
+        self._trial: Union[asyncio.Future, None] = None
+
+    async def admit(self) -> None:
+        while self.state != "closed":
+            now = time.monotonic()
+            if self.state == "open":
+                if now < self.opened_until:
+                    await asyncio.sleep(self.opened_until - now)
+                    continue
+                self.state = "half_open"
+                self._trial = asyncio.get_running_loop().create_future()
+                return
+            # Half open, wait for the trial call. One that never reports
+            # back (cancelled) hands the trial on after a cooldown
+            trial = self._trial
+            await asyncio.wait({trial}, timeout=self.cooldown)
+            if not trial.done() and self._trial is trial:
+                self._trial = asyncio.get_running_loop().create_future()
+                return
+
+    def _open(self) -> None:
+        self.state = "open"
+        self.opened += 1
+        self.opened_until = time.monotonic() + self.cooldown
+        custom_print(
+            f"接口 {self.name} 大量失败，所有请求暂停 {self.cooldown:.0f} 秒",
+            error_msg=True,
+        )
+
+    def record(self, ok: bool) -> None:
+        if self.state == "half_open":
+            trial, self._trial = self._trial, None
+            if ok:
+                self.state = "closed"
+                self.cooldown = self.base_cooldown
+                self.outcomes.clear()
+            else:
+                self.cooldown = min(self.cooldown * 2, self.max_cooldown)
+                self._open()
+            if trial is not None and not trial.done():
+                trial.set_result(None)
+            return
+        if self.state == "open":
+            # Calls that were already out when it opened
+            return
+        self.outcomes.append(ok)
+        failures = self.outcomes.count(False)
+        enough = len(self.outcomes) >= self.min_calls
+        if enough and failures >= self.threshold * len(self.outcomes):
+            self._open()
+
+
+class RetryEngine:
+    """The one place retries are decided, per endpoint: backoff policy,
+    retry budget and circuit breaker.
+
+    Simple call sites use call(). Loops that keep state across attempts,
+    like a segment resuming where it broke off, use admit(), success()
+    and failure() around each attempt. Task status polls go through
+    TaskTracker, paced by the "task" policy."""
+
+    def __init__(
+        self,
+        metrics: Union[Metrics, None] = None,
+        policies: Union[dict[str, RetryPolicy], None] = None,
+    ) -> None:
+        self.metrics = metrics
+        self.policies: dict[str, RetryPolicy] = policies or {}
+        self.default = RetryPolicy()
+        self.breakers: dict[str, CircuitBreaker] = {}
+        self.budgets: dict[str, RetryBudget] = {}
+
+    def policy(self, endpoint: str) -> RetryPolicy:
+        return self.policies.get(endpoint, self.default)
+
+    def breaker(self, endpoint: str) -> CircuitBreaker:
+        breaker = self.breakers.get(endpoint)
+        if breaker is None:
+            breaker = self.breakers[endpoint] = CircuitBreaker(endpoint)
+        return breaker
+
+    def budget(self, endpoint: str) -> RetryBudget:
+        budget = self.budgets.get(endpoint)
+        if budget is None:
+            budget = self.budgets[endpoint] = RetryBudget()
+        return budget
+
+    async def admit(self, endpoint: str, attempt: int = 0) -> None:
+        """Wait until the endpoint's breaker lets a call through."""
+        if attempt == 0:
+            self.budget(endpoint).deposit()
+        await self.breaker(endpoint).admit()
+
+    def success(self, endpoint: str) -> None:
+        self.breaker(endpoint).record(True)
+
+    async def failure(
+        self, endpoint: str, attempt: int, error: BaseException, backoff: bool = True
+    ) -> bool:
+        """Record a failed attempt. Returns whether to try again, once the
+        backoff has passed. backoff is False when the caller already fixed
+        the cause, e.g. fetched a fresh URL."""
+        # A 403 or 404 still means the endpoint answered
+        self.breaker(endpoint).record(not is_endpoint_failure(error))
+        if attempt + 1 >= self.policy(endpoint).attempts:
+            return False
+        # A fixed cause, like an expired URL, is no sign of a failing
+        # endpoint and doesn't draw on the budget
+        if backoff and not self.budget(endpoint).withdraw():
+            return False
+        if self.metrics:
+            self.metrics.retry(endpoint)
+        if backoff:
+            await asyncio.sleep(
+                self.policy(endpoint).delay(attempt, retry_after(error))
+            )
+        return True
+
+    async def call(self, endpoint: str, fn: Callable[[], Awaitable[T]]) -> T:
+        """await fn(), retried on any exception by the endpoint's policy."""
+        for attempt in itertools.count():
+            await self.admit(endpoint, attempt)
+            try:
+                result = await fn()
+            except Exception as e:
+                if await self.failure(endpoint, attempt, e):
+                    continue
+                raise
+            self.success(endpoint)
+            return result
+
+    def configure(self, policies: dict[str, dict[str, Any]]) -> None:
+        """Override policies from config, {endpoint: {attempts, base, cap}}."""
+        for endpoint, options in policies.items():
+            current = self.policy(endpoint)
+            self.policies[endpoint] = RetryPolicy(
+                attempts=int(options.get("attempts", current.attempts)),
+                base=float(options.get("base", current.base)),
+                cap=float(options.get("cap", current.cap)),
+            )
@@ -0,0 +1,89 @@
+import json
+import os
+import time
+from typing import Any
+
+from downloader import DownloadManifest
+
+
+class SyncState:
+    """What a sync last downloaded from one share, keyed by the path of each
+    file relative to the save folder.
+
+    Stored in the save folder next to the files it describes, one section
+    per share so several shares can be mirrored into the same folder."""
+
+    FILE_NAME = ".quark_sync.json"
+
+    def __init__(self, folder: str, share: str, save_interval: float = 1.0) -> None:
+        self.folder = folder
+        self.share = share
+        self.path = os.path.join(folder, self.FILE_NAME)
+        self.save_interval = save_interval
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                self.shares: dict[str, dict[str, dict[str, Any]]] = json.load(f)
+        except (OSError, ValueError):
+            self.shares = {}
+        self.files = self.shares.setdefault(share, {})
+        self._dirty = False
+        self._saved_at = 0.0
+
+    def local_path(self, rel_path: str) -> str:
+        return os.path.join(self.folder, *rel_path.split("/"))
+
+    def unchanged(self, rel_path: str, entry: dict[str, Any]) -> bool:
+        """Whether the remote entry is what was downloaded to rel_path and the
+        local copy is still complete."""
+        known = self.files.get(rel_path)
+        if not known or known.get("size") != (entry.get("size") or 0):
+            return False
+        # Only compare what both sides know
+        for key in ("fid", "updated_at"):
+            if known.get(key) and entry.get(key) and known[key] != entry[key]:
+                return False
+        local_path = self.local_path(rel_path)
+        if os.path.exists(local_path + DownloadManifest.SUFFIX):
+            return False
+        try:
+            return os.path.getsize(local_path) == known["size"]
+        except OSError:
+            return False
+
+    def update(self, rel_path: str, entry: dict[str, Any]) -> None:
+        self.files[rel_path] = {
+            "fid": entry.get("fid"),
+            "size": entry.get("size") or 0,
+            "updated_at": entry.get("updated_at"),
+        }
+        self._dirty = True
+        # Batched, a share of small files would otherwise rewrite it per file
+        if time.monotonic() - self._saved_at >= self.save_interval:
+            self.save()
+
+    def missing(self, seen: set[str]) -> list[str]:
+        """Recorded paths the remote listing no longer has."""
+        return sorted(path for path in self.files if path not in seen)
+
+    def remove(self, rel_path: str) -> str:
+        """Delete a synced file and forget it, returns the deleted path."""
+        self.files.pop(rel_path, None)
+        self._dirty = True
+        local_path = self.local_path(rel_path)
+        for path in (local_path, local_path + DownloadManifest.SUFFIX):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+        return local_path
+
+    def save(self) -> None:
+        if not self._dirty:
+            return
+        os.makedirs(self.folder, exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.shares, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+        self._dirty = False
+        self._saved_at = time.monotonic()
@@ -0,0 +1,170 @@
+import asyncio
+import heapq
+import itertools
+import time
+from typing import Any, Awaitable, Callable, Union
+
+from retry import RetryEngine, is_endpoint_failure
+
+# fetch(task_id, retry_index) -> the task endpoint's JSON response
+Fetch = Callable[[str, int], Awaitable[dict[str, Any]]]
+# settled(response) -> whether the task is done, raises if it failed
+Settled = Callable[[dict[str, Any]], bool]
+
+
+class TrackedTask:
+    __slots__ = ("task_id", "settled", "attempts", "polls", "future")
+
+    def __init__(
+        self,
+        task_id: str,
+        settled: Settled,
+        attempts: int,
+        future: asyncio.Future,
+    ) -> None:
+        self.task_id = task_id
+        self.settled = settled
+        self.attempts = attempts
+        self.polls = 0
+        self.future = future
+
+
+class TaskTracker:
+    """One poller for every outstanding save and share task.
+
+    Callers hand a task_id to wait() and get its response back once it
+    settles. Each task is polled quickly at first and then less and less
+    often, by the retry engine's "task" policy. Polls of all tasks start
+    at most rate per second and concurrency at a time, the task due
+    longest first, so hundreds of parallel tasks only stretch each task's
+    interval instead of multiplying the requests."""
+
+    def __init__(
+        self,
+        fetch: Fetch,
+        retry: RetryEngine,
+        endpoint: str = "task",
+        rate: float = 5.0,
+        concurrency: int = 4,
+    ) -> None:
+        self.fetch = fetch
+        self.retry = retry
+        self.endpoint = endpoint
+        self.rate = rate
+        self.concurrency = concurrency
+        self.tasks: dict[str, TrackedTask] = {}
+        # (due time, sequence, task_id) of every task waiting for its poll
+        self._due: list[tuple[float, int, str]] = []
+        self._seq = itertools.count()
+        self._runner: Union[asyncio.Task, None] = None
+        self._polls: set[asyncio.Task] = set()
+        self._wakeup: Union[asyncio.Event, None] = None
+        self._loop: Union[asyncio.AbstractEventLoop, None] = None
+
+    async def wait(
+        self, task_id: str, settled: Settled, attempts: Union[int, None] = None
+    ) -> Union[dict[str, Any], None]:
+        """The response that settled task_id, None if it didn't settle within
+        attempts polls. Raises what the poll or settled raised."""
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            # Whatever an earlier event loop left behind can't finish now
+            self.tasks, self._due, self._polls = {}, [], set()
+            self._runner = None
+            self._loop = loop
+        task = self.tasks.get(task_id)
+        if task is None:
+            attempts = attempts or self.retry.policy(self.endpoint).attempts
+            task = TrackedTask(task_id, settled, attempts, loop.create_future())
+            self.tasks[task_id] = task
+            self._schedule(task, 0.0)
+        if self._runner is None or self._runner.done():
+            self._wakeup = asyncio.Event()
+            self._runner = loop.create_task(self._run())
+        else:
+            self._wakeup.set()
+        return await task.future
+
+    def _schedule(self, task: TrackedTask, delay: float) -> None:
+        heapq.heappush(
+            self._due, (time.monotonic() + delay, next(self._seq), task.task_id)
+        )
+
+    def _finish(
+        self,
+        task: TrackedTask,
+        result: Union[dict[str, Any], None] = None,
+        error: Union[Exception, None] = None,
+    ) -> None:
+        if self.tasks.get(task.task_id) is task:
+            del self.tasks[task.task_id]
+        if task.future.done():
+            return
+        if error is not None:
+            task.future.set_exception(error)
+        else:
+            task.future.set_result(result)
+
+    async def _run(self) -> None:
+        slots = asyncio.Semaphore(self.concurrency)
+        next_start = 0.0
+        try:
+            while self._due or self._polls:
+                self._wakeup.clear()
+                if not self._due:
+                    # A poll in flight reschedules its task or settles it
+                    await self._wakeup.wait()
+                    continue
+                due, _, task_id = self._due[0]
+                start = max(due, next_start)
+                now = time.monotonic()
+                if start > now:
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), start - now)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                heapq.heappop(self._due)
+                task = self.tasks.get(task_id)
+                if task is None or task.future.done():
+                    # Its caller gave up
+                    self.tasks.pop(task_id, None)
+                    continue
+                await slots.acquire()
+                next_start = time.monotonic() + 1 / self.rate
+                self._polls.add(asyncio.create_task(self._poll(task, slots)))
+        finally:
+            for poll in list(self._polls):
+                poll.cancel()
+
+    async def _poll(self, task: TrackedTask, slots: asyncio.Semaphore) -> None:
+        try:
+            index = task.polls
+            task.polls += 1
+            await self.retry.admit(self.endpoint, index)
+            try:
+                response = await self.fetch(task.task_id, index)
+            except Exception as e:
+                self.retry.breaker(self.endpoint).record(not is_endpoint_failure(e))
+                self._finish(task, error=e)
+                return
+            # The endpoint answered, even when the task itself failed
+            self.retry.success(self.endpoint)
+            try:
+                settled = task.settled(response)
+            except Exception as e:
+                self._finish(task, error=e)
+                return
+            if settled:
+                self._finish(task, response)
+            elif task.polls >= task.attempts:
+                self._finish(task, None)
+            else:
+                if self.retry.metrics:
+                    self.retry.metrics.retry(self.endpoint)
+                self._schedule(task, self.retry.policy(self.endpoint).delay(index))
+        finally:
+            # Gone before the runner looks, or it would wait for it forever
+            self._polls.discard(asyncio.current_task())
+            slots.release()
+            self._wakeup.set()
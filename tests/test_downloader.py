@@ -0,0 +1,80 @@
+import asyncio
+import threading
+
+from downloader import BandwidthLimiter, BufferPool, FileWriter, WriteBuffer
+
+
+def test_cancelled_writer_keeps_other_writes(tmp_path):
+    path = tmp_path / "file.bin"
+    path.write_bytes(b"\0" * 20)
+
+    async def run() -> None:
+        writer = FileWriter(str(path), max_pending=1)
+        # Hold the writer thread so the queued writes can't start yet
+        release = threading.Event()
+        writer._executor.submit(release.wait)
+        await writer.write(0, b"a" * 10)
+        # Over max_pending, blocks on the first worker's write
+        blocked = asyncio.create_task(writer.write(10, b"b" * 10))
+        await asyncio.sleep(0.05)
+        assert not blocked.done()
+        blocked.cancel()
+        await asyncio.sleep(0)
+        release.set()
+        await writer.close()
+        assert blocked.cancelled()
+
+    asyncio.run(run())
+    assert path.read_bytes() == b"a" * 10 + b"b" * 10
+
+
+def test_bandwidth_limiter_forgets_job_with_cancelled_waiters():
+    async def run() -> None:
+        limiter = BandwidthLimiter(rate=1000, burst=1.0)
+        await limiter.consume("a", 1000)
+        waiter = asyncio.create_task(limiter.consume("a", 1000))
+        # The dispatcher is asleep waiting for tokens when the job ends
+        await asyncio.sleep(0.05)
+        waiter.cancel()
+        await asyncio.sleep(0)
+        limiter.forget("a")
+        # A file starting next must not trip over what "a" left behind
+        await asyncio.wait_for(limiter.consume("b", 10), 2)
+
+    asyncio.run(run())
+
+
+def test_cancelled_write_recycles_buffer_after_thread(tmp_path):
+    path = tmp_path / "file.bin"
+    path.write_bytes(b"\0" * 10)
+    entered, release = threading.Event(), threading.Event()
+
+    class SlowHasher:
+        """Keeps the writer thread inside the write, reading the buffer."""
+
+        def update(self, data) -> None:
+            entered.set()
+            release.wait()
+            self.data = bytes(data)
+
+    async def run() -> None:
+        pool = BufferPool(64)
+        writer = FileWriter(str(path), pool=pool)
+        hasher = SlowHasher()
+        buffer = WriteBuffer(writer, 0, hasher)
+        buffer.append(b"x" * 10)
+        buffer.flush_nowait()
+        await asyncio.get_running_loop().run_in_executor(None, entered.wait)
+        try:
+            writer._pending[0].cancel()
+            await asyncio.sleep(0.05)
+            # Still in use by the writer thread
+            assert not pool._free
+        finally:
+            release.set()
+        await writer.close()
+        await asyncio.sleep(0.05)
+        assert len(pool._free) == 1
+        assert hasher.data == b"x" * 10
+
+    asyncio.run(run())
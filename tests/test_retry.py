@@ -0,0 +1,22 @@
+import asyncio
+
+import httpx
+
+from retry import RetryEngine, RetryPolicy
+
+
+def test_fixed_cause_keeps_retry_budget():
+    request = httpx.Request("GET", "https://cdn.example/file")
+    expired = httpx.HTTPStatusError(
+        "403", request=request, response=httpx.Response(403, request=request)
+    )
+
+    async def run() -> None:
+        engine = RetryEngine(policies={"cdn": RetryPolicy(attempts=3)})
+        reserve = engine.budget("cdn").tokens
+        # The caller already fetched a fresh URL, nothing is wrong with the CDN
+        for _ in range(20):
+            assert await engine.failure("cdn", 0, expired, backoff=False)
+        assert engine.budget("cdn").tokens == reserve
+
+    asyncio.run(run())